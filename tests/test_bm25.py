@@ -0,0 +1,89 @@
+__author__ = "qiao"
+
+"""
+BM25Index against rank_bm25.BM25Okapi on a toy corpus: the same scores for every document, and
+the same top-N up to the order of the documents tied at the cut-off.
+"""
+
+import numpy as np
+import os
+import pytest
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trialgpt_retrieval"))
+from bm25 import BM25Index, check_parity
+
+rank_bm25 = pytest.importorskip("rank_bm25")
+
+# duplicated documents (tied scores), an empty document, and terms in most documents (negative idf)
+CORPUS = [
+	"breast cancer her2 positive metastatic",
+	"breast cancer triple negative",
+	"type 2 diabetes mellitus metformin",
+	"type 2 diabetes mellitus insulin",
+	"breast cancer her2 positive metastatic",
+	"chronic kidney disease dialysis",
+	"",
+	"cancer cancer cancer patients with cancer",
+	"hypertension and type 2 diabetes",
+	"non small cell lung cancer egfr mutation",
+	"cancer of the breast in patients",
+	"healthy volunteers",
+]
+TOKENIZED_CORPUS = [doc.split() for doc in CORPUS]
+
+QUERIES = [
+	["breast", "cancer"],
+	["her2", "positive"],
+	["type", "2", "diabetes"],
+	["cancer"],
+	["dialysis", "kidney", "kidney"],
+	["unseen", "terms"],
+	["lung", "cancer", "unseen"],
+]
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_scores_match_rank_bm25(query):
+	reference = rank_bm25.BM25Okapi(TOKENIZED_CORPUS)
+	index = BM25Index.from_tokenized_corpus(TOKENIZED_CORPUS)
+
+	assert np.allclose(index.get_scores([query])[0], reference.get_scores(query))
+
+
+@pytest.mark.parametrize("n", [1, 3, 5, len(CORPUS)])
+def test_top_n_matches_rank_bm25(n):
+	reference = rank_bm25.BM25Okapi(TOKENIZED_CORPUS)
+	index = BM25Index.from_tokenized_corpus(TOKENIZED_CORPUS)
+	top_scores, top_inds = index.search(QUERIES, n)
+
+	for query, scores, inds in zip(QUERIES, top_scores, top_inds):
+		ref_scores = reference.get_scores(query)
+		ref_inds = np.argsort(-ref_scores, kind="stable")[:n]
+
+		# the same score at every rank, and the scores returned are those of the documents returned
+		assert np.allclose(scores, ref_scores[ref_inds])
+		assert np.allclose(ref_scores[inds], scores)
+
+		# the same documents above the n-th score, the ones tied with it may differ
+		cutoff = scores[-1] + 1e-9
+		assert set(inds[scores > cutoff]) == set(ref_inds[ref_scores[ref_inds] > cutoff])
+
+		# the ties are broken by document index
+		assert all(
+			scores[rank] > scores[rank + 1] or inds[rank] < inds[rank + 1]
+			for rank in range(len(inds) - 1)
+		)
+
+	assert check_parity(TOKENIZED_CORPUS, QUERIES, n) == 0
+
+
+def test_saved_index_matches(tmp_path):
+	index = BM25Index.from_tokenized_corpus(TOKENIZED_CORPUS)
+	nctids = [f"NCT{idx:08d}" for idx in range(len(CORPUS))]
+	index.save(str(tmp_path / "bm25"), nctids, [""] * len(CORPUS), {"size": 0, "mtime": 0, "sha256": ""})
+
+	loaded, loaded_nctids = BM25Index.load(str(tmp_path / "bm25"))
+
+	assert loaded_nctids == nctids
+	assert np.allclose(loaded.get_scores(QUERIES), index.get_scores(QUERIES))
@@ -0,0 +1,98 @@
+__author__ = "qiao"
+
+"""
+The vectorized NDCG of RankingTable.evaluate against the reference rank_results.get_ndcg, and the
+unparsed matching outputs left out of the table.
+"""
+
+import numpy as np
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trialgpt_ranking"))
+from rank_results import get_ndcg
+from ranking_engine import RankingTable
+
+LABELS = {
+	"inclusion": ["included", "not included", "not applicable", "not enough information"],
+	"exclusion": ["excluded", "not excluded", "not applicable", "not enough information"],
+}
+
+
+def get_toy_results(seed: int = 0, num_patients: int = 5, num_trials: int = 30):
+	"""Random matching and aggregation results and graded qrels, with tied scores."""
+	rng = np.random.default_rng(seed)
+	matching_results = {}
+	agg_results = {}
+	qrels = {}
+
+	for patient in range(num_patients):
+		patient_id = f"P{patient}"
+		trial_ids = [f"NCT{trial:08d}" for trial in rng.choice(100, num_trials, replace=False)]
+
+		matching_results[patient_id] = {"0": {}}
+		agg_results[patient_id] = {}
+
+		for trial_id in trial_ids:
+			matching_results[patient_id]["0"][trial_id] = {
+				inc_exc: {str(idx): ["", [], str(rng.choice(labels))] for idx in range(rng.integers(1, 4))}
+				for inc_exc, labels in LABELS.items()
+			}
+
+			# coarse scores, so that some trials tie
+			agg_results[patient_id][trial_id] = {
+				"relevance_score_R": float(rng.choice([0, 50, 100])),
+				"eligibility_score_E": float(rng.choice([-100, 0, 100])),
+			}
+
+		# a patient without any relevant trial has an NDCG of 0
+		if patient < num_patients - 1:
+			qrels[patient_id] = {trial_id: int(rng.integers(0, 3)) for trial_id in rng.choice(trial_ids, 15, replace=False)}
+		else:
+			qrels[patient_id] = {trial_id: 0 for trial_id in trial_ids[:5]}
+
+	return matching_results, agg_results, qrels
+
+
+def test_evaluate_matches_get_ndcg():
+	matching_results, agg_results, qrels = get_toy_results()
+	table = RankingTable(matching_results, agg_results)
+	scores = table.get_scores()
+
+	for k in [1, 5, 10, 50]:
+		metrics = table.evaluate(scores, qrels, k=k)
+		rankings = table.top_k(scores)
+		reference = [get_ndcg([trial_id for trial_id, _ in rankings[patient_id]], qrel, k) for patient_id, qrel in qrels.items()]
+
+		assert metrics["num_patients"] == len(qrels)
+		assert np.isclose(metrics[f"ndcg@{k}"], np.mean(reference))
+
+
+def test_evaluate_skips_patients_without_qrels():
+	matching_results, agg_results, qrels = get_toy_results(seed=1)
+	table = RankingTable(matching_results, agg_results)
+	scores = table.get_scores()
+	qrels = {patient_id: qrel for patient_id, qrel in qrels.items() if patient_id != "P0"}
+
+	metrics = table.evaluate(scores, qrels, k=10)
+	rankings = table.top_k(scores)
+	reference = [get_ndcg([trial_id for trial_id, _ in rankings[patient_id]], qrel) for patient_id, qrel in qrels.items()]
+
+	assert metrics["num_patients"] == len(qrels)
+	assert np.isclose(metrics["ndcg@10"], np.mean(reference))
+
+
+def test_unparsed_matching_outputs_are_skipped():
+	matching_results, agg_results, qrels = get_toy_results(seed=2)
+	trial_ids = list(matching_results["P0"]["0"])
+
+	# the matching keeps the raw text when the output does not parse
+	matching_results["P0"]["0"][trial_ids[0]] = "not a JSON output"
+	matching_results["P0"]["0"][trial_ids[1]]["exclusion"] = "not a JSON output"
+
+	table = RankingTable(matching_results, agg_results)
+	rankings = table.top_k(table.get_scores())
+	ranked = [trial_id for trial_id, _ in rankings["P0"]]
+
+	assert trial_ids[0] not in ranked and trial_ids[1] not in ranked
+	assert len(ranked) == len(trial_ids) - 2
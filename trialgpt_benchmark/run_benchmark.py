@@ -0,0 +1,467 @@
+__author__ = "qiao"
+
+"""
+Benchmarks of the retrieval and LLM stages, written as JSON so that runs can be compared over time.
+The retrieval benchmarks build BM25 and FAISS indices of synthetic corpora of configurable sizes
+and search them with the conditions of the bundled patients. The LLM benchmarks run the matching
+and the aggregation against the local mock OpenAI server, with a configurable latency and share
+of 429 errors.
+"""
+
+import argparse
+import asyncio
+import ctypes
+import faiss
+import gc
+import importlib.util
+import json
+import numpy as np
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+sys.path.append(os.path.join(ROOT, "trialgpt_utils"))
+sys.path.append(os.path.join(ROOT, "trialgpt_retrieval"))
+
+from bm25 import BM25Index, TOKENIZERS, regex_tokenize, tokenize_corpus
+from faiss_index import build_faiss_index, get_factory_string, set_search_param
+from fusion import reciprocal_rank_fusion
+from instrumentation import labels, metrics
+from llm_client import LLMClient
+from llm_executor import LLMExecutor
+from mock_openai_server import MockHandler, serve
+from patient_notes import PatientNotes
+
+# the search parameter of the approximate indices (efSearch or nprobe)
+SEARCH_PARAM = 64
+
+# glibc, to return the freed heap memory to the system before measuring the RSS
+try:
+	LIBC = ctypes.CDLL("libc.so.6")
+except OSError:
+	LIBC = None
+
+
+def load_module(name: str, path: str):
+	"""trialgpt_matching and trialgpt_ranking both have a TrialGPT.py, so they are loaded by path."""
+	spec = importlib.util.spec_from_file_location(name, path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+
+	return module
+
+
+def get_percentiles(seconds: list) -> dict:
+	latencies = np.array(seconds, dtype=np.float64) * 1000
+
+	return {
+		"p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+		"p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+		"mean_ms": float(np.mean(latencies)) if len(latencies) else 0.0,
+	}
+
+
+def get_dir_size(path: str) -> int:
+	if os.path.isfile(path):
+		return os.path.getsize(path)
+
+	return sum(os.path.getsize(os.path.join(dirpath, name)) for dirpath, _, names in os.walk(path) for name in names)
+
+
+def get_max_rss_mb() -> float:
+	"""Peak resident memory of the process so far (ru_maxrss is in KB on Linux, in bytes on macOS)."""
+	max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+	return max_rss / 1024 ** 2 if sys.platform == "darwin" else max_rss / 1024
+
+
+def get_rss_mb() -> float:
+	"""
+	Current resident memory of the process, from /proc/self/statm on Linux (the peak elsewhere).
+	The freed memory is released first, otherwise the next phase could reuse it without growing the RSS.
+	"""
+	gc.collect()
+
+	if LIBC is not None and hasattr(LIBC, "malloc_trim"):
+		LIBC.malloc_trim(0)
+
+	try:
+		with open("/proc/self/statm", "r") as f:
+			pages = int(f.read().split()[1])
+	except OSError:
+		return get_max_rss_mb()
+
+	return pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+def load_patients(corpora: list) -> list:
+	"""List[(Str(patient_id), Str(note), List[Str(condition)])] of the bundled cohorts that are present."""
+	patients = []
+
+	for corpus in corpora:
+		query_path = os.path.join(ROOT, "dataset", corpus, "queries.jsonl")
+
+		if not os.path.exists(query_path):
+			continue
+
+		id2queries_path = os.path.join(ROOT, "dataset", corpus, "id2queries.json")
+		id2queries = json.load(open(id2queries_path)) if os.path.exists(id2queries_path) else {}
+
+		with open(query_path, "r") as f:
+			for line in f:
+				entry = json.loads(line)
+				conditions = id2queries.get(entry["_id"], {}).get("gpt-4-turbo", {}).get("conditions") or [entry["text"]]
+				patients.append((entry["_id"], entry["text"], conditions))
+
+	return patients
+
+
+class SyntheticTrials:
+	"""Trials sampled from the word distribution of the patient notes, so that the conditions match them."""
+
+	def __init__(self, patients: list, seed: int = 0):
+		counts = {}
+
+		for _, note, conditions in patients:
+			for token in regex_tokenize(" ".join([note] + conditions).lower()):
+				if token.isalpha() and len(token) > 2:
+					counts[token] = counts.get(token, 0) + 1
+
+		self.words = list(counts.keys())
+		self.weights = np.array(list(counts.values()), dtype=np.float64)
+		self.weights /= self.weights.sum()
+		self.rng = np.random.default_rng(seed)
+
+
+	def get_text(self, num_words: int) -> str:
+		return " ".join(self.rng.choice(self.words, size=num_words, p=self.weights))
+
+
+	def get_criteria(self, name: str, num_criteria: int) -> str:
+		return f"{name} criteria:\n\n" + "\n\n".join(f"{self.get_text(12).capitalize()}." for _ in range(num_criteria))
+
+
+	def get_trial(self, idx: int) -> dict:
+		"""A trial_info.json record."""
+		return {
+			"NCTID": f"NCT{idx:08d}",
+			"brief_title": self.get_text(10).capitalize(),
+			"diseases_list": [self.get_text(2) for _ in range(2)],
+			"drugs_list": [self.get_text(1) for _ in range(2)],
+			"brief_summary": f"{self.get_text(60).capitalize()}.",
+			"inclusion_criteria": self.get_criteria("Inclusion", 8),
+			"exclusion_criteria": self.get_criteria("Exclusion", 8),
+		}
+
+
+	def write_corpus(self, path: str, num_docs: int):
+		"""A corpus.jsonl of num_docs trials."""
+		with open(path, "w") as f:
+			for idx in range(num_docs):
+				entry = {
+					"_id": f"NCT{idx:08d}",
+					"title": self.get_text(10).capitalize(),
+					"text": self.get_text(150),
+					"metadata": {"diseases_list": [self.get_text(2) for _ in range(2)]},
+				}
+				f.write(json.dumps(entry) + "\n")
+
+
+def bench_retrieval(trials: SyntheticTrials, patients: list, num_docs: int, args, tmp_dir: str) -> dict:
+	"""Build, load and search BM25 and FAISS indices of a synthetic corpus of num_docs trials."""
+	output = {"num_docs": num_docs}
+	N = min(args.N, num_docs)
+	corpus_path = os.path.join(tmp_dir, f"corpus_{num_docs}.jsonl")
+	trials.write_corpus(corpus_path, num_docs)
+
+	# BM25: streamed tokenization, CSR build and save, then memory-mapped load, each with its RSS delta
+	index_dir = os.path.join(tmp_dir, f"bm25_{num_docs}")
+	start_rss = get_rss_mb()
+	start_time = time.perf_counter()
+	tokenized_corpus, nctids, hashes = tokenize_corpus(corpus_path, args.tokenizer, args.num_workers)
+	tokenize_time = time.perf_counter() - start_time
+	tokenize_rss = get_rss_mb() - start_rss
+
+	start_rss = get_rss_mb()
+	start_time = time.perf_counter()
+	bm25 = BM25Index.from_tokenized_corpus(tokenized_corpus, tokenizer=args.tokenizer)
+	bm25.save(index_dir, nctids, hashes, {"size": 0, "mtime": 0, "sha256": ""})
+	build_time = time.perf_counter() - start_time
+	build_rss = get_rss_mb() - start_rss
+
+	# nothing is freed before the load is measured, so that the load neither reuses nor releases memory
+	start_rss = get_rss_mb()
+	start_time = time.perf_counter()
+	loaded_bm25, nctids = BM25Index.load(index_dir)
+	load_time = time.perf_counter() - start_time
+	load_rss = get_rss_mb() - start_rss
+
+	del tokenized_corpus
+	bm25 = loaded_bm25
+
+	tokenize = TOKENIZERS[args.tokenizer]
+	queries = [[tokenize(condition.lower()) for condition in conditions] for _, _, conditions in patients]
+	latencies = []
+
+	for condition_tokens in queries:
+		start_time = time.perf_counter()
+		bm25.search(condition_tokens, N)
+		latencies.append(time.perf_counter() - start_time)
+
+	output["bm25"] = {
+		"tokenizer": args.tokenizer,
+		"num_workers": args.num_workers,
+		"tokenize_s": tokenize_time,
+		"build_s": build_time,
+		"load_s": load_time,
+		"tokenize_rss_mb": tokenize_rss,
+		"build_rss_mb": build_rss,
+		"load_rss_mb": load_rss,
+		"disk_mb": get_dir_size(index_dir) / 1024 ** 2,
+		"num_terms": len(bm25.vocab),
+		"search": get_percentiles(latencies),
+	}
+
+	# MedCPT: random unit-norm embeddings stand in for the encoder outputs, which need the model
+	rng = np.random.default_rng(args.seed)
+	embeds = rng.standard_normal((num_docs, 768)).astype(np.float32)
+	embeds /= np.linalg.norm(embeds, axis=1, keepdims=True)
+	query_embeds = [rng.standard_normal((len(conditions), 768)).astype(np.float32) for _, _, conditions in patients]
+
+	output["medcpt"] = {"embeds_mb": embeds.nbytes / 1024 ** 2}
+
+	for index_type in args.index_types:
+		index_path = os.path.join(tmp_dir, f"{index_type}_{num_docs}.faiss")
+
+		start_rss = get_rss_mb()
+		start_time = time.perf_counter()
+		index = build_faiss_index(embeds, get_factory_string(index_type, num_docs))
+		build_time = time.perf_counter() - start_time
+		build_rss = get_rss_mb() - start_rss
+
+		faiss.write_index(index, index_path)
+
+		start_rss = get_rss_mb()
+		start_time = time.perf_counter()
+		loaded_index = faiss.read_index(index_path)
+		load_time = time.perf_counter() - start_time
+		load_rss = get_rss_mb() - start_rss
+		index = loaded_index
+
+		if index_type != "flat":
+			set_search_param(index, index_type, SEARCH_PARAM)
+
+		latencies = []
+
+		for condition_embeds in query_embeds:
+			start_time = time.perf_counter()
+			index.search(condition_embeds, N)
+			latencies.append(time.perf_counter() - start_time)
+
+		# freed here, so that the next build does not release it while being measured
+		del index, loaded_index
+
+		output["medcpt"][index_type] = {
+			"build_s": build_time,
+			"load_s": load_time,
+			"build_rss_mb": build_rss,
+			"load_rss_mb": load_rss,
+			"disk_mb": get_dir_size(index_path) / 1024 ** 2,
+			"search": get_percentiles(latencies),
+		}
+
+	# per-patient retrieval as in HybridRetriever.retrieve, without the query encoder
+	index = faiss.IndexFlatIP(768)
+	index.add(embeds)
+	latencies = []
+
+	for condition_tokens, condition_embeds in zip(queries, query_embeds):
+		start_time = time.perf_counter()
+		_, bm25_inds = bm25.search(condition_tokens, N)
+		_, medcpt_inds = index.search(condition_embeds, N)
+		# FAISS pads the rankings with -1 when it finds fewer than N documents
+		medcpt_inds = [inds[inds >= 0] for inds in medcpt_inds]
+		reciprocal_rank_fusion([list(bm25_inds), medcpt_inds], [1, 1], 20, N, num_docs)
+		latencies.append(time.perf_counter() - start_time)
+
+	output["hybrid_retrieval"] = get_percentiles(latencies)
+
+	return output
+
+
+async def bench_llm(trials: SyntheticTrials, patients: list, args) -> dict:
+	"""Matching and aggregation throughput of num_pairs patient-trial pairs against the mock server."""
+	server = serve(0, args.llm_latency, args.error_rate, background=True, rate_limit_share=1.0)
+	os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+	matching = load_module("trialgpt_matching_main", os.path.join(ROOT, "trialgpt_matching", "TrialGPT.py"))
+	ranking = load_module("trialgpt_ranking_main", os.path.join(ROOT, "trialgpt_ranking", "TrialGPT.py"))
+
+	# no response cache, so that every call reaches the server
+	client = LLMClient(cache_path="off", executor=LLMExecutor(max_concurrency=args.max_concurrency))
+	patient_notes = PatientNotes(path=None, segmenter=args.segmenter)
+
+	rng = random.Random(args.seed)
+	trial_list = [trials.get_trial(idx) for idx in range(max(1, args.num_pairs // 4))]
+	pairs = [(rng.choice(patients), rng.choice(trial_list)) for _ in range(args.num_pairs)]
+	pairs = [(patient_notes.get(patient_id, note), trial) for (patient_id, note, _), trial in pairs]
+
+	output = {
+		"num_pairs": args.num_pairs,
+		"max_concurrency": args.max_concurrency,
+		"mock_latency_s": args.llm_latency,
+		"rate_limit_rate": args.error_rate,
+	}
+
+	for stage in ["matching", "aggregation"]:
+		MockHandler.counts.clear()
+		metrics.reset()
+		latencies = []
+
+		async def run_pair(patient, trial, results=None):
+			start_time = time.perf_counter()
+
+			with labels(trial_id=trial["NCTID"]):
+				if stage == "matching":
+					result = await matching.trialgpt_matching_async(trial, patient, "mock", client)
+				else:
+					result = await ranking.trialgpt_aggregation_async(patient, results, trial, "mock", client)
+
+			latencies.append(time.perf_counter() - start_time)
+
+			return result
+
+		start_time = time.perf_counter()
+
+		if stage == "matching":
+			matching_results = await asyncio.gather(*[run_pair(patient, trial) for patient, trial in pairs])
+		else:
+			await asyncio.gather(*[run_pair(patient, trial, results) for (patient, trial), results in zip(pairs, matching_results)])
+
+		elapsed = time.perf_counter() - start_time
+
+		output[stage] = {
+			"seconds": elapsed,
+			"pairs_per_s": len(pairs) / elapsed,
+			"requests": MockHandler.counts["requests"],
+			"rate_limited": MockHandler.counts["429"],
+			"requests_per_s": MockHandler.counts["requests"] / elapsed,
+			"pair_latency": get_percentiles(latencies),
+			# the client-side tokens, retries and parse failures by stage, see instrumentation.py
+			"metrics": metrics.summary(),
+		}
+
+	server.shutdown()
+
+	return output
+
+
+def get_meta(args) -> dict:
+	try:
+		commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+	except OSError:
+		commit = ""
+
+	return {
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"commit": commit,
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"cpu_count": os.cpu_count(),
+		"numpy": np.__version__,
+		"args": vars(args),
+	}
+
+
+def flatten(output, prefix: str = "") -> dict:
+	"""Dict{Str(dotted path): Float} of the numeric leaves of a benchmark output."""
+	if isinstance(output, dict):
+		return {key: value for name, child in output.items() for key, value in flatten(child, f"{prefix}{name}.").items()}
+
+	if isinstance(output, (int, float)) and not isinstance(output, bool):
+		return {prefix[:-1]: output}
+
+	return {}
+
+
+def compare(old: dict, new: dict):
+	"""Print the relative change of every numeric result shared by two runs."""
+	old_values = flatten({key: value for key, value in old.items() if key != "meta"})
+	new_values = flatten({key: value for key, value in new.items() if key != "meta"})
+
+	print(f"Comparing {old['meta']['commit'][:8]} ({old['meta']['time']}) with {new['meta']['commit'][:8]} ({new['meta']['time']})")
+
+	for key, new_value in new_values.items():
+		if key not in old_values:
+			continue
+
+		old_value = old_values[key]
+		change = (new_value - old_value) / abs(old_value) if old_value else 0.0
+		print(f"{key:<60}{old_value:>14.4f}{new_value:>14.4f}{change:>+10.1%}")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the retrieval and LLM stages, the results are written as JSON.")
+	parser.add_argument("--stages", default="retrieval,llm", help="comma-separated subset of retrieval and llm")
+	parser.add_argument("--corpora", default="sigir,trec_2021,trec_2022", help="the cohorts whose patients are used as queries")
+	parser.add_argument("--num_docs", default="1000,10000", help="comma-separated sizes of the synthetic corpora")
+	parser.add_argument("--tokenizer", default="nltk", help="the BM25 tokenizer, nltk or regex")
+	parser.add_argument("--num_workers", type=int, default=1, help="the processes that tokenize the corpus")
+	parser.add_argument("--index_types", default="flat,hnsw", help="comma-separated FAISS index types")
+	parser.add_argument("--N", type=int, default=1000, help="the number of trials retrieved per condition")
+	parser.add_argument("--segmenter", default="punkt", help="the sentence segmenter of the patient notes, punkt or regex")
+	parser.add_argument("--num_pairs", type=int, default=200, help="the patient-trial pairs matched and aggregated")
+	parser.add_argument("--max_concurrency", type=int, default=16)
+	parser.add_argument("--llm_latency", type=float, default=0.2, help="the latency of the mock server in seconds")
+	parser.add_argument("--error_rate", type=float, default=0.05, help="the share of the mock requests answered with 429")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", default=None, help="default: results/benchmark_{time}.json")
+	parser.add_argument("--compare", default=None, help="a previous output to compare with")
+	args = parser.parse_args()
+
+	args.stages = args.stages.split(",")
+	args.index_types = args.index_types.split(",")
+	sizes = [int(size) for size in args.num_docs.split(",")]
+
+	patients = load_patients(args.corpora.split(","))
+	trials = SyntheticTrials(patients, args.seed)
+	output = {"meta": get_meta(args)}
+
+	if "retrieval" in args.stages:
+		tmp_dir = tempfile.mkdtemp(prefix="trialgpt_benchmark_")
+
+		try:
+			# keyed by the corpus size, so that runs with different sizes are compared size by size
+			output["retrieval"] = {}
+
+			for num_docs in sizes:
+				output["retrieval"][str(num_docs)] = bench_retrieval(trials, patients, num_docs, args, tmp_dir)
+				print(json.dumps(output["retrieval"][str(num_docs)], indent=4))
+
+		finally:
+			shutil.rmtree(tmp_dir)
+
+	if "llm" in args.stages:
+		output["llm"] = asyncio.run(bench_llm(trials, patients, args))
+		print(json.dumps(output["llm"], indent=4))
+
+	output["meta"]["max_rss_mb"] = get_max_rss_mb()
+
+	output_path = args.output or os.path.join(ROOT, "results", f"benchmark_{time.strftime('%Y%m%d-%H%M%S')}.json")
+	os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+	with open(output_path, "w") as f:
+		json.dump(output, f, indent=4)
+
+	print(f"Results saved to {output_path}")
+
+	if args.compare:
+		compare(json.load(open(args.compare)), output)
@@ -4,20 +4,40 @@ __author__ = "qiao"
 TrialGPT-Matching main functions.
 """
 
+import asyncio
+import functools
+import hashlib
 import json
 from nltk.tokenize import sent_tokenize
 import time
 import os
+import sys
 
-from openai import AzureOpenAI
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trialgpt_utils"))
+from instrumentation import labeled, labels, metrics
+from llm_client import LLMClient
+from llm_executor import estimate_tokens
+from prompt_budget import PromptBudget, count_message_tokens, count_tokens, truncate_tokens
 
-client = AzureOpenAI(
-	api_version="2023-09-01-preview",
-	azure_endpoint=os.getenv("OPENAI_ENDPOINT"),
-	api_key=os.getenv("OPENAI_API_KEY"),
-)
+client = LLMClient()
 
-def parse_criteria(criteria):
+# Dict{(Str(NCTID), Str(inc_exc)): Str(trial)}, the trial texts are shared by all patients
+trial_texts = {}
+
+# the compaction levels of a matching prompt over its token budget, the lowest-value fields are cut first
+MATCHING_LEVELS = [
+	{},
+	{"summary_tokens": 64},
+	{"summary_tokens": 0},
+	{"summary_tokens": 0, "criterion_tokens": 128},
+	{"summary_tokens": 0, "criterion_tokens": 64},
+	{"summary_tokens": 0, "criterion_tokens": 32},
+]
+
+
+@functools.lru_cache(maxsize=None)
+def parse_criteria(criteria, criterion_tokens=None):
+	"""The numbered criteria, each cut to criterion_tokens if given."""
 	output = ""
 	criteria = criteria.split("\n\n")
 	
@@ -31,7 +51,7 @@ def parse_criteria(criteria):
 		if len(criterion) < 5:
 			continue
 	
-		output += f"{idx}. {criterion}\n" 
+		output += f"{idx}. {truncate_tokens(criterion, criterion_tokens)}\n" 
 		idx += 1
 	
 	return output
@@ -40,79 +60,413 @@ def parse_criteria(criteria):
 def print_trial(
 	trial_info: dict,
 	inc_exc: str,
+	summary_tokens: int = None,
+	criterion_tokens: int = None,
 ) -> str:
-	"""Given a dict of trial information, returns a string of trial."""
+	"""
+	Given a dict of trial information, returns a string of trial, memoized by NCT ID.
+	summary_tokens and criterion_tokens cut the summary and each criterion for a token budget.
+	"""
+	compacted = summary_tokens is not None or criterion_tokens is not None
+	key = (trial_info.get("NCTID"), inc_exc)
+
+	if key[0] is not None and not compacted and key in trial_texts:
+		return trial_texts[key]
 	
 	trial = f"Title: {trial_info['brief_title']}\n"
 	trial += f"Target diseases: {', '.join(trial_info['diseases_list'])}\n"
 	trial += f"Interventions: {', '.join(trial_info['drugs_list'])}\n"
-	trial += f"Summary: {trial_info['brief_summary']}\n"
+	trial += f"Summary: {truncate_tokens(trial_info['brief_summary'], summary_tokens)}\n"
 	
 	if inc_exc == "inclusion":
-		trial += "Inclusion criteria:\n %s\n" % parse_criteria(trial_info['inclusion_criteria'])
+		trial += "Inclusion criteria:\n %s\n" % parse_criteria(trial_info['inclusion_criteria'], criterion_tokens)
 	elif inc_exc == "exclusion":
-		trial += "Exclusion criteria:\n %s\n" % parse_criteria(trial_info['exclusion_criteria']) 
+		trial += "Exclusion criteria:\n %s\n" % parse_criteria(trial_info['exclusion_criteria'], criterion_tokens) 
+
+	if key[0] is not None and not compacted:
+		trial_texts[key] = trial
 
 	return trial
 
 
-def get_matching_prompt(
-	trial_info: dict,
-	inc_exc: str,
-	patient: str,
-) -> str:
-	"""Output the prompt."""
-	prompt = f"You are a helpful assistant for clinical trial recruitment. Your task is to compare a given patient note and the {inc_exc} criteria of a clinical trial to determine the patient's eligibility at the criterion level.\n"
+def get_trial_section(trial_info: dict, inc_exc: str, **compaction) -> str:
+	return f"Here is the clinical trial:\n{print_trial(trial_info, inc_exc, **compaction)}\n\n"
+
+
+def get_criteria_instructions(inc_exc: str) -> str:
+	"""The criterion-level instructions and labels shared by the single-trial and the batched prompts."""
+	instructions = ""
 
 	if inc_exc == "inclusion":
-		prompt += "The factors that allow someone to participate in a clinical study are called inclusion criteria. They are based on characteristics such as age, gender, the type and stage of a disease, previous treatment history, and other medical conditions.\n"
+		instructions += "The factors that allow someone to participate in a clinical study are called inclusion criteria. They are based on characteristics such as age, gender, the type and stage of a disease, previous treatment history, and other medical conditions.\n"
 	
 	elif inc_exc == "exclusion":
-		prompt += "The factors that disqualify someone from participating are called exclusion criteria. They are based on characteristics such as age, gender, the type and stage of a disease, previous treatment history, and other medical conditions.\n"
+		instructions += "The factors that disqualify someone from participating are called exclusion criteria. They are based on characteristics such as age, gender, the type and stage of a disease, previous treatment history, and other medical conditions.\n"
 
-	prompt += f"You should check the {inc_exc} criteria one-by-one, and output the following three elements for each criterion:\n"
-	prompt += f"\tElement 1. For each {inc_exc} criterion, briefly generate your reasoning process: First, judge whether the criterion is not applicable (not very common), where the patient does not meet the premise of the criterion. Then, check if the patient note contains direct evidence. If so, judge whether the patient meets or does not meet the criterion. If there is no direct evidence, try to infer from existing evidence, and answer one question: If the criterion is true, is it possible that a good patient note will miss such information? If impossible, then you can assume that the criterion is not true. Otherwise, there is not enough information.\n"
-	prompt += f"\tElement 2. If there is relevant information, you must generate a list of relevant sentence IDs in the patient note. If there is no relevant information, you must annotate an empty list.\n" 
-	prompt += f"\tElement 3. Classify the patient eligibility for this specific {inc_exc} criterion: "
+	instructions += f"You should check the {inc_exc} criteria one-by-one, and output the following three elements for each criterion:\n"
+	instructions += f"\tElement 1. For each {inc_exc} criterion, briefly generate your reasoning process: First, judge whether the criterion is not applicable (not very common), where the patient does not meet the premise of the criterion. Then, check if the patient note contains direct evidence. If so, judge whether the patient meets or does not meet the criterion. If there is no direct evidence, try to infer from existing evidence, and answer one question: If the criterion is true, is it possible that a good patient note will miss such information? If impossible, then you can assume that the criterion is not true. Otherwise, there is not enough information.\n"
+	instructions += f"\tElement 2. If there is relevant information, you must generate a list of relevant sentence IDs in the patient note. If there is no relevant information, you must annotate an empty list.\n" 
+	instructions += f"\tElement 3. Classify the patient eligibility for this specific {inc_exc} criterion: "
 	
 	if inc_exc == "inclusion":
-		prompt += 'the label must be chosen from {"not applicable", "not enough information", "included", "not included"}. "not applicable" should only be used for criteria that are not applicable to the patient. "not enough information" should be used where the patient note does not contain sufficient information for making the classification. Try to use as less "not enough information" as possible because if the note does not mention a medically important fact, you can assume that the fact is not true for the patient. "included" denotes that the patient meets the inclusion criterion, while "not included" means the reverse.\n'
+		instructions += 'the label must be chosen from {"not applicable", "not enough information", "included", "not included"}. "not applicable" should only be used for criteria that are not applicable to the patient. "not enough information" should be used where the patient note does not contain sufficient information for making the classification. Try to use as less "not enough information" as possible because if the note does not mention a medically important fact, you can assume that the fact is not true for the patient. "included" denotes that the patient meets the inclusion criterion, while "not included" means the reverse.\n'
 	elif inc_exc == "exclusion":
-		prompt += 'the label must be chosen from {"not applicable", "not enough information", "excluded", "not excluded"}. "not applicable" should only be used for criteria that are not applicable to the patient. "not enough information" should be used where the patient note does not contain sufficient information for making the classification. Try to use as less "not enough information" as possible because if the note does not mention a medically important fact, you can assume that the fact is not true for the patient. "excluded" denotes that the patient meets the exclusion criterion and should be excluded in the trial, while "not excluded" means the reverse.\n'
-	
+		instructions += 'the label must be chosen from {"not applicable", "not enough information", "excluded", "not excluded"}. "not applicable" should only be used for criteria that are not applicable to the patient. "not enough information" should be used where the patient note does not contain sufficient information for making the classification. Try to use as less "not enough information" as possible because if the note does not mention a medically important fact, you can assume that the fact is not true for the patient. "excluded" denotes that the patient meets the exclusion criterion and should be excluded in the trial, while "not excluded" means the reverse.\n'
+
+	return instructions
+
+
+def get_matching_prompt(
+	trial_info: dict,
+	inc_exc: str,
+	patient: str,
+	trial_first: bool = False,
+	**compaction,
+) -> str:
+	"""
+	Output the prompt. With trial_first, the trial comes before the patient note, so that the
+	system prompt and the trial form a stable prefix shared by all patients of the trial.
+	compaction is a level of MATCHING_LEVELS (the arguments of print_trial).
+	"""
+	prompt = f"You are a helpful assistant for clinical trial recruitment. Your task is to compare a given patient note and the {inc_exc} criteria of a clinical trial to determine the patient's eligibility at the criterion level.\n"
+
+	prompt += get_criteria_instructions(inc_exc)
+
 	prompt += "You should output only a JSON dict exactly formatted as: dict{str(criterion_number): list[str(element_1_brief_reasoning), list[int(element_2_sentence_id)], str(element_3_eligibility_label)]}."
 	
-	user_prompt = f"Here is the patient note, each sentence is led by a sentence_id:\n{patient}\n\n" 
-	user_prompt += f"Here is the clinical trial:\n{print_trial(trial_info, inc_exc)}\n\n"
+	if trial_first:
+		user_prompt = get_trial_section(trial_info, inc_exc, **compaction)
+		user_prompt += f"Here is the patient note, each sentence is led by a sentence_id:\n{patient}\n\n"
+	else:
+		user_prompt = f"Here is the patient note, each sentence is led by a sentence_id:\n{patient}\n\n" 
+		user_prompt += get_trial_section(trial_info, inc_exc, **compaction)
+
 	user_prompt += f"Plain JSON output:"
 
 	return prompt, user_prompt
 
 
-def trialgpt_matching(trial: dict, patient: str, model: str):
+class PrefixStats:
+	"""Share of the input tokens in prompt prefixes already sent in this run, counted as in prompt_budget.py."""
+
+	def __init__(self):
+		self.seen = set()
+		self.shared_tokens = 0
+		self.total_tokens = 0
+
+
+	def add(self, messages: list, prefix: str):
+		key = hashlib.sha1(prefix.encode("utf-8")).hexdigest()
+
+		if key in self.seen:
+			self.shared_tokens += count_tokens(prefix)
+
+		self.seen.add(key)
+		self.total_tokens += count_message_tokens(messages)
+
+
+	def ratio(self) -> float:
+		return self.shared_tokens / max(self.total_tokens, 1)
+
+
+	def report(self) -> str:
+		return f"Shared-prefix tokens: {self.shared_tokens} / {self.total_tokens} input tokens ({self.ratio():.1%})"
+
+
+def get_matching_messages(
+	trial: dict,
+	inc_exc: str,
+	patient: str,
+	trial_first: bool = False,
+	prompt_budget: PromptBudget = None,
+) -> list:
+	"""The prompt messages, compacted to the token budget of prompt_budget if given."""
+	def render(**compaction):
+		system_prompt, user_prompt = get_matching_prompt(trial, inc_exc, patient, trial_first, **compaction)
+
+		return [
+			{"role": "system", "content": system_prompt},
+			{"role": "user", "content": user_prompt},
+		]
+
+	if prompt_budget is None:
+		return render()
+
+	return prompt_budget.fit("matching", render, MATCHING_LEVELS)
+
+
+def load_matching_output(message: str):
+	return json.loads(message.strip().strip("`").strip("json"))
+
+
+def is_matching_output(message: str) -> bool:
+	"""Whether a matching output is a JSON dict, only those are cached."""
+	try:
+		return type(load_matching_output(message)) is dict
+	except ValueError:
+		return False
+
+
+def parse_matching_output(message: str):
+	"""The criterion-level JSON dict, or the raw message if it cannot be parsed."""
+	try:
+		return load_matching_output(message)
+	except:
+		metrics.record_parse_failure("the matching output is not valid JSON")
+		return message
+
+
+def get_static_prefix(messages: list, trial_first: bool) -> str:
+	"""The part of the prompt sent that does not depend on the patient, as compacted if it was."""
+	if trial_first:
+		return messages[0]["content"] + messages[1]["content"].split("Here is the patient note")[0]
+
+	return messages[0]["content"]
+
+
+def trialgpt_matching(
+	trial: dict,
+	patient: str,
+	model: str,
+	trial_first: bool = False,
+	prefix_stats: PrefixStats = None,
+	prompt_budget: PromptBudget = None,
+):
 	results = {}
 
 	# doing inclusions and exclusions in separate prompts
 	for inc_exc in ["inclusion", "exclusion"]:
-		system_prompt, user_prompt = get_matching_prompt(trial, inc_exc, patient)
-	
-		messages = [
+		messages = get_matching_messages(trial, inc_exc, patient, trial_first, prompt_budget)
+
+		if prefix_stats is not None:
+			prefix_stats.add(messages, get_static_prefix(messages, trial_first))
+
+		with labels(stage=f"matching_{inc_exc}"):
+			message = client.chat(model, messages, validate=is_matching_output, temperature=0)
+			results[inc_exc] = parse_matching_output(message)
+
+	return results
+
+
+async def trialgpt_matching_async(
+	trial: dict,
+	patient: str,
+	model: str,
+	client: LLMClient,
+	trial_first: bool = False,
+	prefix_stats: PrefixStats = None,
+	prompt_budget: PromptBudget = None,
+):
+	"""Same as trialgpt_matching, with the inclusion and exclusion prompts sent concurrently."""
+	inc_excs = ["inclusion", "exclusion"]
+	inc_exc_messages = [get_matching_messages(trial, inc_exc, patient, trial_first, prompt_budget) for inc_exc in inc_excs]
+
+	if prefix_stats is not None:
+		for inc_exc, messages in zip(inc_excs, inc_exc_messages):
+			prefix_stats.add(messages, get_static_prefix(messages, trial_first))
+
+	messages = await asyncio.gather(*[
+		labeled(client.achat(model, messages, validate=is_matching_output, temperature=0), stage=f"matching_{inc_exc}")
+		for inc_exc, messages in zip(inc_excs, inc_exc_messages)
+	])
+
+	results = {}
+
+	for inc_exc, message in zip(inc_excs, messages):
+		with labels(stage=f"matching_{inc_exc}"):
+			results[inc_exc] = parse_matching_output(message)
+
+	return results
+
+
+def get_batch_matching_prompt(
+	trials: list,
+	inc_exc: str,
+	patient: str,
+	trial_first: bool = False,
+	**compaction,
+) -> str:
+	"""
+	Output the prompt of several trials of one patient, answered with a dict keyed by NCT ID.
+	With trial_first, the trials come before the patient note. compaction is a level of
+	MATCHING_LEVELS, applied to every trial.
+	"""
+	prompt = f"You are a helpful assistant for clinical trial recruitment. Your task is to compare a given patient note and the {inc_exc} criteria of several clinical trials to determine the patient's eligibility at the criterion level.\n"
+
+	prompt += get_criteria_instructions(inc_exc)
+
+	prompt += "You should check every clinical trial, and output only a JSON dict exactly formatted as: dict{str(NCTID): dict{str(criterion_number): list[str(element_1_brief_reasoning), list[int(element_2_sentence_id)], str(element_3_eligibility_label)]}}."
+
+	patient_section = f"Here is the patient note, each sentence is led by a sentence_id:\n{patient}\n\n"
+	trial_sections = "".join(
+		f"Here is the clinical trial {trial['NCTID']}:\n{print_trial(trial, inc_exc, **compaction)}\n\n"
+		for trial in trials
+	)
+
+	if trial_first:
+		user_prompt = trial_sections + patient_section
+	else:
+		user_prompt = patient_section + trial_sections
+
+	user_prompt += "Plain JSON output:"
+
+	return prompt, user_prompt
+
+
+def get_batch_matching_messages(
+	trials: list,
+	inc_exc: str,
+	patient: str,
+	trial_first: bool = False,
+	prompt_budget: PromptBudget = None,
+) -> list:
+	"""The batched prompt messages, compacted to the token budget of prompt_budget if given."""
+	def render(**compaction):
+		system_prompt, user_prompt = get_batch_matching_prompt(trials, inc_exc, patient, trial_first, **compaction)
+
+		return [
 			{"role": "system", "content": system_prompt},
 			{"role": "user", "content": user_prompt},
 		]
 
-		response = client.chat.completions.create(
-			model=model,
-			messages=messages,
-			temperature=0,
-		)
+	if prompt_budget is None:
+		return render()
+
+	return prompt_budget.fit("matching_batch", render, MATCHING_LEVELS)
+
+
+def estimate_output_tokens(trial: dict, inc_exc: str) -> int:
+	"""About 100 output tokens per line of the trial text (mostly the criteria)."""
+	return 100 * print_trial(trial, inc_exc).count("\n")
+
+
+def get_trial_batches(
+	trials: list,
+	inc_exc: str,
+	patient: str,
+	token_budget: int,
+	max_batch_size: int = 8,
+	max_prompt_tokens: int = None,
+) -> list:
+	"""
+	Greedily group the trials of a patient into batches whose estimated prompt and output tokens
+	(about 100 output tokens per criterion) fit into token_budget, and whose prompt tokens fit into
+	max_prompt_tokens if given. A trial over the budget is batched alone.
+	"""
+	system_prompt, user_prompt = get_batch_matching_prompt([], inc_exc, patient)
+	base_tokens = estimate_tokens([{"content": system_prompt}, {"content": user_prompt}])
+
+	batches = []
+	batch = []
+	batch_tokens = base_tokens
+	prompt_tokens = base_tokens
+
+	for trial in trials:
+		criteria = print_trial(trial, inc_exc)
+		trial_prompt_tokens = len(criteria) // 4
+		trial_tokens = trial_prompt_tokens + estimate_output_tokens(trial, inc_exc)
+
+		if batch and (
+			batch_tokens + trial_tokens > token_budget
+			or len(batch) == max_batch_size
+			or (max_prompt_tokens is not None and prompt_tokens + trial_prompt_tokens > max_prompt_tokens)
+		):
+			batches.append(batch)
+			batch = []
+			batch_tokens = base_tokens
+			prompt_tokens = base_tokens
+
+		batch.append(trial)
+		batch_tokens += trial_tokens
+		prompt_tokens += trial_prompt_tokens
+
+	if batch:
+		batches.append(batch)
+
+	return batches
+
+
+async def match_batch_async(
+	trials: list,
+	inc_exc: str,
+	patient: str,
+	model: str,
+	client: LLMClient,
+	stats: dict = None,
+	prompt_budget: PromptBudget = None,
+	trial_first: bool = False,
+) -> dict:
+	"""
+	Dict{Str(NCTID): criterion-level output} of a batch, the trials missing from an unparseable
+	or incomplete batched output are matched one by one. The batched output is limited to the
+	output tokens estimated for its trials.
+	"""
+	outputs = {}
+
+	if len(trials) > 1:
+		messages = get_batch_matching_messages(trials, inc_exc, patient, trial_first, prompt_budget)
+		max_tokens = sum(estimate_output_tokens(trial, inc_exc) for trial in trials)
+
+		with labels(stage=f"matching_{inc_exc}_batch"):
+			batch_output = parse_matching_output(await client.achat(model, messages, validate=is_matching_output, temperature=0, max_tokens=max_tokens))
+
+		if type(batch_output) is dict:
+			outputs = {
+				trial["NCTID"]: batch_output[trial["NCTID"]] for trial in trials
+				if type(batch_output.get(trial["NCTID"])) is dict
+			}
+
+	fallbacks = [trial for trial in trials if trial["NCTID"] not in outputs]
+
+	if stats is not None:
+		stats["batched_requests"] = stats.get("batched_requests", 0) + (len(trials) > 1)
+		stats["single_requests"] = stats.get("single_requests", 0) + len(fallbacks)
+		stats["fallbacks"] = stats.get("fallbacks", 0) + (len(fallbacks) if len(trials) > 1 else 0)
+
+	messages = await asyncio.gather(*[
+		labeled(client.achat(model, get_matching_messages(trial, inc_exc, patient, trial_first, prompt_budget), validate=is_matching_output, temperature=0), stage=f"matching_{inc_exc}", trial_id=trial["NCTID"])
+		for trial in fallbacks
+	])
+
+	for trial, message in zip(fallbacks, messages):
+		with labels(stage=f"matching_{inc_exc}", trial_id=trial["NCTID"]):
+			outputs[trial["NCTID"]] = parse_matching_output(message)
+
+	return outputs
+
+
+async def trialgpt_matching_batch_async(
+	trials: list,
+	patient: str,
+	model: str,
+	client: LLMClient,
+	token_budget: int,
+	stats: dict = None,
+	prompt_budget: PromptBudget = None,
+	trial_first: bool = False,
+) -> dict:
+	"""
+	Batched trialgpt_matching of several trials of one patient, returns Dict{Str(NCTID): results}
+	with the same per-trial results as trialgpt_matching. With prompt_budget, the batches are
+	also sized to its max_tokens, and the batched and fallback prompts are compacted to it.
+	"""
+	inc_excs = ["inclusion", "exclusion"]
+	max_prompt_tokens = prompt_budget.max_tokens if prompt_budget is not None else None
+	jobs = [
+		(inc_exc, batch)
+		for inc_exc in inc_excs
+		for batch in get_trial_batches(trials, inc_exc, patient, token_budget, max_prompt_tokens=max_prompt_tokens)
+	]
+
+	batch_outputs = await asyncio.gather(*[
+		match_batch_async(batch, inc_exc, patient, model, client, stats, prompt_budget, trial_first)
+		for inc_exc, batch in jobs
+	])
 
-		message = response.choices[0].message.content.strip()
-		message = message.strip("`").strip("json")
+	results = {trial["NCTID"]: {} for trial in trials}
 
-		try:
-			results[inc_exc] = json.loads(message)
-		except:
-			results[inc_exc] = message
+	for (inc_exc, _), outputs in zip(jobs, batch_outputs):
+		for trial_id, output in outputs.items():
+			results[trial_id][inc_exc] = output
 
 	return results
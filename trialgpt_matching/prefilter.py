@@ -0,0 +1,372 @@
+__author__ = "qiao"
+
+"""
+Rule-based pre-screening of the retrieved trials before the LLM matching. The age and sex
+limits, the healthy-volunteers-only flag and the hard exclusion keywords of each trial are
+parsed once into a cached table, and each patient's candidates are filtered in one pass.
+"""
+
+from beir.datasets.data_loader import GenericDataLoader
+import json
+import numpy as np
+import os
+import re
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trialgpt_utils"))
+
+from trial_store import TrialStore
+
+RULES = ["age", "sex", "healthy", "keywords"]
+
+# the version of the parsing rules, a cached table of another version is parsed again
+FORMAT_VERSION = 2
+
+# sex constraints
+ANY_SEX = 0
+MALE = 1
+FEMALE = 2
+
+# exclusion criteria that disqualify a patient whose note states them, one bit each
+HARD_EXCLUSION_KEYWORDS = {
+	"pregnancy": r"\bpregnan\w*",
+	"lactation": r"\b(?:breast-?feeding|lactat\w*|nursing mothers?)\b",
+	"dialysis": r"\b(?:hemo)?dialysis\b",
+	"hiv": r"\bHIV\b",
+}
+
+NEGATION = re.compile(r"\b(?:no|not|denies|denied|without|negative for|free of|absence of)\b[^.;]*$", re.IGNORECASE)
+# a negation after the mention in the same sentence, e.g., "HIV test was negative"
+POST_NEGATION = re.compile(r"^[^.;]*?\b(?:negative|ruled out|not detected|non-?reactive|undetectable|absent)\b", re.IGNORECASE)
+
+# exclusion criteria that only exclude some of the patients with a keyword, e.g., "peritoneal dialysis"
+# for a patient on hemodialysis, "planning a pregnancy" for a pregnant patient, or "dialysis is allowed"
+TRIAL_PRE_CONTEXT = {
+	"pregnancy": re.compile(r"\b(?:plan\w*|intend\w*|wish\w*|partners?)\b[^.;]*$", re.IGNORECASE),
+	"dialysis": re.compile(r"\bperitoneal\s+$", re.IGNORECASE),
+}
+EXCEPTION = re.compile(r"\b(?:except|other than|unless|excluding)\b[^.;]*$", re.IGNORECASE)
+POST_EXCEPTION = re.compile(r"^[^.;]*?\b(?:allowed|permitted|eligible|acceptable)\b", re.IGNORECASE)
+
+AGE_MENTION = re.compile(r"\bage[sd]?\b|years? old|years? of age", re.IGNORECASE)
+AGE_RANGE = re.compile(r"\bage[sd]?\s*(?:between|from|of)?\s*(\d{1,3})\s*(?:-|–|to|and)\s*(\d{1,3})\s*(?:years?|yrs?)?", re.IGNORECASE)
+MIN_AGE = re.compile(r"(?:≥|>=|>|\bat least|\bover|\bolder than|\bgreater than(?: or equal to)?|\bminimum(?: age)?(?: of)?)\s*(\d{1,3})\s*(?:years?|yrs?)|\b(\d{1,3})\s*(?:years?|yrs?)(?: of age)?\s*(?:or|and) (?:older|over|above)", re.IGNORECASE)
+MAX_AGE = re.compile(r"(?:≤|<=|<|\bunder|\byounger than|\bless than(?: or equal to)?|\bmaximum(?: age)?(?: of)?|\bup to)\s*(\d{1,3})\s*(?:years?|yrs?)|\b(\d{1,3})\s*(?:years?|yrs?)(?: of age)?\s*(?:or|and) (?:younger|under|below)", re.IGNORECASE)
+
+FEMALE_WORDS = re.compile(r"\b(?:women|woman|female|females|girls?)\b", re.IGNORECASE)
+MALE_WORDS = re.compile(r"\b(?:men|man|male|males|boys?)\b", re.IGNORECASE)
+# sentences about contraception or pregnancy mention women without restricting the sex
+SEX_NEUTRAL = re.compile(r"childbearing|contracept|pregnan|lactat|breast-?feed", re.IGNORECASE)
+
+HEALTHY_ONLY = re.compile(r"\bhealthy (?:volunteers?|subjects?|adults?|participants?|individuals?|males?|females?|men|women)\b", re.IGNORECASE)
+
+PATIENT_AGE = re.compile(r"\b(\d{1,3})[- ](year|yr|month|week|day)s?[- ]old\b|\b(\d{1,3})\s*(?:yo|y/o|y\.o\.)", re.IGNORECASE)
+# the sex of the patient is only taken from the demographic phrase after the age, e.g., "45-year-old African American man",
+# since the rest of the note also mentions relatives ("his mother", "her father")
+PATIENT_SEX = re.compile(r"^[\s,]*(?:[A-Za-z-]+\s+){0,3}?(woman|female|girl|lady|man|male|boy|gentleman|f|m)\b", re.IGNORECASE)
+FEMALE_TERMS = {"woman", "female", "girl", "lady", "f"}
+
+
+def get_age_limits(inclusion: str, exclusion: str) -> tuple:
+	"""(min_age, max_age) in years from the criteria text, NaN when a limit is not found."""
+	min_age = np.nan
+	max_age = np.nan
+
+	for criterion in inclusion.split("\n"):
+		if not AGE_MENTION.search(criterion):
+			continue
+
+		match = AGE_RANGE.search(criterion)
+		if match:
+			low, high = sorted([int(match.group(1)), int(match.group(2))])
+			min_age = np.fmin(min_age, low)
+			max_age = np.fmax(max_age, high)
+			continue
+
+		for match in MIN_AGE.finditer(criterion):
+			min_age = np.fmin(min_age, int(match.group(1) or match.group(2)))
+
+		for match in MAX_AGE.finditer(criterion):
+			max_age = np.fmax(max_age, int(match.group(1) or match.group(2)))
+
+	# an upper limit in the exclusion criteria is a lower limit for inclusion, and vice versa
+	for criterion in exclusion.split("\n"):
+		if not AGE_MENTION.search(criterion):
+			continue
+
+		for match in MAX_AGE.finditer(criterion):
+			min_age = np.fmax(min_age, int(match.group(1) or match.group(2)))
+
+		for match in MIN_AGE.finditer(criterion):
+			max_age = np.fmin(max_age, int(match.group(1) or match.group(2)))
+
+	# conflicting limits are more likely parsing errors than real constraints
+	if min_age > max_age:
+		return np.nan, np.nan
+
+	return min_age, max_age
+
+
+def get_sex(trial_info: dict, inclusion: str) -> int:
+	"""MALE or FEMALE for trials restricted to one sex, otherwise ANY_SEX."""
+	gender = str(trial_info.get("gender", "")).lower()
+
+	if gender in ["male", "female"]:
+		return MALE if gender == "male" else FEMALE
+
+	text = " ".join(
+		[trial_info.get("brief_title", "")]
+		+ [sentence for sentence in re.split(r"[.\n]", inclusion) if not SEX_NEUTRAL.search(sentence)]
+	)
+	female = FEMALE_WORDS.search(text) is not None
+	male = MALE_WORDS.search(text) is not None
+
+	if female and not male:
+		return FEMALE
+	elif male and not female:
+		return MALE
+
+	return ANY_SEX
+
+
+def get_keyword_mask(text: str, negated: bool = False, qualified: bool = False) -> int:
+	"""
+	Bit mask of the hard exclusion keywords found in a text, skipping negated mentions if negated,
+	and the mentions that only exclude some of the patients with the keyword if qualified.
+	"""
+	mask = 0
+
+	for bit, (keyword, pattern) in enumerate(HARD_EXCLUSION_KEYWORDS.items()):
+		for match in re.finditer(pattern, text, flags=re.IGNORECASE):
+			before = text[max(0, match.start() - 80) : match.start()]
+			after = text[match.end() : match.end() + 80]
+
+			if negated and (NEGATION.search(before) or POST_NEGATION.search(after)):
+				continue
+
+			if qualified and (
+				(keyword in TRIAL_PRE_CONTEXT and TRIAL_PRE_CONTEXT[keyword].search(before))
+				or EXCEPTION.search(before)
+				or POST_EXCEPTION.search(after)
+			):
+				continue
+
+			mask |= 1 << bit
+			break
+
+	return mask
+
+
+def parse_trial(trial_info: dict) -> tuple:
+	"""(min_age, max_age, sex, healthy_only, keyword_mask) of a trial."""
+	inclusion = trial_info.get("inclusion_criteria", "")
+	exclusion = trial_info.get("exclusion_criteria", "")
+
+	min_age, max_age = get_age_limits(inclusion, exclusion)
+
+	# structured ClinicalTrials.gov fields, when the trial dict has them, take precedence
+	for key, value in [("minimum_age", "min_age"), ("maximum_age", "max_age")]:
+		match = re.match(r"(\d+)\s*(year|month|week|day)", str(trial_info.get(key, "")), flags=re.IGNORECASE)
+		if match:
+			years = int(match.group(1)) / {"year": 1, "month": 12, "week": 52, "day": 365}[match.group(2).lower()]
+			if value == "min_age":
+				min_age = years
+			else:
+				max_age = years
+
+	# healthy volunteers without any target disease besides "healthy"
+	healthy_only = HEALTHY_ONLY.search(trial_info.get("brief_title", "") + "\n" + inclusion) is not None and all(
+		disease.lower().startswith("healthy") for disease in trial_info.get("diseases_list", [])
+	)
+
+	return (
+		min_age,
+		max_age,
+		get_sex(trial_info, inclusion),
+		healthy_only,
+		get_keyword_mask(exclusion, negated=True, qualified=True),
+	)
+
+
+def parse_patient(patient: str) -> tuple:
+	"""(age in years or NaN, sex or ANY_SEX, keyword_mask) of a patient note."""
+	age = np.nan
+	match = PATIENT_AGE.search(patient)
+
+	if match and match.group(1):
+		age = int(match.group(1)) / {"year": 1, "yr": 1, "month": 12, "week": 52, "day": 365}[match.group(2).lower()]
+	elif match:
+		age = int(match.group(3))
+
+	# a hard filter prefers recall: without a demographic phrase, the patient matches any sex
+	sex = ANY_SEX
+
+	if match:
+		sex_match = PATIENT_SEX.match(patient[match.end() :])
+
+		if sex_match:
+			sex = FEMALE if sex_match.group(1).lower() in FEMALE_TERMS else MALE
+
+	return age, sex, get_keyword_mask(patient, negated=True)
+
+
+class TrialTable:
+	"""The parsed constraints of all trials as columns, cached with the size and mtime of the source."""
+
+	def __init__(self, nctids: list, min_age, max_age, sex, healthy_only, keyword_mask):
+		self.nctids = list(nctids)
+		self.nctid2idx = {nctid: idx for idx, nctid in enumerate(self.nctids)}
+		self.min_age = np.asarray(min_age, dtype=np.float32)
+		self.max_age = np.asarray(max_age, dtype=np.float32)
+		self.sex = np.asarray(sex, dtype=np.int8)
+		self.healthy_only = np.asarray(healthy_only, dtype=bool)
+		self.keyword_mask = np.asarray(keyword_mask, dtype=np.int64)
+
+
+	@classmethod
+	def from_trial_info(cls, trial2info):
+		"""trial2info is a dict or a TrialStore, whose records are parsed one at a time."""
+		nctids = []
+		rows = []
+
+		for nctid, info in trial2info.items():
+			nctids.append(nctid)
+			rows.append(parse_trial(info))
+
+		columns = list(zip(*rows)) or [[]] * 5
+
+		return cls(nctids, *columns)
+
+
+	@classmethod
+	def load(cls, trial_store: TrialStore = None, cache_path: str = "dataset/prefilter_table.npz"):
+		"""Load the cached table, or parse the trial information and cache it."""
+		trial_store = trial_store or TrialStore()
+		source = f"{trial_store.get_source_stamp()}:v{FORMAT_VERSION}"
+
+		if os.path.exists(cache_path):
+			cache = np.load(cache_path)
+
+			if str(cache["source"]) == source:
+				return cls(
+					json.loads(str(cache["nctids"])),
+					cache["min_age"],
+					cache["max_age"],
+					cache["sex"],
+					cache["healthy_only"],
+					cache["keyword_mask"],
+				)
+
+		table = cls.from_trial_info(trial_store)
+
+		np.savez(
+			cache_path,
+			source=source,
+			nctids=json.dumps(table.nctids),
+			min_age=table.min_age,
+			max_age=table.max_age,
+			sex=table.sex,
+			healthy_only=table.healthy_only,
+			keyword_mask=table.keyword_mask,
+		)
+
+		return table
+
+
+	def get_keep_mask(self, nctids: list, patient: str, rules: list = RULES) -> np.ndarray:
+		"""Boolean mask over nctids of the trials kept for a patient, unknown trials are kept."""
+		inds = np.array([self.nctid2idx.get(nctid, -1) for nctid in nctids], dtype=np.int64)
+		known = inds >= 0
+		inds = np.where(known, inds, 0)
+
+		age, sex, keyword_mask = parse_patient(patient)
+		keep = np.ones(len(nctids), dtype=bool)
+
+		# NaN limits and ages compare False, so unknowns never prune
+		if "age" in rules:
+			keep &= ~(self.min_age[inds] > age + 1e-6)
+			keep &= ~(self.max_age[inds] < age - 1e-6)
+
+		if "sex" in rules and sex != ANY_SEX:
+			keep &= ~((self.sex[inds] != ANY_SEX) & (self.sex[inds] != sex))
+
+		# the patients of the cohorts all present with a medical problem
+		if "healthy" in rules:
+			keep &= ~self.healthy_only[inds]
+
+		if "keywords" in rules:
+			keep &= (self.keyword_mask[inds] & keyword_mask) == 0
+
+		return keep | ~known
+
+
+def prefilter_instance(instance: dict, table: TrialTable, rules: list = RULES) -> tuple:
+	"""
+	Filter the trials of a retrieved_trials.json instance (labels "0", "1", "2").
+	Returns (the filtered instance, Dict{Str(label): List[Str(pruned NCTID)]}).
+	"""
+	filtered = {key: value for key, value in instance.items() if key not in ["0", "1", "2"]}
+	pruned = {}
+
+	for label in ["0", "1", "2"]:
+		if label not in instance:
+			continue
+
+		trials = instance[label]
+		keep = table.get_keep_mask([trial["NCTID"] for trial in trials], instance["patient"], rules)
+
+		filtered[label] = [trial for trial, kept in zip(trials, keep) if kept]
+		pruned[label] = [trial["NCTID"] for trial, kept in zip(trials, keep) if not kept]
+
+	return filtered, pruned
+
+
+if __name__ == "__main__":
+	# syntax: python trialgpt_matching/prefilter.py ${corpus} ${rules}
+	# ${rules} is a comma-separated subset of age,sex,healthy,keywords (default: all)
+	corpus = sys.argv[1]
+	rules = sys.argv[2].split(",") if len(sys.argv) > 2 else RULES
+
+	table = TrialTable.load()
+	dataset = json.load(open(f"dataset/{corpus}/retrieved_trials.json"))
+	_, _, qrels = GenericDataLoader(data_folder=f"dataset/{corpus}/").load(split="test")
+
+	outputs = []
+	num_trials = 0
+	num_pruned = 0
+	label2counts = {label: [0, 0] for label in ["0", "1", "2"]}
+	relevant_kept = 0
+	relevant_total = 0
+	# the relevant trials that each rule prunes on its own
+	rule2pruned = {rule: 0 for rule in rules}
+
+	for instance in dataset:
+		filtered, pruned = prefilter_instance(instance, table, rules)
+		outputs.append(filtered)
+
+		qrel = qrels.get(instance["patient_id"], {})
+
+		for label, nctids in pruned.items():
+			num_trials += len(instance[label])
+			num_pruned += len(nctids)
+			label2counts[label][0] += len(instance[label])
+			label2counts[label][1] += len(nctids)
+
+			relevant = [trial["NCTID"] for trial in instance[label] if qrel.get(trial["NCTID"], 0) > 0]
+			relevant_total += len(relevant)
+			relevant_kept += sum(nctid not in nctids for nctid in relevant)
+
+			for rule in rules:
+				rule2pruned[rule] += int((~table.get_keep_mask(relevant, instance["patient"], [rule])).sum())
+
+	with open(f"dataset/{corpus}/retrieved_trials_prefiltered.json", "w") as f:
+		json.dump(outputs, f, indent=4)
+
+	# each pruned trial saves one inclusion and one exclusion call
+	print(f"Rules: {','.join(rules)}")
+	print(f"Pruned {num_pruned} / {num_trials} trials, saving {2 * num_pruned} LLM matching calls and {num_pruned} aggregation calls")
+	for label, (total, pruned) in sorted(label2counts.items(), reverse=True):
+		print(f"Label {label}: pruned {pruned} / {total}")
+	print(f"Recall of the relevant trials (qrels > 0): {relevant_kept / max(relevant_total, 1):.4f}")
+	for rule, pruned in rule2pruned.items():
+		print(f"Recall loss of the {rule} rule alone: {pruned / max(relevant_total, 1):.4f} ({pruned} relevant trials pruned)")
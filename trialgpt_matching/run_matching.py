@@ -4,58 +4,152 @@ __author__ = "qiao"
 Running the TrialGPT matching for three cohorts (sigir, TREC 2021, TREC 2022).
 """
 
+import asyncio
 import json
-from nltk.tokenize import sent_tokenize
-import os
 import sys
 
-from TrialGPT import trialgpt_matching 
+from TrialGPT import PrefixStats, trialgpt_matching_async, trialgpt_matching_batch_async
+from instrumentation import labels, metrics
+from llm_client import LLMClient
+from llm_executor import LLMExecutor
+from patient_notes import PatientNotes
+from prompt_budget import PromptBudget
+from result_store import open_store
+from trial_store import TrialStore
 
-if __name__ == "__main__":
-	corpus = sys.argv[1]
-	model = sys.argv[2] 
-	
-	dataset = json.load(open(f"dataset/{corpus}/retrieved_trials.json"))
+
+async def match_trial(client, model, patient_id, label, trial, patient, trial_first, prefix_stats, prompt_budget):
+	# in case anything goes wrong (e.g., API calling errors after all retries)
+	try:
+		with labels(patient_id=patient_id, trial_id=trial["NCTID"]):
+			results = await trialgpt_matching_async(trial, patient, model, client, trial_first, prefix_stats, prompt_budget)
+		return patient_id, label, trial["NCTID"], results
+
+	except Exception as e:
+		print(e)
+		return patient_id, label, trial["NCTID"], None
+
+
+async def match_patient_batch(client, model, patient_id, label2trials, patient, token_budget, batch_stats, prompt_budget, trial_first):
+	"""Batched matching of the pending trials of a patient, returns a list of (patient_id, label, trial_id, results)."""
+	trials = [trial for trials in label2trials.values() for trial in trials]
+
+	try:
+		with labels(patient_id=patient_id):
+			results = await trialgpt_matching_batch_async(trials, patient, model, client, token_budget, batch_stats, prompt_budget, trial_first)
+
+	except Exception as e:
+		print(e)
+		return []
+
+	return [
+		(patient_id, label, trial["NCTID"], results[trial["NCTID"]])
+		for label, trials in label2trials.items()
+		for trial in trials
+	]
+
+
+async def main(corpus, model, max_concurrency, rpm, tpm, trial_first, token_budget, trials_name, max_prompt_tokens):
+	dataset = json.load(open(f"dataset/{corpus}/{trials_name}.json"))
 
 	output_path = f"results/matching_results_{corpus}_{model}.json" 
 
+	# e.g., the trials kept by prefilter.py
+	if trials_name != "retrieved_trials":
+		output_path = output_path.replace(".json", f"_{trials_name.replace('retrieved_trials_', '')}.json")
+
+	if token_budget:
+		output_path = output_path.replace(".json", "_batched.json")
+
+	if trial_first:
+		output_path = output_path.replace(".json", "_trial_first.json")
+
+	if max_prompt_tokens:
+		output_path = output_path.replace(".json", f"_budget{max_prompt_tokens}.json")
+
+	# one record per (patient, label, trial), exported to
 	# Dict{Str(patient_id): Dict{Str(label): Dict{Str(trial_id): Str(output)}}}
-	if os.path.exists(output_path):
-		output = json.load(open(output_path))
-	else:
-		output = {}
+	store = open_store(output_path, "matching")
+
+	# the trials can also be given by NCT ID only, and are then completed from the trial store
+	trial_store = TrialStore()
+
+	# the numbered patient notes, shared with run_aggregation.py
+	patient_notes = PatientNotes()
+
+	client = LLMClient(executor=LLMExecutor(max_concurrency=max_concurrency, rpm=rpm, tpm=tpm))
+	prefix_stats = PrefixStats()
+	prompt_budget = PromptBudget(max_prompt_tokens) if max_prompt_tokens else None
+	batch_stats = {}
+	tasks = []
 
 	for instance in dataset:
 		# Dict{'patient': Str(patient), '0': Str(NCTID), ...}
 		patient_id = instance["patient_id"]
-		patient = instance["patient"]
-		sents = sent_tokenize(patient)
-		sents.append("The patient will provide informed consent, and will comply with the trial protocol without any practical issues.")
-		sents = [f"{idx}. {sent}" for idx, sent in enumerate(sents)]
-		patient = "\n".join(sents)
-
-		# initialize the patient id in the output 
-		if patient_id not in output:
-			output[patient_id] = {"0": {}, "1": {}, "2": {}}
-		
+		patient = patient_notes.get(patient_id, instance["patient"])
+
+		label2trials = {}
+
 		for label in ["2", "1", "0"]:
 			if label not in instance: continue
 
-			for trial in instance[label]: 
+			for trial in trial_store.resolve(instance[label]):
 				trial_id = trial["NCTID"]
 
 				# already calculated and cached
-				if trial_id in output[patient_id][label]:
+				if (patient_id, label, trial_id) in store:
 					continue
 				
-				# in case anything goes wrong (e.g., API calling errors)
-				try:
-					results = trialgpt_matching(trial, patient, model)
-					output[patient_id][label][trial_id] = results
+				label2trials.setdefault(label, []).append(trial)
+
+				# the executor bounds the requests in flight
+				if not token_budget:
+					tasks.append(match_trial(client, model, patient_id, label, trial, patient, trial_first, prefix_stats, prompt_budget))
 
-					with open(output_path, "w") as f:
-						json.dump(output, f, indent=4)
+		if token_budget and label2trials:
+			tasks.append(match_patient_batch(client, model, patient_id, label2trials, patient, token_budget, batch_stats, prompt_budget, trial_first))
 
-				except Exception as e:
-					print(e)
+	try:
+		for task in asyncio.as_completed(tasks):
+			outputs = await task
+
+			for patient_id, label, trial_id, results in (outputs if token_budget else [outputs]):
+				if results is None:
 					continue
+
+				store.put(patient_id, label, trial_id, results)
+
+	finally:
+		store.close()
+		store.export(output_path)
+		print(client.stats())
+		if token_budget:
+			print(f"Batched matching: {batch_stats}")
+		else:
+			print(prefix_stats.report())
+		if prompt_budget is not None:
+			print(prompt_budget.report(corpus))
+
+		# the tokens, latencies, retries and parse failures per (patient, trial, stage)
+		print(metrics.report())
+		metrics.save(output_path.replace("matching_results_", "metrics_matching_"))
+
+
+if __name__ == "__main__":
+	# syntax: python trialgpt_matching/run_matching.py ${corpus} ${model} ${max_concurrency} ${rpm} ${tpm} ${prompt_order} ${token_budget} ${trials_name} ${max_prompt_tokens}
+	# ${rpm} and ${tpm} are the requests and tokens per minute of the deployment, 0 for no limit
+	# ${prompt_order} can be patient_first (default) or trial_first
+	# ${token_budget} > 0 batches several trials of a patient per request within that many tokens (default: 0, one trial per request)
+	# ${trials_name} is the trial file in dataset/${corpus}/, retrieved_trials (default) or retrieved_trials_prefiltered
+	# ${max_prompt_tokens} > 0 compacts the prompts over that many tokens, see trialgpt_utils/prompt_budget.py (default: 0, no limit)
+	corpus = sys.argv[1]
+	model = sys.argv[2] 
+	max_concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+	rpm = float(sys.argv[4]) if len(sys.argv) > 4 else 0
+	tpm = float(sys.argv[5]) if len(sys.argv) > 5 else 0
+	trial_first = len(sys.argv) > 6 and sys.argv[6] == "trial_first"
+	token_budget = int(sys.argv[7]) if len(sys.argv) > 7 else 0
+	trials_name = sys.argv[8] if len(sys.argv) > 8 else "retrieved_trials"
+	max_prompt_tokens = int(sys.argv[9]) if len(sys.argv) > 9 else 0
+
+	asyncio.run(main(corpus, model, max_concurrency, rpm or None, tpm or None, trial_first, token_budget, trials_name, max_prompt_tokens))
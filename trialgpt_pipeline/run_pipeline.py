@@ -0,0 +1,318 @@
+__author__ = "qiao"
+
+"""
+Streaming TrialGPT pipeline: each patient flows through retrieval, (optional) prefiltering,
+matching, aggregation and ranking. The stages are connected by bounded queues, so a trial
+is aggregated as soon as its matching result arrives, and a patient is ranked as soon as
+all of its trials are done. The matching and aggregation results are kept in the result
+stores of run_matching.py and run_aggregation.py, from which an interrupted run resumes.
+"""
+
+import argparse
+import asyncio
+from beir.datasets.data_loader import GenericDataLoader
+import importlib.util
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+sys.path.append(os.path.join(ROOT, "trialgpt_utils"))
+sys.path.append(os.path.join(ROOT, "trialgpt_retrieval"))
+sys.path.append(os.path.join(ROOT, "trialgpt_matching"))
+sys.path.append(os.path.join(ROOT, "trialgpt_ranking"))
+
+from hybrid_fusion_retrieval import HybridRetriever, get_conditions
+from instrumentation import labels, metrics
+from llm_client import LLMClient
+from llm_executor import LLMExecutor
+from patient_notes import PatientNotes
+from prefilter import TrialTable, prefilter_instance
+from prompt_budget import PromptBudget
+from rank_results import get_agg_score, get_matching_score
+from result_store import open_store
+from trial_store import TrialStore
+
+
+def load_module(name: str, path: str):
+	"""trialgpt_matching and trialgpt_ranking both have a TrialGPT.py, so they are loaded by path."""
+	spec = importlib.util.spec_from_file_location(name, path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+
+	return module
+
+
+matching = load_module("trialgpt_matching_main", os.path.join(ROOT, "trialgpt_matching", "TrialGPT.py"))
+ranking = load_module("trialgpt_ranking_main", os.path.join(ROOT, "trialgpt_ranking", "TrialGPT.py"))
+
+
+def is_valid_matching(results) -> bool:
+	"""Whether both criterion-level outputs parsed, parse_matching_output keeps the raw text otherwise."""
+	return type(results) is dict and type(results.get("inclusion")) is dict and type(results.get("exclusion")) is dict
+
+
+class Pipeline:
+	def __init__(self, args):
+		self.args = args
+
+		_, self.queries, self.qrels = GenericDataLoader(data_folder=f"dataset/{args.corpus}/").load(split="test")
+		self.id2queries = json.load(open(f"dataset/{args.corpus}/id2queries.json"))
+		self.trial_store = TrialStore()
+		self.patient_notes = PatientNotes()
+
+		self.retriever = HybridRetriever(args.corpus, cache_path="trialgpt_retrieval/query_cache.sqlite3")
+		self.table = TrialTable.load(self.trial_store) if args.prefilter else None
+		self.prompt_budget = PromptBudget(args.max_prompt_tokens) if args.max_prompt_tokens else None
+
+		self.client = LLMClient(executor=LLMExecutor(
+			max_concurrency=args.matching_workers + args.aggregation_workers,
+			rpm=args.rpm or None,
+			tpm=args.tpm or None,
+		))
+
+		suffix = f"{args.corpus}_{args.model}"
+		self.matching_store = open_store(f"results/matching_results_{suffix}_pipeline.json", "matching")
+		self.aggregation_store = open_store(f"results/aggregation_results_{suffix}_pipeline.json", "aggregation")
+		# one line per ranked patient, the nested .json is written once at the end
+		self.ranking_path = f"results/pipeline_rankings_{suffix}.jsonl"
+
+		# bounded queues give the backpressure between the stages
+		self.patient_queue = asyncio.Queue()
+		self.matching_queue = asyncio.Queue(maxsize=args.queue_size)
+		self.aggregation_queue = asyncio.Queue(maxsize=args.queue_size)
+
+		# Dict{Str(patient_id): Int(trials not done yet)}
+		self.remaining = {}
+		# Dict{Str(patient_id): List[(Str(label), Str(trial_id))]}, the trials of this run
+		self.patient_trials = {}
+		self.rankings = {}
+		self.counts = {"patients": 0, "trials": 0, "pruned": 0, "matched": 0, "aggregated": 0, "resumed": 0, "skipped": 0}
+
+
+	async def retrieve(self):
+		"""Retrieval stage: top-N trials of a patient, then the prefilter, then the pending work."""
+		while True:
+			patient_id = await self.patient_queue.get()
+
+			if patient_id is None:
+				return
+
+			# one patient that fails (e.g., a missing note) must not stop the retrieval stage
+			try:
+				conditions = get_conditions(self.id2queries, patient_id, self.args.q_type)
+				nctids = []
+
+				if conditions:
+					# the retrieval is CPU-bound, a worker thread keeps the LLM stages running
+					with labels(patient_id=patient_id):
+						nctids = await asyncio.to_thread(
+							self.retriever.retrieve,
+							conditions,
+							k=self.args.k,
+							bm25_wt=self.args.bm25_wt,
+							medcpt_wt=self.args.medcpt_wt,
+							N=self.args.N,
+						)
+
+				patient = self.patient_notes.get(patient_id, self.queries[patient_id])
+				qrel = self.qrels.get(patient_id, {})
+
+				# the qrels labels only group the trials in the exported matching results
+				instance = {"patient_id": patient_id, "patient": self.queries[patient_id], "0": [], "1": [], "2": []}
+				for trial in self.trial_store.resolve(nctids):
+					instance[str(qrel.get(trial["NCTID"], 0))].append(trial)
+
+				if self.table is not None:
+					instance, pruned = prefilter_instance(instance, self.table)
+					self.counts["pruned"] += sum(len(trials) for trials in pruned.values())
+
+				jobs = [(label, trial) for label in ["2", "1", "0"] for trial in instance[label]]
+				self.patient_trials[patient_id] = [(label, trial["NCTID"]) for label, trial in jobs]
+				self.remaining[patient_id] = len(jobs)
+				self.counts["patients"] += 1
+				self.counts["trials"] += len(jobs)
+
+				if not jobs:
+					self.rank(patient_id)
+
+				for label, trial in jobs:
+					trial_id = trial["NCTID"]
+
+					if (patient_id, None, trial_id) in self.aggregation_store:
+						self.counts["resumed"] += 1
+						self.done(patient_id)
+					elif (patient_id, label, trial_id) in self.matching_store:
+						results = self.matching_store.results[(patient_id, label, trial_id)]
+						await self.aggregation_queue.put((patient_id, patient, trial, results))
+					else:
+						await self.matching_queue.put((patient_id, patient, label, trial))
+
+			except Exception as e:
+				print(f"{patient_id}: {e}")
+
+
+	async def match(self):
+		"""Matching stage: criterion-level predictions, passed on to the aggregation right away."""
+		while True:
+			item = await self.matching_queue.get()
+
+			if item is None:
+				return
+
+			patient_id, patient, label, trial = item
+
+			try:
+				with labels(patient_id=patient_id, trial_id=trial["NCTID"]):
+					results = await matching.trialgpt_matching_async(
+						trial, patient, self.args.model, self.client, self.args.trial_first, prompt_budget=self.prompt_budget
+					)
+			except Exception as e:
+				print(e)
+				self.done(patient_id)
+				continue
+
+			self.matching_store.put(patient_id, label, trial["NCTID"], results)
+			self.counts["matched"] += 1
+
+			await self.aggregation_queue.put((patient_id, patient, trial, results))
+
+
+	async def aggregate(self):
+		"""Aggregation stage: trial-level relevance and eligibility scores."""
+		while True:
+			item = await self.aggregation_queue.get()
+
+			if item is None:
+				return
+
+			patient_id, patient, trial, results = item
+
+			try:
+				if not is_valid_matching(results):
+					result = "matching result error"
+				else:
+					with labels(patient_id=patient_id, trial_id=trial["NCTID"]):
+						result = await ranking.trialgpt_aggregation_async(
+							patient, results, trial, self.args.model, self.client, self.prompt_budget
+						)
+
+				self.aggregation_store.put(patient_id, None, trial["NCTID"], result)
+				self.counts["aggregated"] += 1
+
+			except Exception as e:
+				print(e)
+
+			finally:
+				self.done(patient_id)
+
+
+	def done(self, patient_id: str):
+		self.remaining[patient_id] -= 1
+
+		if self.remaining[patient_id] == 0:
+			self.rank(patient_id)
+
+
+	def rank(self, patient_id: str):
+		"""Ranking stage: matching score + aggregation score, as in rank_results.py, over the trials of this run."""
+		trial2score = {}
+
+		# a failed ranking must not stop the worker that finished the patient
+		try:
+			for label, trial_id in self.patient_trials.get(patient_id, []):
+				results = self.matching_store.results.get((patient_id, label, trial_id))
+
+				if not is_valid_matching(results):
+					continue
+
+				agg_score = 0
+				if (patient_id, None, trial_id) in self.aggregation_store:
+					agg_score = get_agg_score(self.aggregation_store.results[(patient_id, None, trial_id)])
+
+				trial2score[trial_id] = get_matching_score(results) + agg_score
+
+		except Exception as e:
+			print(f"{patient_id}: {e}")
+
+		self.rankings[patient_id] = sorted(trial2score.items(), key=lambda x: -x[1])
+
+		with open(self.ranking_path, "a") as f:
+			f.write(json.dumps({"patient_id": patient_id, "ranking": self.rankings[patient_id]}) + "\n")
+
+
+	async def run(self):
+		start_time = time.time()
+
+		with open(f"dataset/{self.args.corpus}/queries.jsonl", "r") as f:
+			for line in f:
+				patient_id = json.loads(line)["_id"]
+
+				# as in hybrid_fusion_retrieval.py, only the judged patients with keywords are run
+				if patient_id not in self.qrels or patient_id not in self.id2queries or patient_id not in self.queries:
+					self.counts["skipped"] += 1
+					continue
+
+				await self.patient_queue.put(patient_id)
+
+		retrievers = [asyncio.create_task(self.retrieve()) for _ in range(self.args.retrieval_workers)]
+		matchers = [asyncio.create_task(self.match()) for _ in range(self.args.matching_workers)]
+		aggregators = [asyncio.create_task(self.aggregate()) for _ in range(self.args.aggregation_workers)]
+
+		try:
+			# each stage is shut down once its upstream is done
+			for _ in retrievers:
+				await self.patient_queue.put(None)
+			await asyncio.gather(*retrievers)
+
+			for _ in matchers:
+				await self.matching_queue.put(None)
+			await asyncio.gather(*matchers)
+
+			for _ in aggregators:
+				await self.aggregation_queue.put(None)
+			await asyncio.gather(*aggregators)
+
+		finally:
+			for store in [self.matching_store, self.aggregation_store]:
+				store.close()
+				store.export(store.path.replace(".jsonl", ".json"))
+
+			with open(self.ranking_path.replace(".jsonl", ".json"), "w") as f:
+				json.dump(self.rankings, f, indent=4)
+
+		print(f"Pipeline done in {time.time() - start_time:.1f}s: {self.counts}")
+		print(self.client.stats())
+		if self.prompt_budget is not None:
+			print(self.prompt_budget.report(self.args.corpus))
+		print(metrics.report())
+		metrics.save(f"results/metrics_pipeline_{self.args.corpus}_{self.args.model}.json")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run TrialGPT end to end, streaming the patients through the stages.")
+	parser.add_argument("corpus", help="sigir, trec_2021, or trec_2022")
+	parser.add_argument("model", help="any model index in OpenAI or AzureOpenAI API")
+	parser.add_argument("--q_type", default="gpt-4-turbo", help="the keyword type for the retrieval")
+	parser.add_argument("--N", type=int, default=100, help="the number of retrieved trials to match per patient")
+	parser.add_argument("--k", type=int, default=20, help="the reciprocal rank fusion constant")
+	parser.add_argument("--bm25_wt", type=float, default=1)
+	parser.add_argument("--medcpt_wt", type=float, default=1)
+	parser.add_argument("--prefilter", action="store_true", help="apply the rule-based prefilter before matching")
+	parser.add_argument("--trial_first", action="store_true", help="put the trial before the patient note in the matching prompts")
+	parser.add_argument("--max_prompt_tokens", type=int, default=0, help="compact the prompts over this many tokens, 0 for no limit")
+	parser.add_argument("--retrieval_workers", type=int, default=1)
+	parser.add_argument("--matching_workers", type=int, default=16)
+	parser.add_argument("--aggregation_workers", type=int, default=8)
+	parser.add_argument("--queue_size", type=int, default=64, help="the bound of the queues between the stages")
+	parser.add_argument("--rpm", type=float, default=0, help="requests per minute of the deployment, 0 for no limit")
+	parser.add_argument("--tpm", type=float, default=0, help="tokens per minute of the deployment, 0 for no limit")
+	args = parser.parse_args()
+
+	async def main():
+		# the queues and the executor are created in the running event loop
+		await Pipeline(args).run()
+
+	asyncio.run(main())
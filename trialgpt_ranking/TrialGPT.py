@@ -8,20 +8,43 @@ import json
 from nltk.tokenize import sent_tokenize
 import time
 import os
-
-from openai import AzureOpenAI
-
-client = AzureOpenAI(
-	api_version="2023-09-01-preview",
-	azure_endpoint=os.getenv("OPENAI_ENDPOINT"),
-	api_key=os.getenv("OPENAI_API_KEY"),
-)
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trialgpt_utils"))
+from instrumentation import labels, metrics
+from llm_client import LLMClient
+from prompt_budget import PromptBudget, truncate_tokens
+
+client = LLMClient()
+
+# the compaction levels of an aggregation prompt over its token budget, the lowest-value fields are cut
+# first: the reasoning of the "not applicable" criteria, the summary, then the other reasoning and criteria
+NOT_APPLICABLE = ("not applicable",)
+UNINFORMATIVE = ("not applicable", "not enough information")
+
+AGGREGATION_LEVELS = [
+	{},
+	{"drop_reasoning": NOT_APPLICABLE},
+	{"drop_reasoning": NOT_APPLICABLE, "summary_tokens": 64},
+	{"drop_reasoning": NOT_APPLICABLE, "summary_tokens": 0},
+	{"drop_reasoning": UNINFORMATIVE, "summary_tokens": 0},
+	{"drop_reasoning": UNINFORMATIVE, "summary_tokens": 0, "reasoning_tokens": 32},
+	{"drop_reasoning": UNINFORMATIVE, "summary_tokens": 0, "reasoning_tokens": 32, "criterion_tokens": 64},
+	{"drop_reasoning": UNINFORMATIVE, "summary_tokens": 0, "reasoning_tokens": 32, "criterion_tokens": 32},
+]
 
 def convert_criteria_pred_to_string(
 		prediction: dict,
 		trial_info: dict,
+		drop_reasoning: tuple = (),
+		reasoning_tokens: int = None,
+		criterion_tokens: int = None,
 ) -> str:
-	"""Given the TrialGPT prediction, output the linear string of the criteria."""
+	"""
+	Given the TrialGPT prediction, output the linear string of the criteria.
+	For a token budget, the reasoning of the criteria labeled as in drop_reasoning is left out,
+	and the other reasoning and the criteria are cut to reasoning_tokens and criterion_tokens.
+	"""
 	output = ""
 
 	for inc_exc in ["inclusion", "exclusion"]:
@@ -54,8 +77,9 @@ def convert_criteria_pred_to_string(
 			if len(preds) != 3:
 				continue
 
-			output += f"{inc_exc} criterion {idx}: {criterion}\n"
-			output += f"\tPatient relevance: {preds[0]}\n"
+			output += f"{inc_exc} criterion {idx}: {truncate_tokens(criterion, criterion_tokens)}\n"
+			if preds[2] not in drop_reasoning:
+				output += f"\tPatient relevance: {truncate_tokens(str(preds[0]), reasoning_tokens)}\n"
 			if len(preds[1]) > 0:
 				output += f"\tEvident sentences: {preds[1]}\n"
 			output += f"\tPatient eligibility: {preds[2]}\n"
@@ -67,15 +91,17 @@ def convert_pred_to_prompt(
 		patient: str,
 		pred: dict,
 		trial_info: dict,
+		summary_tokens: int = None,
+		**compaction,
 ) -> str:
-	"""Convert the prediction to a prompt string."""
+	"""Convert the prediction to a prompt string, compaction is a level of AGGREGATION_LEVELS."""
 	# get the trial string
 	trial = f"Title: {trial_info['brief_title']}\n"
 	trial += f"Target conditions: {', '.join(trial_info['diseases_list'])}\n"
-	trial += f"Summary: {trial_info['brief_summary']}"
+	trial += f"Summary: {truncate_tokens(trial_info['brief_summary'], summary_tokens)}"
 
 	# then get the prediction strings
-	pred = convert_criteria_pred_to_string(pred, trial_info)
+	pred = convert_criteria_pred_to_string(pred, trial_info, **compaction)
 
 	# construct the prompt
 	prompt = "You are a helpful assistant for clinical trial recruitment. You will be given a patient note, a clinical trial, and the patient eligibility predictions for each criterion.\n"
@@ -96,25 +122,67 @@ def convert_pred_to_prompt(
 	return prompt, user_prompt
 
 
-def trialgpt_aggregation(patient: str, trial_results: dict, trial_info: dict, model: str):
-	system_prompt, user_prompt = convert_pred_to_prompt(
-			patient,
-			trial_results,
-			trial_info
-	)   
-
-	messages = [
-		{"role": "system", "content": system_prompt},
-		{"role": "user", "content": user_prompt}
-	]
-
-	response = client.chat.completions.create(
-		model=model,
-		messages=messages,
-		temperature=0,
-	)
-	result = response.choices[0].message.content.strip()
+def get_aggregation_messages(patient: str, trial_results: dict, trial_info: dict, prompt_budget: PromptBudget = None) -> list:
+	"""The prompt messages, compacted to the token budget of prompt_budget if given."""
+	def render(**compaction):
+		system_prompt, user_prompt = convert_pred_to_prompt(
+				patient,
+				trial_results,
+				trial_info,
+				**compaction
+		)   
+
+		return [
+			{"role": "system", "content": system_prompt},
+			{"role": "user", "content": user_prompt}
+		]
+
+	if prompt_budget is None:
+		return render()
+
+	return prompt_budget.fit("aggregation", render, AGGREGATION_LEVELS)
+
+
+def is_aggregation_output(result: str) -> bool:
+	"""Whether an aggregation output is valid JSON, only those are cached."""
+	try:
+		json.loads(result.strip("`").strip("json"))
+		return True
+	except json.JSONDecodeError:
+		return False
+
+
+def parse_aggregation_output(result: str) -> dict:
 	result = result.strip("`").strip("json")
-	result = json.loads(result)
 
-	return result
+	try:
+		return json.loads(result)
+	except json.JSONDecodeError:
+		metrics.record_parse_failure("the aggregation output is not valid JSON")
+		raise
+
+
+def trialgpt_aggregation(patient: str, trial_results: dict, trial_info: dict, model: str, prompt_budget: PromptBudget = None):
+	messages = get_aggregation_messages(patient, trial_results, trial_info, prompt_budget)
+
+	with labels(stage="aggregation"):
+		result = client.chat(model, messages, validate=is_aggregation_output, temperature=0)
+
+		return parse_aggregation_output(result)
+
+
+async def trialgpt_aggregation_async(
+	patient: str,
+	trial_results: dict,
+	trial_info: dict,
+	model: str,
+	client: LLMClient,
+	prompt_budget: PromptBudget = None,
+):
+	"""Same as trialgpt_aggregation, through the asynchronous executor of the client."""
+	messages = get_aggregation_messages(patient, trial_results, trial_info, prompt_budget)
+
+	with labels(stage="aggregation"):
+		result = await client.achat(model, messages, validate=is_aggregation_output, temperature=0)
+
+		return parse_aggregation_output(result)
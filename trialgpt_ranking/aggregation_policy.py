@@ -0,0 +1,123 @@
+__author__ = "qiao"
+
+"""
+Early-exit policies for TrialGPT-Ranking: the matching scores are computed first, and the
+aggregation LLM call is only made for the trials whose final rank could still change.
+The offline evaluation replays a policy on existing matching and aggregation results.
+"""
+
+from beir.datasets.data_loader import GenericDataLoader
+import json
+import sys
+
+from rank_results import get_agg_score, get_matching_score, get_ndcg
+
+# the aggregation score (R + E) / 100 is within [0, 2]
+MAX_AGG_SCORE = 2.0
+
+SKIPPED = "skipped by early-exit policy"
+
+
+def get_trials_to_aggregate(trial2results: dict, policy: str) -> set:
+	"""
+	The trials of a patient that need the aggregation call, given Dict{Str(trial_id): matching results}.
+	policy is a comma-separated list of rules, each removing trials:
+		none: aggregate every trial
+		excluded: skip the trials with an "excluded" exclusion criterion (already penalized by -1)
+		window:K[:margin]: skip the trials that cannot enter the top K, i.e., whose matching score plus
+			margin (default: 2, the largest aggregation score, which makes the rule exact) is below the
+			K-th best matching score
+	"""
+	trial2score = {
+		trial_id: get_matching_score(results)
+		for trial_id, results in trial2results.items()
+		if type(results) is dict
+	}
+	keep = set(trial2score.keys())
+
+	for rule in policy.split(","):
+		name, *params = rule.split(":")
+
+		if name == "none":
+			continue
+
+		elif name == "excluded":
+			keep -= {
+				trial_id for trial_id in keep
+				if any(len(info) == 3 and info[2] == "excluded" for info in trial2results[trial_id]["exclusion"].values())
+			}
+
+		elif name == "window":
+			top_k = int(params[0])
+			margin = float(params[1]) if len(params) > 1 else MAX_AGG_SCORE
+			scores = sorted(trial2score.values(), reverse=True)
+
+			if len(scores) > top_k:
+				threshold = scores[top_k - 1]
+				keep -= {trial_id for trial_id in keep if trial2score[trial_id] + margin < threshold}
+
+		else:
+			raise ValueError(f"Unknown early-exit rule: {rule}")
+
+	return keep
+
+
+def rank_trials(trial2results: dict, trial2assessment: dict) -> list:
+	"""Trial ids by descending matching + aggregation score, a missing or skipped aggregation scores 0."""
+	trial2score = {}
+
+	for trial_id, results in trial2results.items():
+		if type(results) is not dict:
+			continue
+
+		trial2score[trial_id] = get_matching_score(results) + get_agg_score(trial2assessment.get(trial_id, {}))
+
+	return [trial_id for trial_id, _ in sorted(trial2score.items(), key=lambda x: -x[1])]
+
+
+if __name__ == "__main__":
+	# offline evaluation of early-exit policies on existing results
+	# syntax: python trialgpt_ranking/aggregation_policy.py ${corpus} ${matching_results_path} ${aggregation_results_path} ${policies}
+	# ${policies} is a space-separated list of policies, e.g., "none excluded window:10 window:10:1 excluded,window:10"
+	corpus = sys.argv[1]
+	matching_results = json.load(open(sys.argv[2]))
+	agg_results = json.load(open(sys.argv[3]))
+	policies = sys.argv[4].split() if len(sys.argv) > 4 else ["none", "excluded", "window:10", "window:10:1", "excluded,window:10:1"]
+
+	_, _, qrels = GenericDataLoader(data_folder=f"dataset/{corpus}/").load(split="test")
+
+	# the labels only group the trials
+	patient2trials = {
+		patient_id: {trial_id: results for trials in label2trials.values() for trial_id, results in trials.items()}
+		for patient_id, label2trials in matching_results.items()
+		if patient_id in qrels
+	}
+
+	full_ndcgs = {
+		patient_id: get_ndcg(rank_trials(trial2results, agg_results.get(patient_id, {})), qrels[patient_id])
+		for patient_id, trial2results in patient2trials.items()
+	}
+	full_ndcg = sum(full_ndcgs.values()) / max(len(full_ndcgs), 1)
+
+	print(f"{'policy':<28}{'calls':>8}{'saved':>9}{'NDCG@10':>10}{'change':>9}")
+
+	for policy in policies:
+		num_calls = 0
+		num_trials = 0
+		ndcgs = []
+
+		for patient_id, trial2results in patient2trials.items():
+			keep = get_trials_to_aggregate(trial2results, policy)
+			trial2assessment = {
+				trial_id: assessment for trial_id, assessment in agg_results.get(patient_id, {}).items()
+				if trial_id in keep
+			}
+
+			num_calls += len(keep)
+			num_trials += sum(type(results) is dict for results in trial2results.values())
+			ndcgs.append(get_ndcg(rank_trials(trial2results, trial2assessment), qrels[patient_id]))
+
+		ndcg = sum(ndcgs) / max(len(ndcgs), 1)
+		saved = 1 - num_calls / max(num_trials, 1)
+
+		print(f"{policy:<28}{num_calls:>8}{saved:>9.1%}{ndcg:>10.4f}{ndcg - full_ndcg:>+9.4f}")
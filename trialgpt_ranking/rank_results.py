@@ -5,6 +5,7 @@ Rank the trials given the matching and aggregation results
 """
 
 import json
+import math
 import sys
 
 eps = 1e-9
@@ -78,6 +79,16 @@ def get_agg_score(assessment):
 	return score 
 
 
+def get_ndcg(ranked_trials, qrel, cutoff=10):
+	"""NDCG@cutoff of a list of trial ids with the graded relevance of the qrels as gains."""
+	dcg = sum(qrel.get(trial_id, 0) / math.log2(rank + 2) for rank, trial_id in enumerate(ranked_trials[:cutoff]))
+
+	ideal = sorted(qrel.values(), reverse=True)[:cutoff]
+	idcg = sum(gain / math.log2(rank + 2) for rank, gain in enumerate(ideal))
+
+	return dcg / idcg if idcg > 0 else 0
+
+
 if __name__ == "__main__":
 	# args are the results paths
 	matching_results_path = sys.argv[1]
@@ -0,0 +1,261 @@
+__author__ = "qiao"
+
+"""
+Vectorized TrialGPT-Ranking: the matching and aggregation outputs are turned into columnar
+arrays once, the combined scores are computed in NumPy with configurable weights, and the
+top-K trials per patient are returned, exported to TSV/Parquet, or evaluated against the qrels.
+"""
+
+import csv
+import json
+import numpy as np
+import pandas as pd
+import sys
+
+from rank_results import eps, get_agg_score, get_matching_score, get_ndcg
+
+# the columns of the label counts
+INCLUSION_LABELS = ["included", "not included", "not applicable", "not enough information"]
+EXCLUSION_LABELS = ["excluded", "not excluded", "not applicable", "not enough information"]
+
+# the weights of rank_results.py
+DEFAULT_WEIGHTS = {
+	"inclusion": 1.0,
+	"not_included_penalty": 1.0,
+	"excluded_penalty": 1.0,
+	"aggregation": 1.0,
+}
+
+
+def is_parsed(results) -> bool:
+	"""Whether both criterion-level outputs parsed, the matching keeps the raw text otherwise."""
+	return type(results) is dict and type(results.get("inclusion")) is dict and type(results.get("exclusion")) is dict
+
+
+class RankingTable:
+	"""One row per (patient, trial) with a parsed matching result, the unparsed ones are skipped."""
+
+	def __init__(self, matching_results: dict, agg_results: dict = None):
+		agg_results = agg_results or {}
+
+		self.patient_ids = []
+		self.trial_ids = []
+		patient_inds = []
+		trial_inds = []
+		counts = []
+		relevance = []
+		eligibility = []
+
+		patient2idx = {}
+		trial2idx = {}
+
+		for patient_id, label2trial2results in matching_results.items():
+			patient_idx = patient2idx.setdefault(patient_id, len(patient2idx))
+
+			# a trial listed under several labels is scored once, with its last results as in rank_results.py
+			trial2results = {}
+			for trial2results_label in label2trial2results.values():
+				trial2results.update(trial2results_label)
+
+			for trial_id, results in trial2results.items():
+				if not is_parsed(results):
+					continue
+
+				row = np.zeros(8, dtype=np.int32)
+
+				for offset, inc_exc, labels in [(0, "inclusion", INCLUSION_LABELS), (4, "exclusion", EXCLUSION_LABELS)]:
+					for info in results[inc_exc].values():
+						if len(info) == 3 and info[2] in labels:
+							row[offset + labels.index(info[2])] += 1
+
+				try:
+					assessment = agg_results[patient_id][trial_id]
+					r, e = float(assessment["relevance_score_R"]), float(assessment["eligibility_score_E"])
+				except:
+					r, e = np.nan, np.nan
+
+				patient_inds.append(patient_idx)
+				trial_inds.append(trial2idx.setdefault(trial_id, len(trial2idx)))
+				counts.append(row)
+				relevance.append(r)
+				eligibility.append(e)
+
+		self.patient_ids = list(patient2idx.keys())
+		self.trial_ids = list(trial2idx.keys())
+		self.patient_idx = np.array(patient_inds, dtype=np.int32)
+		self.trial_idx = np.array(trial_inds, dtype=np.int32)
+		self.counts = np.array(counts, dtype=np.int32).reshape(-1, 8)
+		self.relevance = np.array(relevance, dtype=np.float64)
+		self.eligibility = np.array(eligibility, dtype=np.float64)
+
+
+	def get_matching_scores(self, weights: dict = DEFAULT_WEIGHTS) -> np.ndarray:
+		included, not_inc, _, no_info_inc = self.counts[:, :4].T
+		excluded = self.counts[:, 4]
+
+		scores = weights["inclusion"] * included / (included + not_inc + no_info_inc + eps)
+		scores -= weights["not_included_penalty"] * (not_inc > 0)
+		scores -= weights["excluded_penalty"] * (excluded > 0)
+
+		return scores
+
+
+	def get_agg_scores(self) -> np.ndarray:
+		"""(R + E) / 100, and 0 for the missing or unparseable aggregation results."""
+		return np.nan_to_num((self.relevance + self.eligibility) / 100, nan=0.0)
+
+
+	def get_scores(self, weights: dict = DEFAULT_WEIGHTS) -> np.ndarray:
+		return self.get_matching_scores(weights) + weights["aggregation"] * self.get_agg_scores()
+
+
+	def get_order(self, scores: np.ndarray) -> np.ndarray:
+		"""Row order by patient, then by descending score, ties kept in the input order."""
+		return np.lexsort((np.arange(len(scores)), -scores, self.patient_idx))
+
+
+	def get_ranks(self, scores: np.ndarray) -> np.ndarray:
+		"""0-based rank of each row within its patient."""
+		order = self.get_order(scores)
+		sorted_patients = self.patient_idx[order]
+		starts = np.searchsorted(sorted_patients, sorted_patients, side="left")
+
+		ranks = np.empty(len(scores), dtype=np.int64)
+		ranks[order] = np.arange(len(scores)) - starts
+
+		return ranks
+
+
+	def top_k(self, scores: np.ndarray, k: int = None) -> dict:
+		"""Dict{Str(patient_id): List[(Str(trial_id), Float(score))]} of the k best trials (all if None)."""
+		order = self.get_order(scores)
+		bounds = np.searchsorted(self.patient_idx[order], np.arange(len(self.patient_ids) + 1))
+		output = {}
+
+		for patient_idx, patient_id in enumerate(self.patient_ids):
+			rows = order[bounds[patient_idx] : bounds[patient_idx + 1]][:k]
+			output[patient_id] = [(self.trial_ids[trial_idx], float(score)) for trial_idx, score in zip(self.trial_idx[rows], scores[rows])]
+
+		return output
+
+
+	def to_frame(self, weights: dict = DEFAULT_WEIGHTS, k: int = None) -> pd.DataFrame:
+		matching_scores = self.get_matching_scores(weights)
+		agg_scores = self.get_agg_scores()
+		scores = matching_scores + weights["aggregation"] * agg_scores
+		ranks = self.get_ranks(scores)
+
+		df = pd.DataFrame({
+			"patient_id": np.array(self.patient_ids, dtype=object)[self.patient_idx],
+			"trial_id": np.array(self.trial_ids, dtype=object)[self.trial_idx],
+			"rank": ranks + 1,
+			"score": scores,
+			"matching_score": matching_scores,
+			"agg_score": agg_scores,
+		})
+		df = df.iloc[self.get_order(scores)]
+
+		if k is not None:
+			df = df[df["rank"] <= k]
+
+		return df.reset_index(drop=True)
+
+
+	def export(self, path: str, weights: dict = DEFAULT_WEIGHTS, k: int = None):
+		"""Write the ranking as .parquet (requires pyarrow or fastparquet) or .tsv."""
+		df = self.to_frame(weights, k)
+
+		if path.endswith(".parquet"):
+			df.to_parquet(path, index=False)
+		else:
+			df.to_csv(path, sep="\t", index=False)
+
+
+	def evaluate(self, scores: np.ndarray, qrels: dict, k: int = 10) -> dict:
+		"""
+		Mean NDCG@k and P@k over the patients in the qrels, as in trec_eval: the gains are the graded
+		qrels, the ideal ranking uses all judged trials, and P@k counts the trials with a grade > 0.
+		The NDCG is a vectorized rank_results.get_ndcg over the top_k rankings (tests/test_ranking_engine.py).
+		"""
+		ranks = self.get_ranks(scores)
+		patient_ids = np.array(self.patient_ids, dtype=object)[self.patient_idx]
+		trial_ids = np.array(self.trial_ids, dtype=object)[self.trial_idx]
+
+		gains = np.array([qrels.get(patient_id, {}).get(trial_id, 0) for patient_id, trial_id in zip(patient_ids, trial_ids)], dtype=np.float64)
+		in_top = ranks < k
+
+		dcg = np.bincount(self.patient_idx[in_top], weights=gains[in_top] / np.log2(ranks[in_top] + 2), minlength=len(self.patient_ids))
+		hits = np.bincount(self.patient_idx[in_top], weights=(gains[in_top] > 0).astype(np.float64), minlength=len(self.patient_ids))
+
+		discounts = 1 / np.log2(np.arange(k) + 2)
+		ndcgs = []
+		precisions = []
+
+		for patient_idx, patient_id in enumerate(self.patient_ids):
+			if patient_id not in qrels:
+				continue
+
+			ideal = np.sort(np.array(list(qrels[patient_id].values()), dtype=np.float64))[::-1][:k]
+			idcg = np.sum(ideal * discounts[: len(ideal)])
+
+			ndcgs.append(dcg[patient_idx] / idcg if idcg > 0 else 0.0)
+			precisions.append(hits[patient_idx] / k)
+
+		return {
+			f"ndcg@{k}": float(np.mean(ndcgs)) if ndcgs else 0.0,
+			f"p@{k}": float(np.mean(precisions)) if precisions else 0.0,
+			"num_patients": len(ndcgs),
+		}
+
+
+def load_qrels(corpus: str) -> dict:
+	"""Dict{Str(query_id): Dict{Str(trial_id): Int(score)}} from dataset/{corpus}/qrels/test.tsv."""
+	qrels = {}
+
+	with open(f"dataset/{corpus}/qrels/test.tsv", "r") as f:
+		reader = csv.reader(f, delimiter="\t")
+		next(reader)
+
+		for query_id, trial_id, score in reader:
+			qrels.setdefault(query_id, {})[trial_id] = int(score)
+
+	return qrels
+
+
+if __name__ == "__main__":
+	# syntax: python trialgpt_ranking/ranking_engine.py ${corpus} ${matching_results_path} ${aggregation_results_path} ${K} ${output_path}
+	# ${output_path} is optional, .parquet or .tsv
+	corpus = sys.argv[1]
+	matching_results = json.load(open(sys.argv[2]))
+	agg_results = json.load(open(sys.argv[3]))
+	k = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+	output_path = sys.argv[5] if len(sys.argv) > 5 else None
+
+	table = RankingTable(matching_results, agg_results)
+	scores = table.get_scores()
+
+	# parity with the per-trial scores of rank_results.py, in the same row order
+	reference = []
+	for patient_id, label2trial2results in matching_results.items():
+		trial2results = {}
+		for trial2results_label in label2trial2results.values():
+			trial2results.update(trial2results_label)
+
+		for trial_id, results in trial2results.items():
+			if not is_parsed(results):
+				continue
+
+			reference.append(get_matching_score(results) + get_agg_score(agg_results.get(patient_id, {}).get(trial_id, {})))
+
+	print(f"Max score difference with rank_results.py: {np.max(np.abs(scores - np.array(reference)), initial=0):.2e}")
+
+	qrels = load_qrels(corpus)
+	metrics = table.evaluate(scores, qrels, k=k)
+	print(metrics)
+
+	# parity with the NDCG of rank_results.py over the same rankings
+	ndcgs = [get_ndcg([trial_id for trial_id, _ in ranking], qrels[patient_id], k) for patient_id, ranking in table.top_k(scores).items() if patient_id in qrels]
+	print(f"NDCG@{k} difference with rank_results.py: {abs(metrics[f'ndcg@{k}'] - (np.mean(ndcgs) if ndcgs else 0.0)):.2e}")
+
+	if output_path:
+		table.export(output_path, k=k)
@@ -6,12 +6,15 @@ Using GPT to aggregate the scores by itself.
 
 from beir.datasets.data_loader import GenericDataLoader
 import json
-from nltk.tokenize import sent_tokenize
-import os
 import sys
-import time
 
-from TrialGPT import trialgpt_aggregation
+from TrialGPT import client, trialgpt_aggregation
+from aggregation_policy import SKIPPED, get_trials_to_aggregate
+from instrumentation import labels, metrics
+from patient_notes import PatientNotes
+from prompt_budget import PromptBudget
+from result_store import open_store
+from trial_store import TrialStore
 
 if __name__ == "__main__":
 	corpus = sys.argv[1] 
@@ -21,58 +24,77 @@ if __name__ == "__main__":
 	matching_results_path = sys.argv[3]
 	results = json.load(open(matching_results_path))
 
-	# loading the trial2info dict
-	trial2info = json.load(open("dataset/trial_info.json"))
+	# the early-exit policy, see aggregation_policy.py (default: none, aggregate every trial)
+	policy = sys.argv[4] if len(sys.argv) > 4 else "none"
+
+	# > 0 compacts the prompts over that many tokens, see trialgpt_utils/prompt_budget.py (default: 0, no limit)
+	max_prompt_tokens = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+	prompt_budget = PromptBudget(max_prompt_tokens) if max_prompt_tokens else None
+
+	# the trial information, only the trials that are aggregated are loaded
+	trial2info = TrialStore()
 	
 	# loading the patient info
 	_, queries, _ = GenericDataLoader(data_folder=f"dataset/{corpus}/").load(split="test")
+	patient_notes = PatientNotes()
 	
 	# output file path
 	output_path = f"results/aggregation_results_{corpus}_{model}.json"
 
-	if os.path.exists(output_path):
-		output = json.load(open(output_path))
-	else:
-		output = {}
+	if policy != "none":
+		output_path = output_path.replace(".json", f"_{policy.replace(':', '-').replace(',', '_')}.json")
+
+	if max_prompt_tokens:
+		output_path = output_path.replace(".json", f"_budget{max_prompt_tokens}.json")
+
+	# one record per (patient, trial), exported to Dict{Str(patient_id): Dict{Str(trial_id): output}}
+	store = open_store(output_path, "aggregation")
 
 	# patient-level
 	for patient_id, info in results.items():
 		# get the patient note
-		patient = queries[patient_id]
-		sents = sent_tokenize(patient)
-		sents.append("The patient will provide informed consent, and will comply with the trial protocol without any practical issues.")
-		sents = [f"{idx}. {sent}" for idx, sent in enumerate(sents)]
-		patient = "\n".join(sents)
-
-		if patient_id not in output:
-			output[patient_id] = {}
-		
+		patient = patient_notes.get(patient_id, queries[patient_id])
+
+		# the matching scores decide which trials still need the aggregation call
+		keep = get_trials_to_aggregate(
+			{trial_id: trial_results for trials in info.values() for trial_id, trial_results in trials.items()},
+			policy,
+		)
+
 		# label-level, 3 label / patient
 		for label, trials in info.items():
 				
 			# trial-level
 			for trial_id, trial_results in trials.items():
 				# already cached results
-				if trial_id in output[patient_id]:
+				if (patient_id, None, trial_id) in store:
 					continue
 
 				if type(trial_results) is not dict:
-					output[patient_id][trial_id] = "matching result error"
-
-					with open(output_path, "w") as f:
-						json.dump(output, f, indent=4)
+					store.put(patient_id, None, trial_id, "matching result error")
+					continue
 
+				if trial_id not in keep:
+					store.put(patient_id, None, trial_id, SKIPPED)
 					continue
 
 				# specific trial information
 				trial_info = trial2info[trial_id]	
 
 				try:
-					result = trialgpt_aggregation(patient, trial_results, trial_info, model)
-					output[patient_id][trial_id] = result 
+					with labels(patient_id=patient_id, trial_id=trial_id):
+						result = trialgpt_aggregation(patient, trial_results, trial_info, model, prompt_budget)
+					store.put(patient_id, None, trial_id, result)
 
-					with open(output_path, "w") as f:
-						json.dump(output, f, indent=4)
-
-				except:
+				# the API errors and the parse failures are recorded in the metrics
+				except Exception as e:
+					print(f"{patient_id} {trial_id}: {e}")
 					continue
+
+	store.close()
+	store.export(output_path)
+	print(client.stats())
+	if prompt_budget is not None:
+		print(prompt_budget.report(corpus))
+	print(metrics.report())
+	metrics.save(output_path.replace("aggregation_results_", "metrics_aggregation_"))
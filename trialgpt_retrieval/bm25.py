@@ -0,0 +1,591 @@
+__author__ = "qiao"
+
+"""
+Sparse-matrix BM25 (Okapi) index used by the hybrid retriever.
+
+The scoring follows rank_bm25.BM25Okapi exactly (same k1, b, epsilon and the
+same IDF flooring for negative values), but the corpus is stored as a
+vocabulary-by-document CSR matrix of term frequencies, so that all conditions
+of a patient are scored with one sparse matrix product.
+
+On disk, an index is a directory of .npy arrays that are opened with np.memmap:
+	meta.json	format version, BM25 parameters, the tokenizer and the fingerprint of the source corpus
+	vocab.json	List[Str(token)], the position is the term id
+	indptr.npy	CSR row pointers of the term postings
+	doc_ids.npy	int32 document ids of the term postings
+	tf.npy	int32 term frequencies of the term postings
+	doc_len.npy	int32 document lengths
+	idf.npy	float64 precomputed IDF of each term
+	deleted.npy	bool tombstones of withdrawn or replaced documents
+	nctids.json	List[Str(NCTID)], the position is the document id
+	hashes.json	List[Str(content hash)], aligned with nctids.json
+
+Documents can be appended and tombstoned without re-tokenizing the corpus (see
+update_index.py). Tombstoned documents are never returned and do not count in
+the BM25 statistics, until compact() drops them.
+"""
+
+from itertools import islice
+import json
+import multiprocessing
+from nltk import word_tokenize
+import numpy as np
+import os
+import re
+from scipy import sparse
+import shutil
+import sys
+import time
+
+from corpus_utils import get_entry_hash, is_fingerprint_valid
+
+# bump when the on-disk layout changes, older indices are then rebuilt
+FORMAT_VERSION = 2
+
+# a single-pass approximation of word_tokenize: abbreviations followed by a lowercase word (e.g.)
+# and words with inner hyphens, periods or slashes (covid-19, 2.5, and/or) are kept whole,
+# the clitics (n't, 's) and the other punctuation are split off
+TOKEN_PATTERN = re.compile(r"\w+(?:\.\w+)+\.(?=\s+[a-z0-9])|\w+(?=n't)|n't|\w+(?:[-./]\w+)*|'\w*|\.\.\.|[^\w\s]")
+
+
+def regex_tokenize(text: str) -> list:
+	return TOKEN_PATTERN.findall(text)
+
+
+# Dict{Str(name): Callable[Str(text), List[Str(token)]]}, the name is recorded in the index meta
+TOKENIZERS = {
+	"nltk": word_tokenize,
+	"regex": regex_tokenize,
+}
+
+
+def tokenize_trial(entry: dict, tokenizer: str = "nltk") -> list:
+	"""Tokenize a corpus.jsonl entry for BM25."""
+	tokenize = TOKENIZERS[tokenizer]
+
+	# weighting: 3 * title, 2 * condition, 1 * text
+	tokens = tokenize(entry["title"].lower()) * 3
+	for disease in entry["metadata"]["diseases_list"]:
+		tokens += tokenize(disease.lower()) * 2
+	tokens += tokenize(entry["text"].lower())
+
+	return tokens
+
+
+def tokenize_chunk(args: tuple) -> list:
+	"""List[(Str(NCTID), Str(content hash), List[Str(token)])] of a chunk of corpus.jsonl lines."""
+	lines, tokenizer = args
+	outputs = []
+
+	for line in lines:
+		entry = json.loads(line)
+		outputs.append((entry["_id"], get_entry_hash(entry), tokenize_trial(entry, tokenizer)))
+
+	return outputs
+
+
+def tokenize_corpus(source_path: str, tokenizer: str = "nltk", num_workers: int = 1, chunk_size: int = 256) -> tuple:
+	"""
+	Read corpus.jsonl in chunks of lines and tokenize them with a process pool.
+	At most 4 chunks per worker are read ahead, and the outputs keep the file order.
+	Returns (tokenized_corpus, nctids, hashes).
+	"""
+	tokenized_corpus = []
+	nctids = []
+	hashes = []
+
+	def add(outputs):
+		for nctid, entry_hash, tokens in outputs:
+			nctids.append(nctid)
+			hashes.append(entry_hash)
+			tokenized_corpus.append(tokens)
+
+	with open(source_path, "r") as f:
+		chunks = iter(lambda: (list(islice(f, chunk_size)), tokenizer), ([], tokenizer))
+
+		if num_workers <= 1:
+			for chunk in chunks:
+				add(tokenize_chunk(chunk))
+
+		else:
+			with multiprocessing.Pool(num_workers) as pool:
+				while True:
+					group = list(islice(chunks, 4 * num_workers))
+
+					if not group:
+						break
+
+					for outputs in pool.map(tokenize_chunk, group):
+						add(outputs)
+
+	return tokenized_corpus, nctids, hashes
+
+
+class BM25Index:
+	def __init__(
+		self,
+		vocab: dict,
+		tf: sparse.csr_matrix,
+		k1: float = 1.5,
+		b: float = 0.75,
+		epsilon: float = 0.25,
+		doc_len: np.ndarray = None,
+		idf: np.ndarray = None,
+		deleted: np.ndarray = None,
+		tokenizer: str = "nltk",
+	):
+		"""
+		vocab: Dict{Str(token): Int(term_id)}
+		tf: CSR matrix of shape (len(vocab), num_docs) holding the term frequencies
+		doc_len and idf are derived from tf unless given (e.g., loaded from disk)
+		deleted: optional bool mask of tombstoned documents
+		tokenizer: the name in TOKENIZERS the documents were tokenized with, the queries must use the same
+		"""
+		self.vocab = vocab
+		self.tokenizer = tokenizer
+		self.tf = tf
+		self.k1 = k1
+		self.b = b
+		self.epsilon = epsilon
+		self.num_docs = tf.shape[1]
+
+		if deleted is None:
+			deleted = np.zeros(self.num_docs, dtype=bool)
+		self.deleted = deleted
+		self.has_deleted = bool(np.any(deleted))
+
+		# the BM25 statistics only count the live documents
+		self.corpus_size = self.num_docs - int(np.count_nonzero(deleted))
+
+		if doc_len is None:
+			doc_len = np.asarray(tf.sum(axis=0)).ravel()
+		self.doc_len = doc_len
+
+		if self.has_deleted:
+			self.avgdl = float(np.sum(doc_len[~deleted], dtype=np.float64)) / max(self.corpus_size, 1)
+		else:
+			self.avgdl = float(np.sum(doc_len, dtype=np.float64)) / max(self.corpus_size, 1)
+
+		if idf is None:
+			idf = self.compute_idf(self.get_doc_freqs(), self.corpus_size, epsilon)
+		self.idf = idf
+
+		# the document-length normalization of BM25, shared by all terms
+		self.doc_norm = k1 * (1 - b + b * np.asarray(doc_len, dtype=np.float64) / self.avgdl)
+
+
+	def get_doc_freqs(self) -> np.ndarray:
+		"""Number of live documents containing each term."""
+		if not self.has_deleted:
+			return np.diff(self.tf.indptr)
+
+		rows = np.repeat(np.arange(self.tf.shape[0]), np.diff(self.tf.indptr))
+		live = ~self.deleted[self.tf.indices]
+
+		return np.bincount(rows[live], minlength=self.tf.shape[0])
+
+
+	@staticmethod
+	def compute_idf(doc_freqs: np.ndarray, corpus_size: int, epsilon: float) -> np.ndarray:
+		"""Okapi IDF with negative values floored to epsilon * average IDF, as in rank_bm25."""
+		doc_freqs = np.asarray(doc_freqs, dtype=np.float64)
+		idf = np.log(corpus_size - doc_freqs + 0.5) - np.log(doc_freqs + 0.5)
+
+		# terms that only occur in tombstoned documents are not part of the vocabulary of rank_bm25
+		in_vocab = doc_freqs > 0
+
+		if np.any(in_vocab):
+			idf[(idf < 0) & in_vocab] = epsilon * idf[in_vocab].mean()
+
+		return idf
+
+
+	@staticmethod
+	def count_terms(tokenized_corpus: list, vocab: dict) -> sparse.csr_matrix:
+		"""Term frequency matrix of tokenized documents, new tokens are added to vocab in place."""
+		term_ids = []
+		doc_ids = []
+
+		for doc_idx, tokens in enumerate(tokenized_corpus):
+			term_ids.append(np.fromiter(
+				(vocab.setdefault(token, len(vocab)) for token in tokens),
+				dtype=np.int32,
+				count=len(tokens),
+			))
+			doc_ids.append(np.full(len(tokens), doc_idx, dtype=np.int32))
+
+		term_ids = np.concatenate(term_ids) if term_ids else np.zeros(0, dtype=np.int32)
+		doc_ids = np.concatenate(doc_ids) if doc_ids else np.zeros(0, dtype=np.int32)
+
+		# duplicated (term, doc) pairs are summed into term frequencies
+		return sparse.coo_matrix(
+			(np.ones(len(term_ids), dtype=np.int32), (term_ids, doc_ids)),
+			shape=(len(vocab), len(tokenized_corpus)),
+		).tocsr()
+
+
+	@classmethod
+	def from_tokenized_corpus(cls, tokenized_corpus: list, **kwargs):
+		"""Build the index from a List[List[Str(token)]]."""
+		vocab = {}
+		tf = cls.count_terms(tokenized_corpus, vocab)
+
+		return cls(vocab, tf, **kwargs)
+
+
+	def add_documents(self, tokenized_corpus: list, deleted_docs=()):
+		"""
+		Return a new index with the tokenized documents appended after the existing ones
+		and the document ids in deleted_docs tombstoned. Only the new documents are counted,
+		the statistics of the existing ones are reused.
+		"""
+		vocab = dict(self.vocab)
+		new_tf = self.count_terms(tokenized_corpus, vocab)
+
+		# the existing rows gain no postings for the new terms
+		old_tf = self.tf
+		indptr = np.concatenate([old_tf.indptr, np.full(len(vocab) - old_tf.shape[0], old_tf.indptr[-1])])
+		old_tf = sparse.csr_matrix((old_tf.data, old_tf.indices, indptr), shape=(len(vocab), self.num_docs))
+
+		tf = sparse.hstack([old_tf, new_tf], format="csr")
+
+		deleted = np.concatenate([np.asarray(self.deleted), np.zeros(len(tokenized_corpus), dtype=bool)])
+		deleted[list(deleted_docs)] = True
+
+		doc_len = np.concatenate([np.asarray(self.doc_len), np.asarray(new_tf.sum(axis=0)).ravel()])
+
+		return BM25Index(vocab, tf, k1=self.k1, b=self.b, epsilon=self.epsilon, doc_len=doc_len, deleted=deleted, tokenizer=self.tokenizer)
+
+
+	def compact(self):
+		"""Return (index, keep), a new index without the tombstoned documents and unused terms,
+		where keep is the bool mask of the kept document ids."""
+		keep = ~np.asarray(self.deleted)
+		tf = self.tf[:, np.where(keep)[0]].tocsr()
+
+		used_terms = np.diff(tf.indptr) > 0
+		tf = tf[np.where(used_terms)[0]]
+
+		tokens = [None] * len(self.vocab)
+		for token, term_id in self.vocab.items():
+			tokens[term_id] = token
+
+		tokens = [token for token, used in zip(tokens, used_terms) if used]
+		vocab = {token: term_id for term_id, token in enumerate(tokens)}
+
+		index = BM25Index(vocab, tf, k1=self.k1, b=self.b, epsilon=self.epsilon, doc_len=np.asarray(self.doc_len)[keep], tokenizer=self.tokenizer)
+
+		return index, keep
+
+
+	def save(self, index_dir: str, nctids: list, hashes: list, source_fingerprint: dict):
+		"""Write the index to index_dir, replacing any previous version atomically."""
+		tmp_dir = f"{index_dir}.tmp{os.getpid()}"
+		os.makedirs(tmp_dir, exist_ok=True)
+
+		# int32 row pointers keep the memory-mapped arrays usable by scipy without copies
+		index_dtype = np.int32 if self.tf.nnz < np.iinfo(np.int32).max else np.int64
+
+		np.save(os.path.join(tmp_dir, "indptr.npy"), self.tf.indptr.astype(index_dtype))
+		np.save(os.path.join(tmp_dir, "doc_ids.npy"), self.tf.indices.astype(index_dtype))
+		np.save(os.path.join(tmp_dir, "tf.npy"), self.tf.data.astype(np.int32))
+		np.save(os.path.join(tmp_dir, "doc_len.npy"), np.asarray(self.doc_len, dtype=np.int32))
+		np.save(os.path.join(tmp_dir, "idf.npy"), np.asarray(self.idf, dtype=np.float64))
+		np.save(os.path.join(tmp_dir, "deleted.npy"), np.asarray(self.deleted, dtype=bool))
+
+		vocab = [None] * len(self.vocab)
+		for token, term_id in self.vocab.items():
+			vocab[term_id] = token
+
+		with open(os.path.join(tmp_dir, "vocab.json"), "w") as f:
+			json.dump(vocab, f)
+
+		with open(os.path.join(tmp_dir, "nctids.json"), "w") as f:
+			json.dump(nctids, f)
+
+		with open(os.path.join(tmp_dir, "hashes.json"), "w") as f:
+			json.dump(hashes, f)
+
+		meta = {
+			"format_version": FORMAT_VERSION,
+			"k1": self.k1,
+			"b": self.b,
+			"epsilon": self.epsilon,
+			"tokenizer": self.tokenizer,
+			"num_terms": self.tf.shape[0],
+			"num_docs": self.tf.shape[1],
+			"source": source_fingerprint,
+		}
+
+		# meta.json is written last and marks a complete index
+		with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+			json.dump(meta, f, indent=4)
+
+		if os.path.exists(index_dir):
+			shutil.rmtree(index_dir)
+		os.replace(tmp_dir, index_dir)
+
+
+	@classmethod
+	def load(cls, index_dir: str):
+		"""Memory-map an index written by save, returns (index, nctids)."""
+		meta = json.load(open(os.path.join(index_dir, "meta.json")))
+
+		def load_array(name):
+			return np.load(os.path.join(index_dir, name), mmap_mode="r")
+
+		tf = sparse.csr_matrix(
+			(load_array("tf.npy"), load_array("doc_ids.npy"), load_array("indptr.npy")),
+			shape=(meta["num_terms"], meta["num_docs"]),
+			copy=False,
+		)
+
+		vocab = json.load(open(os.path.join(index_dir, "vocab.json")))
+		vocab = {token: term_id for term_id, token in enumerate(vocab)}
+		nctids = json.load(open(os.path.join(index_dir, "nctids.json")))
+
+		index = cls(
+			vocab,
+			tf,
+			k1=meta["k1"],
+			b=meta["b"],
+			epsilon=meta["epsilon"],
+			doc_len=load_array("doc_len.npy"),
+			idf=load_array("idf.npy"),
+			deleted=load_array("deleted.npy"),
+			tokenizer=meta.get("tokenizer", "nltk"),
+		)
+
+		return index, nctids
+
+
+	@staticmethod
+	def load_hashes(index_dir: str) -> list:
+		"""The content hashes of the documents, aligned with the NCT IDs."""
+		return json.load(open(os.path.join(index_dir, "hashes.json")))
+
+
+	@staticmethod
+	def exists(index_dir: str, tokenizer: str = None) -> bool:
+		"""Whether index_dir holds a complete index of the current format (and of the tokenizer, if given)."""
+		meta_path = os.path.join(index_dir, "meta.json")
+
+		if not os.path.exists(meta_path):
+			return False
+
+		meta = json.load(open(meta_path))
+
+		# the indices built before the tokenizer was recorded used word_tokenize
+		if tokenizer is not None and meta.get("tokenizer", "nltk") != tokenizer:
+			return False
+
+		return meta.get("format_version") == FORMAT_VERSION
+
+
+	@staticmethod
+	def is_cached(index_dir: str, source_path: str, tokenizer: str = None) -> bool:
+		"""Whether index_dir holds a complete index of the current format built from source_path."""
+		if not BM25Index.exists(index_dir, tokenizer):
+			return False
+
+		meta = json.load(open(os.path.join(index_dir, "meta.json")))
+
+		return is_fingerprint_valid(meta.get("source"), source_path)
+
+
+	def get_query_matrix(self, queries: list) -> sparse.csr_matrix:
+		"""Convert a list of tokenized queries to a (num_queries, vocab) count matrix."""
+		rows = []
+		cols = []
+
+		for query_idx, tokens in enumerate(queries):
+			for token in tokens:
+				# out-of-vocabulary tokens have zero contributions
+				if token in self.vocab:
+					rows.append(query_idx)
+					cols.append(self.vocab[token])
+
+		return sparse.csr_matrix(
+			(np.ones(len(rows), dtype=np.float64), (rows, cols)),
+			shape=(len(queries), len(self.vocab)),
+		)
+
+
+	def get_weights(self, term_ids: np.ndarray) -> sparse.csr_matrix:
+		"""The BM25 term-document weights for the given rows of the vocabulary."""
+		sub_tf = self.tf[term_ids]
+		tf = sub_tf.data.astype(np.float64)
+		rows = np.repeat(np.arange(len(term_ids)), np.diff(sub_tf.indptr))
+
+		data = self.idf[term_ids][rows] * (tf * (self.k1 + 1) / (tf + self.doc_norm[sub_tf.indices]))
+
+		return sparse.csr_matrix((data, sub_tf.indices, sub_tf.indptr), shape=sub_tf.shape)
+
+
+	def get_scores(self, queries: list) -> np.ndarray:
+		"""Score all documents for a batch of tokenized queries, returns (num_queries, num_docs)."""
+		query_matrix = self.get_query_matrix(queries)
+
+		# only the vocabulary rows used by the queries are touched
+		term_ids = np.unique(query_matrix.indices)
+		query_matrix = query_matrix[:, term_ids]
+
+		scores = query_matrix @ self.get_weights(term_ids)
+
+		return scores.toarray()
+
+
+	def search(self, queries: list, n: int):
+		"""
+		Top-n search for a batch of tokenized queries.
+		Returns (scores, inds), both of shape (num_queries, min(n, corpus_size)), ranked by
+		descending score with ties broken by the document index.
+		"""
+		scores = self.get_scores(queries)
+		n = min(n, self.corpus_size)
+
+		if self.has_deleted:
+			scores[:, self.deleted] = -np.inf
+
+		if n < self.num_docs:
+			# the n-th highest score of each query, the documents tied with it are taken by index
+			thresholds = -np.partition(-scores, n - 1, axis=1)[:, n - 1]
+			top_inds = []
+
+			for query_scores, threshold in zip(scores, thresholds):
+				above = np.flatnonzero(query_scores > threshold)
+				tied = np.flatnonzero(query_scores == threshold)[: n - len(above)]
+				top_inds.append(np.concatenate([above, tied]))
+
+			top_inds = np.array(top_inds, dtype=np.int64).reshape(len(queries), n)
+		else:
+			top_inds = np.tile(np.arange(self.num_docs), (len(queries), 1))
+
+		top_scores = np.take_along_axis(scores, top_inds, axis=1)
+
+		# lexsort uses the last key as the primary one
+		order = np.lexsort((top_inds, -top_scores), axis=1)
+		top_inds = np.take_along_axis(top_inds, order, axis=1)
+		top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+		return top_scores, top_inds
+
+
+	def get_top_n(self, query: list, documents: list, n: int = 5) -> list:
+		"""Drop-in equivalent of rank_bm25's get_top_n for a single tokenized query."""
+		assert self.num_docs == len(documents)
+		_, inds = self.search([query], n)
+
+		return [documents[ind] for ind in inds[0]]
+
+
+def check_parity(tokenized_corpus: list, queries: list, n: int) -> int:
+	"""
+	Compare BM25Index against rank_bm25.BM25Okapi for the given queries.
+	The two rankings must have the same scores at every rank and contain the same documents
+	above the score of the n-th one (documents tied at the cut-off can be ordered differently).
+	Returns the number of queries that do not match.
+	"""
+	from rank_bm25 import BM25Okapi
+
+	reference = BM25Okapi(tokenized_corpus)
+	index = BM25Index.from_tokenized_corpus(tokenized_corpus)
+	top_scores, top_inds = index.search(queries, n)
+
+	mismatches = 0
+
+	for query, scores, inds in zip(queries, top_scores, top_inds):
+		ref_scores = reference.get_scores(query)
+		ref_inds = np.argsort(ref_scores)[::-1][:n]
+
+		same_scores = np.allclose(scores, ref_scores[ref_inds]) and np.allclose(ref_scores[inds], scores)
+		same_docs = set(inds[scores > scores[-1] + 1e-9]) == set(ref_inds[ref_scores[ref_inds] > scores[-1] + 1e-9])
+
+		if not (same_scores and same_docs):
+			mismatches += 1
+			print(f"Mismatched query: {query}")
+
+	return mismatches
+
+
+def check_tokenizer_parity(reference: list, tokenized_corpus: list, reference_queries: list, queries: list, n: int) -> dict:
+	"""
+	Compare a tokenization of the corpus and of the queries with a reference one (word_tokenize):
+	the share of documents with the same tokens, the share of the reference tokens that are kept
+	(as multisets), and the mean overlap of the top-n BM25 documents of the two indices.
+	"""
+	same_docs = 0
+	kept_tokens = 0
+	num_tokens = 0
+
+	for ref_tokens, tokens in zip(reference, tokenized_corpus):
+		same_docs += ref_tokens == tokens
+
+		counts = {}
+		for token in tokens:
+			counts[token] = counts.get(token, 0) + 1
+
+		for token in ref_tokens:
+			if counts.get(token, 0) > 0:
+				counts[token] -= 1
+				kept_tokens += 1
+
+		num_tokens += len(ref_tokens)
+
+	_, ref_inds = BM25Index.from_tokenized_corpus(reference).search(reference_queries, n)
+	_, inds = BM25Index.from_tokenized_corpus(tokenized_corpus).search(queries, n)
+	overlaps = [len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(ref_inds, inds)]
+
+	return {
+		"same_documents": same_docs / max(len(reference), 1),
+		"token_agreement": kept_tokens / max(num_tokens, 1),
+		f"top{n}_overlap": float(np.mean(overlaps)) if overlaps else 1.0,
+	}
+
+
+if __name__ == "__main__":
+	# checks the rankings against rank_bm25 for all conditions of a cohort, and a faster tokenizer against word_tokenize
+	# syntax: python trialgpt_retrieval/bm25.py ${corpus} ${q_type} ${N} ${tokenizer} ${num_workers}
+	# ${tokenizer} is a name in TOKENIZERS (default: nltk, which only runs the rank_bm25 check)
+	corpus = sys.argv[1]
+	q_type = sys.argv[2]
+	N = int(sys.argv[3])
+	tokenizer = sys.argv[4] if len(sys.argv) > 4 else "nltk"
+	num_workers = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+
+	source_path = f"dataset/{corpus}/corpus.jsonl"
+
+	start_time = time.time()
+	tokenized_corpus, _, _ = tokenize_corpus(source_path, "nltk", num_workers)
+	print(f"Tokenized the corpus with nltk in {time.time() - start_time:.1f}s ({num_workers} workers)")
+
+	id2queries = json.load(open(f"dataset/{corpus}/id2queries.json"))
+	conditions = []
+
+	for qid, q_type2queries in id2queries.items():
+		if q_type not in q_type2queries:
+			continue
+
+		q_conditions = q_type2queries[q_type]
+
+		if type(q_conditions) is str:
+			q_conditions = [q_conditions]
+		elif type(q_conditions) is dict:
+			q_conditions = q_conditions["conditions"]
+
+		conditions += q_conditions
+
+	queries = [word_tokenize(condition.lower()) for condition in conditions]
+
+	mismatches = check_parity(tokenized_corpus, queries, N)
+	print(f"{len(queries) - mismatches} / {len(queries)} queries have the same top-{N} rankings as rank_bm25.")
+
+	if tokenizer != "nltk":
+		start_time = time.time()
+		fast_corpus, _, _ = tokenize_corpus(source_path, tokenizer, num_workers)
+		print(f"Tokenized the corpus with {tokenizer} in {time.time() - start_time:.1f}s ({num_workers} workers)")
+
+		fast_queries = [TOKENIZERS[tokenizer](condition.lower()) for condition in conditions]
+		print(f"Parity of {tokenizer} with nltk: {check_tokenizer_parity(tokenized_corpus, fast_corpus, queries, fast_queries, N)}")
+
+	sys.exit(1 if mismatches else 0)
@@ -0,0 +1,104 @@
+__author__ = "qiao"
+
+"""
+Helpers for tracking the trial corpus files that the retrieval indices are built from.
+"""
+
+import hashlib
+import json
+import os
+
+
+def get_file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+	"""SHA-256 of a file, read in chunks."""
+	sha = hashlib.sha256()
+
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(chunk_size), b""):
+			sha.update(chunk)
+
+	return sha.hexdigest()
+
+
+def get_file_fingerprint(path: str) -> dict:
+	"""Size, mtime and content hash of a file."""
+	stat = os.stat(path)
+
+	return {
+		"size": stat.st_size,
+		"mtime": stat.st_mtime,
+		"sha256": get_file_hash(path),
+	}
+
+
+def get_file_stamp(path: str) -> str:
+	"""A cheap version string of a file from its size and mtime."""
+	if not os.path.exists(path):
+		return "missing"
+
+	stat = os.stat(path)
+
+	return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def is_fingerprint_valid(fingerprint: dict, path: str) -> bool:
+	"""
+	Whether the file still matches a fingerprint from get_file_fingerprint.
+	The hash is only computed when the size is the same but the mtime differs,
+	so that an untouched file is validated with a single stat call.
+	"""
+	if not fingerprint or not os.path.exists(path):
+		return False
+
+	stat = os.stat(path)
+
+	if stat.st_size != fingerprint["size"]:
+		return False
+
+	if stat.st_mtime == fingerprint["mtime"]:
+		return True
+
+	return get_file_hash(path) == fingerprint["sha256"]
+
+
+def get_entry_hash(entry: dict) -> str:
+	"""Content hash of a corpus.jsonl entry, independent of the key order."""
+	return hashlib.sha1(json.dumps(entry, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def diff_corpus(source_path: str, nctids: list, hashes: list, deleted: list):
+	"""
+	Compare the corpus file with the documents of a cached index.
+	nctids, hashes and deleted are aligned with the document ids of the index.
+	Returns (new_entries, stale_docs):
+		new_entries: List[Dict], the corpus entries that are new or whose content changed
+		stale_docs: List[Int], the live document ids that are changed or withdrawn
+	"""
+	nctid2doc = {
+		nctid: doc_idx for doc_idx, nctid in enumerate(nctids) if not deleted[doc_idx]
+	}
+
+	new_entries = []
+	stale_docs = []
+	seen = set()
+
+	with open(source_path, "r") as f:
+		for line in f:
+			entry = json.loads(line)
+			nctid = entry["_id"]
+			seen.add(nctid)
+
+			doc_idx = nctid2doc.get(nctid)
+
+			if doc_idx is not None and hashes[doc_idx] == get_entry_hash(entry):
+				continue
+
+			if doc_idx is not None:
+				stale_docs.append(doc_idx)
+
+			new_entries.append(entry)
+
+	# withdrawn trials
+	stale_docs += [doc_idx for nctid, doc_idx in nctid2doc.items() if nctid not in seen]
+
+	return new_entries, sorted(stale_docs)
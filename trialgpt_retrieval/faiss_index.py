@@ -0,0 +1,200 @@
+__author__ = "qiao"
+
+"""
+Configurable FAISS indices for the MedCPT retriever, with an on-disk cache
+and a recall report against the exact flat index.
+"""
+
+from beir.datasets.data_loader import GenericDataLoader
+import faiss
+import json
+import numpy as np
+import os
+import sys
+import time
+
+from corpus_utils import get_file_fingerprint, is_fingerprint_valid
+from update_index import get_medcpt_paths
+
+# the search-time knob of each index type
+SEARCH_PARAMS = {
+	"flat": None,
+	"hnsw": "efSearch",
+	"ivf_flat": "nprobe",
+	"ivf_pq": "nprobe",
+	"opq_ivf_pq": "nprobe",
+}
+
+
+def get_factory_string(index_type: str, num_docs: int, nlist: int = None, pq_m: int = 64, hnsw_m: int = 32) -> str:
+	"""
+	The faiss.index_factory description of an index type.
+	nlist defaults to 4 * sqrt(num_docs) inverted lists, pq_m is the number of PQ sub-quantizers
+	(768 must be divisible by it), and hnsw_m is the number of HNSW neighbors per node.
+	"""
+	if nlist is None:
+		nlist = max(1, int(4 * np.sqrt(num_docs)))
+
+	if index_type == "flat":
+		return "Flat"
+	elif index_type == "hnsw":
+		return f"HNSW{hnsw_m}"
+	elif index_type == "ivf_flat":
+		return f"IVF{nlist},Flat"
+	elif index_type == "ivf_pq":
+		return f"IVF{nlist},PQ{pq_m}"
+	elif index_type == "opq_ivf_pq":
+		return f"OPQ{pq_m},IVF{nlist},PQ{pq_m}"
+
+	raise ValueError(f"Unknown index type: {index_type}")
+
+
+def build_faiss_index(embeds: np.ndarray, factory_string: str, ids: np.ndarray = None, max_train_size: int = 100000):
+	"""Train (if needed) and fill an inner-product index, the returned ids are the row ids of embeds."""
+	if ids is None:
+		ids = np.arange(len(embeds))
+
+	ids = np.asarray(ids, dtype=np.int64)
+	index = faiss.index_factory(embeds.shape[1], f"IDMap,{factory_string}", faiss.METRIC_INNER_PRODUCT)
+
+	if not index.is_trained:
+		rng = np.random.default_rng(0)
+		train_ids = ids if len(ids) <= max_train_size else rng.choice(ids, max_train_size, replace=False)
+		index.train(np.ascontiguousarray(embeds[np.sort(train_ids)], dtype=np.float32))
+
+	# add in chunks to bound the float32 copies of a memory-mapped matrix
+	for start in range(0, len(ids), 65536):
+		chunk = ids[start : start + 65536]
+		index.add_with_ids(np.ascontiguousarray(embeds[chunk], dtype=np.float32), chunk)
+
+	return index
+
+
+def set_search_param(index, index_type: str, value: int):
+	"""Set nprobe (IVF) or efSearch (HNSW) on a built index."""
+	name = SEARCH_PARAMS[index_type]
+
+	if name is not None and value is not None:
+		faiss.ParameterSpace().set_index_parameter(index, name, value)
+
+
+def get_faiss_index(corpus: str, embeds: np.ndarray, deleted: np.ndarray, index_type: str, **factory_kwargs):
+	"""
+	Load the cached ANN index of a corpus, or build and cache it with faiss.write_index.
+	The cache is invalidated when the corpus embeddings or their tombstones change.
+	"""
+	paths = get_medcpt_paths(corpus)
+	factory_string = get_factory_string(index_type, int(np.count_nonzero(~deleted)), **factory_kwargs)
+	index_key = factory_string.replace(",", "_")
+
+	index_path = f"trialgpt_retrieval/{corpus}_{index_key}.faiss"
+	meta_path = f"trialgpt_retrieval/{corpus}_{index_key}.json"
+
+	source_paths = [paths["embeds"]] + ([paths["deleted"]] if os.path.exists(paths["deleted"]) else [])
+
+	if os.path.exists(index_path) and os.path.exists(meta_path):
+		meta = json.load(open(meta_path))
+
+		if len(meta["sources"]) == len(source_paths) and all(
+			is_fingerprint_valid(fingerprint, path) for fingerprint, path in zip(meta["sources"], source_paths)
+		):
+			return faiss.read_index(index_path)
+
+	sources = [get_file_fingerprint(path) for path in source_paths]
+
+	print(f"Building the {factory_string} index")
+	start_time = time.time()
+	index = build_faiss_index(embeds, factory_string, ids=np.where(~deleted)[0])
+	print(f"Built in {time.time() - start_time:.1f}s")
+
+	faiss.write_index(index, index_path)
+	with open(meta_path, "w") as f:
+		json.dump({"factory_string": factory_string, "sources": sources}, f, indent=4)
+
+	return index
+
+
+def get_condition_recalls(top_inds: list, nctids: list, relevant: set) -> float:
+	"""Share of the relevant trials found in the union of the per-condition results."""
+	found = set(nctids[ind] for inds in top_inds for ind in inds if ind >= 0)
+
+	return len(found & relevant) / len(relevant)
+
+
+if __name__ == "__main__":
+	# recall@N of an ANN index against the exact flat index for different search-time settings
+	# syntax: python trialgpt_retrieval/faiss_index.py ${corpus} ${q_type} ${index_type} ${N} ${search_params}
+	# ${index_type} can be hnsw, ivf_flat, ivf_pq, and opq_ivf_pq
+	# ${search_params} is a comma-separated list of nprobe (IVF) or efSearch (HNSW) values
+	from medcpt_encoder import encode_queries, get_device, load_query_encoder
+
+	corpus = sys.argv[1]
+	q_type = sys.argv[2]
+	index_type = sys.argv[3]
+	N = int(sys.argv[4])
+	search_params = [int(value) for value in sys.argv[5].split(",")]
+
+	paths = get_medcpt_paths(corpus)
+	embeds = np.load(paths["embeds"], mmap_mode="r")
+	nctids = json.load(open(paths["nctids"]))
+	deleted = np.load(paths["deleted"]) if os.path.exists(paths["deleted"]) else np.zeros(len(nctids), dtype=bool)
+
+	_, _, qrels = GenericDataLoader(data_folder=f"dataset/{corpus}/").load(split="test")
+	id2queries = json.load(open(f"dataset/{corpus}/id2queries.json"))
+
+	device = get_device()
+	model, tokenizer = load_query_encoder(device)
+
+	# the query embeddings are computed once and shared by all settings
+	qid2embeds = {}
+	for qid, q_type2queries in id2queries.items():
+		if qid not in qrels or sum(qrels[qid].values()) == 0 or q_type not in q_type2queries:
+			continue
+
+		conditions = q_type2queries[q_type]
+
+		if type(conditions) is str:
+			conditions = [conditions]
+		elif type(conditions) is dict:
+			conditions = conditions["conditions"]
+
+		if len(conditions) > 0:
+			qid2embeds[qid] = encode_queries(conditions, model, tokenizer, device)
+
+	def evaluate(index):
+		"""Returns (qid2inds, seconds per condition)."""
+		qid2inds = {}
+		num_conditions = 0
+		start_time = time.time()
+
+		for qid, query_embeds in qid2embeds.items():
+			_, qid2inds[qid] = index.search(query_embeds, N)
+			num_conditions += len(query_embeds)
+
+		return qid2inds, (time.time() - start_time) / max(num_conditions, 1)
+
+	exact_index = build_faiss_index(embeds, "Flat", ids=np.where(~deleted)[0])
+	exact_inds, exact_latency = evaluate(exact_index)
+
+	relevant = {qid: set(nctid for nctid, score in qrels[qid].items() if score > 0) for qid in qid2embeds}
+	exact_recall = np.mean([get_condition_recalls(exact_inds[qid], nctids, relevant[qid]) for qid in qid2embeds])
+
+	ann_index = get_faiss_index(corpus, embeds, deleted, index_type)
+	ann_factory_string = get_factory_string(index_type, int(np.count_nonzero(~deleted)))
+
+	print(f"{'index':<24}{'param':>8}{'recall@N vs flat':>18}{'qrels recall':>14}{'ms/query':>10}")
+	print(f"{'Flat':<24}{'-':>8}{1:>18.4f}{exact_recall:>14.4f}{exact_latency * 1000:>10.2f}")
+
+	for value in search_params:
+		set_search_param(ann_index, index_type, value)
+		ann_inds, ann_latency = evaluate(ann_index)
+
+		overlaps = []
+		for qid in qid2embeds:
+			for ann_list, exact_list in zip(ann_inds[qid], exact_inds[qid]):
+				exact_set = set(exact_list[exact_list >= 0])
+				overlaps.append(len(exact_set & set(ann_list)) / max(len(exact_set), 1))
+
+		ann_recall = np.mean([get_condition_recalls(ann_inds[qid], nctids, relevant[qid]) for qid in qid2embeds])
+
+		print(f"{ann_factory_string:<24}{value:>8}{np.mean(overlaps):>18.4f}{ann_recall:>14.4f}{ann_latency * 1000:>10.2f}")
@@ -0,0 +1,90 @@
+__author__ = "qiao"
+
+"""
+Vectorized reciprocal rank fusion over integer document ids.
+"""
+
+import numpy as np
+
+
+def align_nctids(*nctid_lists):
+	"""
+	Build a shared document id space for retrievers whose indices list the trials differently.
+	Returns (nctids, mappings), where nctids is the union of the lists and mappings[i] is an
+	int64 array that maps the document ids of the i-th list to the shared ones.
+	"""
+	nctids = list(nctid_lists[0])
+	nctid2idx = {nctid: idx for idx, nctid in enumerate(nctids)}
+	mappings = []
+
+	for nctid_list in nctid_lists:
+		mapping = np.empty(len(nctid_list), dtype=np.int64)
+
+		for idx, nctid in enumerate(nctid_list):
+			if nctid not in nctid2idx:
+				nctid2idx[nctid] = len(nctids)
+				nctids.append(nctid)
+
+			mapping[idx] = nctid2idx[nctid]
+
+		mappings.append(mapping)
+
+	return nctids, mappings
+
+
+def reciprocal_rank_fusion(rankings: list, weights: list, k: float, N: int, num_docs: int):
+	"""
+	Fuse the per-condition rankings of several retrievers.
+	rankings: one entry per retriever, each a list (over conditions, by priority) of 1-D arrays
+		of document ids ranked by that retriever for that condition
+	weights: one weight per retriever, a retriever with weight <= 0 is left out
+	Each document scores sum(weight * 1 / (rank + k) * 1 / (condition_idx + 1)) over the lists it is in.
+	Returns (top_inds, top_scores) of the (up to) N best documents, ranked by descending score
+	with ties broken by first occurrence, as the original dict-based fusion: the lists are visited
+	by condition, then by retriever, then by rank.
+	"""
+	inds = []
+	contributions = []
+	num_conditions = max([len(condition_rankings) for condition_rankings in rankings], default=0)
+
+	for condition_idx in range(num_conditions):
+		for condition_rankings, weight in zip(rankings, weights):
+			if weight <= 0 or condition_idx >= len(condition_rankings):
+				continue
+
+			condition_inds = np.asarray(condition_rankings[condition_idx], dtype=np.int64)
+			inds.append(condition_inds)
+			contributions.append(weight * (1 / (np.arange(len(condition_inds)) + k)) * (1 / (condition_idx + 1)))
+
+	if not inds:
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+	inds = np.concatenate(inds)
+
+	# summed in the visiting order, so that the scores are the same floats as the original ones
+	scores = np.bincount(inds, weights=np.concatenate(contributions), minlength=num_docs)
+
+	# the position of the first occurrence of each document, len(inds) if it is not retrieved
+	first_seen = np.full(num_docs, len(inds), dtype=np.int64)
+	np.minimum.at(first_seen, inds, np.arange(len(inds)))
+
+	candidates = np.flatnonzero(first_seen < len(inds))
+	candidate_scores = scores[candidates]
+	first_seen = first_seen[candidates]
+
+	if len(candidates) > N:
+		# the documents tied with the N-th score are taken by first occurrence
+		threshold = -np.partition(-candidate_scores, N - 1)[N - 1]
+		above = np.flatnonzero(candidate_scores > threshold)
+		tied = np.flatnonzero(candidate_scores == threshold)
+		tied = tied[np.argsort(first_seen[tied], kind="stable")][: N - len(above)]
+		top = np.concatenate([above, tied])
+
+		candidates = candidates[top]
+		candidate_scores = candidate_scores[top]
+		first_seen = first_seen[top]
+
+	# lexsort uses the last key as the primary one
+	order = np.lexsort((first_seen, -candidate_scores))
+
+	return candidates[order], candidate_scores[order]
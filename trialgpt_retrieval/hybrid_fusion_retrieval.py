@@ -7,105 +7,248 @@ Conduct the first stage retrieval by the hybrid retriever
 from beir.datasets.data_loader import GenericDataLoader
 import faiss
 import json
-from nltk import word_tokenize
 import numpy as np
 import os
-from rank_bm25 import BM25Okapi
 import sys
+import threading
 import tqdm
-import torch
-from transformers import AutoTokenizer, AutoModel
 
-def get_bm25_corpus_index(corpus):
-	corpus_path = os.path.join(f"trialgpt_retrieval/bm25_corpus_{corpus}.json")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trialgpt_utils"))
+from bm25 import BM25Index, TOKENIZERS, tokenize_corpus
+from corpus_utils import get_file_fingerprint, get_file_stamp
+from faiss_index import get_faiss_index, set_search_param
+from fusion import align_nctids, reciprocal_rank_fusion
+from instrumentation import metrics
+from medcpt_encoder import QUERY_ENCODER, encode_corpus, encode_queries, get_device, load_query_encoder
+from query_cache import QueryCache
+from update_index import get_medcpt_paths, read_corpus_hashes, save_medcpt_cache, update_bm25_index, update_medcpt_index
 
-	# if already cached then load, otherwise build
-	if os.path.exists(corpus_path):
-		corpus_data = json.load(open(corpus_path))
-		tokenized_corpus = corpus_data["tokenized_corpus"]
-		corpus_nctids = corpus_data["corpus_nctids"]
+def get_bm25_corpus_index(corpus, incremental=False, tokenizer="nltk", num_workers=1):
+	index_dir = f"trialgpt_retrieval/bm25_index_{corpus}"
+	source_path = f"dataset/{corpus}/corpus.jsonl"
+
+	# if already cached with the same tokenizer and the corpus is unchanged then load, otherwise build
+	if BM25Index.is_cached(index_dir, source_path, tokenizer):
+		bm25, corpus_nctids = BM25Index.load(index_dir)
+
+	# only tokenize the new or changed trials
+	elif incremental and BM25Index.exists(index_dir, tokenizer):
+		bm25, corpus_nctids = update_bm25_index(corpus)
 
 	else:
-		tokenized_corpus = []
-		corpus_nctids = []
-
-		with open(f"dataset/{corpus}/corpus.jsonl", "r") as f:
-			for line in f.readlines():
-				entry = json.loads(line)
-				corpus_nctids.append(entry["_id"])
-				
-				# weighting: 3 * title, 2 * condition, 1 * text
-				tokens = word_tokenize(entry["title"].lower()) * 3
-				for disease in entry["metadata"]["diseases_list"]:
-					tokens += word_tokenize(disease.lower()) * 2
-				tokens += word_tokenize(entry["text"].lower())
-
-				tokenized_corpus.append(tokens)
-
-		corpus_data = {
-			"tokenized_corpus": tokenized_corpus,
-			"corpus_nctids": corpus_nctids,
-		}
-
-		with open(corpus_path, "w") as f:
-			json.dump(corpus_data, f, indent=4)
-	
-	bm25 = BM25Okapi(tokenized_corpus)
+		# fingerprint before reading, so that a concurrent update invalidates the new index
+		source_fingerprint = get_file_fingerprint(source_path)
+
+		# streamed in chunks of lines and tokenized by num_workers processes
+		tokenized_corpus, corpus_nctids, corpus_hashes = tokenize_corpus(source_path, tokenizer, num_workers)
+
+		bm25 = BM25Index.from_tokenized_corpus(tokenized_corpus, tokenizer=tokenizer)
+		bm25.save(index_dir, corpus_nctids, corpus_hashes, source_fingerprint)
 
 	return bm25, corpus_nctids
 
 			
-def get_medcpt_corpus_index(corpus):
-	corpus_path = f"trialgpt_retrieval/{corpus}_embeds.npy" 
-	nctids_path = f"trialgpt_retrieval/{corpus}_nctids.json"
+def get_medcpt_corpus_index(
+	corpus, 
+	batch_size=32, 
+	num_workers=1, 
+	precision="fp32", 
+	incremental=False, 
+	index_type="flat", 
+	search_param=None,
+):
+	paths = get_medcpt_paths(corpus)
 
 	# if already cached then load, otherwise build
-	if os.path.exists(corpus_path):
-		embeds = np.load(corpus_path)
-		corpus_nctids = json.load(open(nctids_path)) 
+	if os.path.exists(paths["embeds"]) and incremental:
+		# only embed the new or changed trials
+		embeds, corpus_nctids, deleted = update_medcpt_index(corpus, batch_size, precision)
+
+	elif os.path.exists(paths["embeds"]):
+		embeds = np.load(paths["embeds"])
+		corpus_nctids = json.load(open(paths["nctids"])) 
+
+		if os.path.exists(paths["deleted"]):
+			deleted = np.load(paths["deleted"])
+		else:
+			deleted = np.zeros(len(corpus_nctids), dtype=bool)
 
 	else:
-		embeds = []
-		corpus_nctids = []
-
-		model = AutoModel.from_pretrained("ncbi/MedCPT-Article-Encoder").to("cuda")
-		tokenizer = AutoTokenizer.from_pretrained("ncbi/MedCPT-Article-Encoder")
-
-		with open(f"dataset/{corpus}/corpus.jsonl", "r") as f:
-			print("Encoding the corpus")
-			for line in tqdm.tqdm(f.readlines()):
-				entry = json.loads(line)
-				corpus_nctids.append(entry["_id"])
-
-				title = entry["title"]
-				text = entry["text"]
-
-				with torch.no_grad():
-					# tokenize the articles
-					encoded = tokenizer(
-						[[title, text]], 
-						truncation=True, 
-						padding=True, 
-						return_tensors='pt', 
-						max_length=512,
-					).to("cuda")
-					
-					embed = model(**encoded).last_hidden_state[:, 0, :]
-
-					embeds.append(embed[0].cpu().numpy())
-
-		embeds = np.array(embeds)
-
-		np.save(corpus_path, embeds)
-		with open(nctids_path, "w") as f:
-			json.dump(corpus_nctids, f, indent=4)
-
-	index = faiss.IndexFlatIP(768)
-	index.add(embeds)
+		embeds, corpus_nctids = encode_corpus(corpus, batch_size, num_workers, precision)
+
+		nctid2hash = read_corpus_hashes(f"dataset/{corpus}/corpus.jsonl")
+		corpus_hashes = [nctid2hash[nctid] for nctid in corpus_nctids]
+		deleted = np.zeros(len(corpus_nctids), dtype=bool)
+
+		save_medcpt_cache(corpus, embeds, corpus_nctids, corpus_hashes, deleted)
+
+	if index_type != "flat":
+		# approximate index, cached on disk and searched with nprobe / efSearch = search_param
+		index = get_faiss_index(corpus, embeds, deleted, index_type)
+		set_search_param(index, index_type, search_param)
+
+	elif np.any(deleted):
+		# tombstoned rows are left out, the ids still point into corpus_nctids
+		index = faiss.IndexIDMap(faiss.IndexFlatIP(768))
+		live_ids = np.where(~deleted)[0]
+		index.add_with_ids(embeds[live_ids], live_ids.astype(np.int64))
+	else:
+		index = faiss.IndexFlatIP(768)
+		index.add(embeds)
 	
 	return index, corpus_nctids
 	
 
+class HybridRetriever:
+	"""
+	The BM25 + MedCPT hybrid retriever, with the indices loaded once.
+	With a cache_path, the condition tokens, the query embeddings and the per-condition rankings
+	are cached on disk (see query_cache.py), so that repeated conditions and parameter sweeps
+	only redo the fusion.
+	"""
+
+	def __init__(
+		self,
+		corpus,
+		index_type="flat",
+		search_param=None,
+		incremental=False,
+		cache_path=None,
+		tokenizer="nltk",
+		num_workers=1,
+	):
+		self.bm25, bm25_nctids = get_bm25_corpus_index(corpus, incremental=incremental, tokenizer=tokenizer, num_workers=num_workers)
+		self.medcpt, medcpt_nctids = get_medcpt_corpus_index(
+			corpus, 
+			incremental=incremental, 
+			index_type=index_type, 
+			search_param=search_param,
+		)
+
+		# the fusion works on the document ids of the BM25 index, extended with any MedCPT-only trials
+		self.nctids, (self.bm25_map, self.medcpt_map) = align_nctids(bm25_nctids, medcpt_nctids)
+
+		self.cache = QueryCache(cache_path) if cache_path else None
+
+		# cached rankings are only valid for the same index versions
+		bm25_meta = json.load(open(f"trialgpt_retrieval/bm25_index_{corpus}/meta.json"))
+		medcpt_paths = get_medcpt_paths(corpus)
+		self.bm25_namespace = f"bm25:{corpus}:{tokenizer}:{bm25_meta['source']['sha256']}:{self.bm25.num_docs}:{self.bm25.corpus_size}"
+		self.medcpt_namespace = f"medcpt:{corpus}:{index_type}:{search_param}:" + ":".join(
+			get_file_stamp(medcpt_paths[name]) for name in ["embeds", "deleted"]
+		)
+
+		# the query encoder for MedCPT is only loaded when a condition is not cached, by one thread
+		self.device = get_device()
+		self.model = None
+		self.tokenizer = None
+		self.model_lock = threading.Lock()
+
+
+	def tokenize(self, conditions):
+		# the conditions are tokenized like the documents of the index
+		tokenize = TOKENIZERS[self.bm25.tokenizer]
+
+		if self.cache is None:
+			return [tokenize(condition.lower()) for condition in conditions]
+
+		return self.cache.get_tokens(conditions, f"tokenizer:{self.bm25.tokenizer}", lambda text: tokenize(text.lower()))
+
+
+	def encode(self, conditions):
+		def encode_texts(texts):
+			with self.model_lock:
+				if self.model is None:
+					self.model, self.tokenizer = load_query_encoder(self.device)
+
+			return encode_queries(texts, self.model, self.tokenizer, self.device)
+
+		with metrics.timer("retrieval_medcpt_encode"):
+			if self.cache is None:
+				return encode_texts(conditions)
+
+			return self.cache.get_embeds(conditions, QUERY_ENCODER, encode_texts)
+
+
+	def search_bm25(self, conditions, N):
+		"""Per-condition top-N BM25 document ids, all conditions are scored in one batch."""
+		with metrics.timer("retrieval_bm25"):
+			_, inds = self.bm25.search(self.tokenize(conditions), n=N)
+
+		return list(inds)
+
+
+	def search_medcpt(self, conditions, N):
+		"""Per-condition top-N MedCPT document ids."""
+		embeds = self.encode(conditions)
+
+		with metrics.timer("retrieval_medcpt_search"):
+			_, inds = self.medcpt.search(embeds, k=N)
+
+		# approximate indices pad with -1 when fewer than N trials are found
+		return [ind_list[ind_list >= 0] for ind_list in inds]
+
+
+	def search_conditions(self, conditions, N, bm25=True, medcpt=True):
+		"""
+		Per-condition top-N document ids of each retriever, in the shared id space.
+		Returns (bm25_rankings, medcpt_rankings), each a list of 1-D arrays (empty if disabled).
+		"""
+		bm25_rankings = []
+		medcpt_rankings = []
+
+		if bm25 and self.cache is not None:
+			bm25_rankings = self.cache.get_rankings(conditions, self.bm25_namespace, N, self.search_bm25)
+		elif bm25:
+			bm25_rankings = self.search_bm25(conditions, N)
+
+		if medcpt and self.cache is not None:
+			medcpt_rankings = self.cache.get_rankings(conditions, self.medcpt_namespace, N, self.search_medcpt)
+		elif medcpt:
+			medcpt_rankings = self.search_medcpt(conditions, N)
+
+		bm25_rankings = [self.bm25_map[ind_list] for ind_list in bm25_rankings]
+		medcpt_rankings = [self.medcpt_map[ind_list] for ind_list in medcpt_rankings]
+
+		return bm25_rankings, medcpt_rankings
+
+
+	def fuse(self, bm25_rankings, medcpt_rankings, k=20, bm25_wt=1, medcpt_wt=1, N=2000):
+		"""Reciprocal rank fusion of the per-condition rankings, returns the top-N NCT IDs."""
+		with metrics.timer("retrieval_fusion"):
+			top_inds, _ = reciprocal_rank_fusion(
+				[bm25_rankings, medcpt_rankings],
+				[bm25_wt, medcpt_wt],
+				k,
+				N,
+				len(self.nctids),
+			)
+
+		return [self.nctids[ind] for ind in top_inds]
+
+
+	def retrieve(self, conditions, k=20, bm25_wt=1, medcpt_wt=1, N=2000):
+		"""Top-N NCT IDs for a list of conditions ranked by priority."""
+		if len(conditions) == 0:
+			return []
+
+		rankings = self.search_conditions(conditions, N, bm25=bm25_wt > 0, medcpt=medcpt_wt > 0)
+
+		return self.fuse(*rankings, k=k, bm25_wt=bm25_wt, medcpt_wt=medcpt_wt, N=N)
+
+
+def get_conditions(id2queries, qid, q_type):
+	"""The keyword list of a patient for a query type."""
+	if q_type in ["raw", "human_summary"]:
+		return [id2queries[qid][q_type]]
+	elif "turbo" in q_type:
+		return id2queries[qid][q_type]["conditions"]
+	elif "Clinician" in q_type:
+		return id2queries[qid].get(q_type, [])
+
+	return []
+
+
 if __name__ == "__main__":
 	# different corpora, "trec_2021", "trec_2022", "sigir"
 	corpus = sys.argv[1]
@@ -117,10 +260,18 @@ if __name__ == "__main__":
 	k = int(sys.argv[3])
 
 	# bm25 weight 
-	bm25_wt = int(sys.argv[4])
+	bm25_wt = float(sys.argv[4])
 
 	# medcpt weight
-	medcpt_wt = int(sys.argv[5])
+	medcpt_wt = float(sys.argv[5])
+
+	# the MedCPT index type (flat, hnsw, ivf_flat, ivf_pq, or opq_ivf_pq) and its nprobe / efSearch
+	index_type = sys.argv[6] if len(sys.argv) > 6 else "flat"
+	search_param = int(sys.argv[7]) if len(sys.argv) > 7 else None
+
+	# the BM25 tokenizer (nltk or regex) and the number of processes that tokenize the corpus
+	tokenizer = sys.argv[8] if len(sys.argv) > 8 else "nltk"
+	num_workers = int(sys.argv[9]) if len(sys.argv) > 9 else 1
 
 	# how many to rank
 	N = 2000 
@@ -131,16 +282,24 @@ if __name__ == "__main__":
 	# loading all types of queries
 	id2queries = json.load(open(f"dataset/{corpus}/id2queries.json"))
 
-	# loading the indices
-	bm25, bm25_nctids = get_bm25_corpus_index(corpus)
-	medcpt, medcpt_nctids = get_medcpt_corpus_index(corpus)
-
-	# loading the query encoder for MedCPT
-	model = AutoModel.from_pretrained("ncbi/MedCPT-Query-Encoder").to("cuda")
-	tokenizer = AutoTokenizer.from_pretrained("ncbi/MedCPT-Query-Encoder")
+	# loading the indices and the query encoder
+	retriever = HybridRetriever(
+		corpus, 
+		index_type=index_type, 
+		search_param=search_param, 
+		cache_path="trialgpt_retrieval/query_cache.sqlite3",
+		tokenizer=tokenizer,
+		num_workers=num_workers,
+	)
 	
 	# then conduct the searches, saving top 1k
-	output_path = f"results/qid2nctids_results_{q_type}_{corpus}_k{k}_bm25wt{bm25_wt}_medcptwt{medcpt_wt}_N{N}.json"
+	output_path = f"results/qid2nctids_results_{q_type}_{corpus}_k{k}_bm25wt{bm25_wt:g}_medcptwt{medcpt_wt:g}_N{N}.json"
+
+	if index_type != "flat":
+		output_path = output_path.replace(".json", f"_{index_type}{search_param}.json")
+
+	if tokenizer != "nltk":
+		output_path = output_path.replace(".json", f"_{tokenizer}.json")
 	
 	qid2nctids = {}
 	recalls = []
@@ -157,65 +316,9 @@ if __name__ == "__main__":
 			truth_sum = sum(qrels[qid].values())
 			
 			# get the keyword list
-			if q_type in ["raw", "human_summary"]:
-				conditions = [id2queries[qid][q_type]]
-			elif "turbo" in q_type:
-				conditions = id2queries[qid][q_type]["conditions"]
-			elif "Clinician" in q_type:
-				conditions = id2queries[qid].get(q_type, [])
-
-			if len(conditions) == 0:
-				nctid2score = {}
-			else:
-				# a list of nctid lists for the bm25 retriever
-				bm25_condition_top_nctids = []
-
-				for condition in conditions:
-					tokens = word_tokenize(condition.lower())
-					top_nctids = bm25.get_top_n(tokens, bm25_nctids, n=N)
-					bm25_condition_top_nctids.append(top_nctids)
-				
-				# doing MedCPT retrieval
-				with torch.no_grad():
-					encoded = tokenizer(
-						conditions, 
-						truncation=True, 
-						padding=True, 
-						return_tensors='pt', 
-						max_length=256,
-					).to("cuda")
-
-					# encode the queries (use the [CLS] last hidden states as the representations)
-					embeds = model(**encoded).last_hidden_state[:, 0, :].cpu().numpy()
-
-					# search the Faiss index
-					scores, inds = medcpt.search(embeds, k=N)				
-
-				medcpt_condition_top_nctids = []
-				for ind_list in inds:
-					top_nctids = [medcpt_nctids[ind] for ind in ind_list]
-					medcpt_condition_top_nctids.append(top_nctids)
-
-				nctid2score = {}
-
-				for condition_idx, (bm25_top_nctids, medcpt_top_nctids) in enumerate(zip(bm25_condition_top_nctids, medcpt_condition_top_nctids)):
-
-					if bm25_wt > 0:
-						for rank, nctid in enumerate(bm25_top_nctids):
-							if nctid not in nctid2score:
-								nctid2score[nctid] = 0
-							
-							nctid2score[nctid] += (1 / (rank + k)) * (1 / (condition_idx + 1))
-					
-					if medcpt_wt > 0:
-						for rank, nctid in enumerate(medcpt_top_nctids):
-							if nctid not in nctid2score:
-								nctid2score[nctid] = 0
-							
-							nctid2score[nctid] += (1 / (rank + k)) * (1 / (condition_idx + 1))
-
-			nctid2score = sorted(nctid2score.items(), key=lambda x: -x[1])
-			top_nctids = [nctid for nctid, _ in nctid2score[:N]]
+			conditions = get_conditions(id2queries, qid, q_type)
+
+			top_nctids = retriever.retrieve(conditions, k=k, bm25_wt=bm25_wt, medcpt_wt=medcpt_wt, N=N)
 			qid2nctids[qid] = top_nctids
 
 			actual_sum = sum([qrels[qid].get(nctid, 0) for nctid in top_nctids])
@@ -1,20 +1,26 @@
 __author__ = "qiao"
 
 """
-generate the search keywords for each patient
+generate the search keywords for each patient, with concurrent requests, resuming from
+the patients already in the result store, and a corrective retry for malformed outputs
 """
 
+import asyncio
 import json
 import os
-from openai import AzureOpenAI
 
 import sys
 
-client = AzureOpenAI(
-	api_version="2023-09-01-preview",
-	azure_endpoint=os.getenv("OPENAI_ENDPOINT"),
-	api_key=os.getenv("OPENAI_API_KEY"),
-)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trialgpt_utils"))
+from instrumentation import labels, metrics
+from llm_client import LLMClient
+from llm_executor import LLMExecutor
+from result_store import open_store
+
+# the prompt asks for up to 32 conditions
+MAX_CONDITIONS = 32
+
+OUTPUT_FORMAT = 'Dict{"summary": Str(summary), "conditions": List[Str(condition)]}'
 
 
 def get_keyword_generation_messages(note):
@@ -26,34 +32,137 @@ def get_keyword_generation_messages(note):
 		{"role": "system", "content": system},
 		{"role": "user", "content": prompt}
 	]
-	
+
 	return messages
 
 
-if __name__ == "__main__":
-	# the corpus: trec_2021, trec_2022, or sigir
-	corpus = sys.argv[1]
+def parse_keywords(output: str) -> dict:
+	"""The {"summary", "conditions"} dict of an output, raises ValueError if it does not follow the schema."""
+	output = output.strip("`").strip("json")
 
-	# the model index to use
-	model = sys.argv[2]
+	try:
+		keywords = json.loads(output)
+	except json.JSONDecodeError as e:
+		raise ValueError(f"the output is not valid JSON ({e})")
+
+	if type(keywords) is not dict:
+		raise ValueError("the output is not a JSON dict")
+
+	if type(keywords.get("summary")) is not str:
+		raise ValueError('"summary" is missing or not a string')
+
+	conditions = keywords.get("conditions")
+
+	if type(conditions) is not list or not all(type(condition) is str for condition in conditions):
+		raise ValueError('"conditions" is missing or not a list of strings')
+
+	conditions = [condition.strip() for condition in conditions if condition.strip()]
+
+	if not conditions:
+		raise ValueError('"conditions" is empty')
+
+	return {"summary": keywords["summary"], "conditions": conditions[:MAX_CONDITIONS]}
+
+
+def is_keywords(output: str) -> bool:
+	"""Whether an output follows the schema, only those are cached."""
+	try:
+		parse_keywords(output)
+		return True
+	except ValueError:
+		return False
+
+
+def get_retry_messages(messages: list, output: str, error: str) -> list:
+	"""The conversation with the malformed output and what is wrong with it, which is also a new cache key."""
+	return messages + [
+		{"role": "assistant", "content": output},
+		{"role": "user", "content": f"Your output is invalid: {error}. Please output only a JSON dict formatted as {OUTPUT_FORMAT}.\n\nJSON output:"},
+	]
+
+
+async def generate_keywords(client: LLMClient, model: str, note: str, max_attempts: int = 3) -> tuple:
+	"""Returns (keywords, number of attempts), raises ValueError if all attempts are malformed."""
+	messages = get_keyword_generation_messages(note)
+
+	for attempt in range(1, max_attempts + 1):
+		with labels(stage="keywords"):
+			output = await client.achat(model, messages, validate=is_keywords, temperature=0)
+
+			try:
+				return parse_keywords(output), attempt
+			except ValueError as e:
+				metrics.record_parse_failure(str(e))
+				error = str(e)
+				messages = get_retry_messages(messages, output, error)
+
+	raise ValueError(f"malformed keywords after {max_attempts} attempts: {error}")
+
+
+async def generate_corpus(client, model, corpus, stats):
+	output_path = f"results/retrieval_keywords_{model}_{corpus}.json"
+
+	# one record per patient, the generated patients are skipped on a restart
+	store = open_store(output_path, "keywords")
+
+	async def generate_patient(entry):
+		try:
+			with labels(patient_id=entry["_id"]):
+				keywords, attempts = await generate_keywords(client, model, entry["text"])
+		except Exception as e:
+			print(f"{corpus} {entry['_id']}: {e}")
+			stats["failed"] += 1
+			return
+
+		store.put(entry["_id"], None, None, keywords)
+		stats["generated"] += 1
+		stats["retried"] += attempts > 1
+
+	tasks = []
 
-	outputs = {}
-	
 	with open(f"dataset/{corpus}/queries.jsonl", "r") as f:
-		for line in f.readlines():
+		for line in f:
 			entry = json.loads(line)
-			messages = get_keyword_generation_messages(entry["text"])
 
-			response = client.chat.completions.create(
-				model=model,
-				messages=messages,
-				temperature=0,
-			)
+			if (entry["_id"], None, None) in store:
+				stats["resumed"] += 1
+				continue
+
+			# the executor bounds the requests in flight
+			tasks.append(generate_patient(entry))
+
+	try:
+		await asyncio.gather(*tasks)
+
+	finally:
+		store.close()
+		store.export(output_path)
+
+
+async def main(corpora, model, max_concurrency, rpm, tpm):
+	client = LLMClient(executor=LLMExecutor(max_concurrency=max_concurrency, rpm=rpm, tpm=tpm))
+	stats = {"generated": 0, "resumed": 0, "retried": 0, "failed": 0}
+
+	# the cohorts share the executor, so the concurrency and rate limits hold across all of them
+	await asyncio.gather(*[generate_corpus(client, model, corpus, stats) for corpus in corpora])
+
+	print(f"Keyword generation: {stats}")
+	print(client.stats())
+	print(metrics.report())
+	metrics.save(f"results/metrics_keywords_{model}.json")
+
+
+if __name__ == "__main__":
+	# syntax: python trialgpt_retrieval/keyword_generation.py ${corpora} ${model} ${max_concurrency} ${rpm} ${tpm}
+	# ${corpora} is a comma-separated list of trec_2021, trec_2022, and sigir
+	# ${rpm} and ${tpm} are the requests and tokens per minute of the deployment, 0 for no limit
+	corpora = sys.argv[1].split(",")
+
+	# the model index to use
+	model = sys.argv[2]
 
-			output = response.choices[0].message.content
-			output = output.strip("`").strip("json")
-			
-			outputs[entry["_id"]] = json.loads(output)
+	max_concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+	rpm = float(sys.argv[4]) if len(sys.argv) > 4 else 0
+	tpm = float(sys.argv[5]) if len(sys.argv) > 5 else 0
 
-			with open(f"results/retrieval_keywords_{model}_{corpus}.json", "w") as f:
-				json.dump(outputs, f, indent=4)
+	asyncio.run(main(corpora, model, max_concurrency, rpm or None, tpm or None))
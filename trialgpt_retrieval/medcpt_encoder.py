@@ -0,0 +1,208 @@
+__author__ = "qiao"
+
+"""
+Batched MedCPT-Article-Encoder for building the dense corpus index on GPU or CPU.
+"""
+
+import json
+import multiprocessing
+import numpy as np
+import os
+import sys
+import time
+import torch
+import tqdm
+from transformers import AutoTokenizer, AutoModel
+
+ARTICLE_ENCODER = "ncbi/MedCPT-Article-Encoder"
+QUERY_ENCODER = "ncbi/MedCPT-Query-Encoder"
+
+
+def get_device(worker_idx: int = 0) -> str:
+	"""The device for a (worker) process: GPUs are shared round-robin, otherwise CPU."""
+	if torch.cuda.is_available():
+		return f"cuda:{worker_idx % torch.cuda.device_count()}"
+
+	return "cpu"
+
+
+def load_article_encoder(device: str, precision: str = "fp32"):
+	"""
+	precision can be fp32, bf16 (autocast on CPU or GPU), fp16 (autocast on GPU),
+	or int8 (dynamic quantization of the linear layers, CPU only).
+	"""
+	model = AutoModel.from_pretrained(ARTICLE_ENCODER)
+	tokenizer = AutoTokenizer.from_pretrained(ARTICLE_ENCODER)
+
+	if precision == "int8":
+		if not device.startswith("cpu"):
+			raise ValueError("int8 dynamic quantization is only supported on CPU.")
+
+		model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+	model = model.to(device)
+	model.eval()
+
+	return model, tokenizer
+
+
+def encode_articles(
+	entries: list,
+	model,
+	tokenizer,
+	device: str,
+	batch_size: int = 32,
+	precision: str = "fp32",
+) -> np.ndarray:
+	"""Encode a list of corpus entries into a (len(entries), 768) float32 matrix, in the input order."""
+	# tokenize without padding first, then batch the articles by length
+	encoded = tokenizer(
+		[[entry["title"], entry["text"]] for entry in entries],
+		truncation=True,
+		max_length=512,
+	)
+	lengths = np.array([len(input_ids) for input_ids in encoded["input_ids"]])
+	order = np.argsort(-lengths, kind="stable")
+
+	autocast_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(precision)
+	device_type = device.split(":")[0]
+
+	embeds = np.zeros((len(entries), model.config.hidden_size), dtype=np.float32)
+
+	with torch.inference_mode(), torch.autocast(device_type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+		for start in range(0, len(order), batch_size):
+			batch_inds = order[start : start + batch_size]
+			batch = tokenizer.pad(
+				{key: [encoded[key][idx] for idx in batch_inds] for key in encoded.keys()},
+				return_tensors="pt",
+			).to(device)
+
+			# use the [CLS] last hidden states as the representations
+			embed = model(**batch).last_hidden_state[:, 0, :]
+			embeds[batch_inds] = embed.float().cpu().numpy()
+
+	return embeds
+
+
+def load_query_encoder(device: str):
+	model = AutoModel.from_pretrained(QUERY_ENCODER).to(device)
+	tokenizer = AutoTokenizer.from_pretrained(QUERY_ENCODER)
+	model.eval()
+
+	return model, tokenizer
+
+
+def encode_queries(queries: list, model, tokenizer, device: str) -> np.ndarray:
+	"""Encode a list of query strings into a (len(queries), 768) float32 matrix."""
+	with torch.no_grad():
+		encoded = tokenizer(
+			queries, 
+			truncation=True, 
+			padding=True, 
+			return_tensors='pt', 
+			max_length=256,
+		).to(device)
+
+		# encode the queries (use the [CLS] last hidden states as the representations)
+		embeds = model(**encoded).last_hidden_state[:, 0, :].cpu().numpy()
+
+	return embeds
+
+
+def encode_shard(args: tuple) -> dict:
+	"""Worker of encode_corpus: encode the lines [start, end) of the corpus into one shard file."""
+	corpus, shard_idx, start, end, batch_size, precision, num_threads, chunk_size = args
+
+	device = get_device(shard_idx)
+	if device == "cpu":
+		torch.set_num_threads(num_threads)
+
+	model, tokenizer = load_article_encoder(device, precision)
+
+	with open(f"dataset/{corpus}/corpus.jsonl", "r") as f:
+		entries = [json.loads(line) for line_idx, line in enumerate(f) if start <= line_idx < end]
+
+	start_time = time.time()
+	embeds = []
+
+	# bounded chunks keep the un-padded token ids of a large shard in memory only chunk by chunk
+	for chunk_start in tqdm.tqdm(range(0, len(entries), chunk_size), desc=f"Shard {shard_idx}", position=shard_idx):
+		chunk = entries[chunk_start : chunk_start + chunk_size]
+		embeds.append(encode_articles(chunk, model, tokenizer, device, batch_size, precision))
+
+	embeds = np.concatenate(embeds) if embeds else np.zeros((0, model.config.hidden_size), dtype=np.float32)
+	seconds = time.time() - start_time
+
+	shard_path = f"trialgpt_retrieval/{corpus}_embeds_shard{shard_idx}.npy"
+	np.save(shard_path, embeds)
+
+	return {
+		"shard_path": shard_path,
+		"nctids": [entry["_id"] for entry in entries],
+		"device": device,
+		"num_docs": len(entries),
+		"seconds": seconds,
+	}
+
+
+def encode_corpus(
+	corpus: str,
+	batch_size: int = 32,
+	num_workers: int = 1,
+	precision: str = "fp32",
+	chunk_size: int = 4096,
+):
+	"""
+	Encode dataset/{corpus}/corpus.jsonl with num_workers processes, each writing one embedding
+	shard, then merge the shards in corpus order. Returns (embeds, nctids).
+	"""
+	with open(f"dataset/{corpus}/corpus.jsonl", "r") as f:
+		num_docs = sum(1 for _ in f)
+
+	bounds = np.linspace(0, num_docs, num_workers + 1).astype(int)
+	num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+	shard_args = [
+		(corpus, shard_idx, bounds[shard_idx], bounds[shard_idx + 1], batch_size, precision, num_threads, chunk_size)
+		for shard_idx in range(num_workers)
+	]
+
+	print(f"Encoding the corpus with {num_workers} worker(s)")
+	start_time = time.time()
+
+	if num_workers == 1:
+		shards = [encode_shard(shard_args[0])]
+	else:
+		# CUDA and the torch thread pools do not survive fork
+		with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+			shards = pool.map(encode_shard, shard_args)
+
+	seconds = time.time() - start_time
+
+	embeds = np.concatenate([np.load(shard["shard_path"]) for shard in shards])
+	nctids = [nctid for shard in shards for nctid in shard["nctids"]]
+
+	for shard in shards:
+		os.remove(shard["shard_path"])
+
+	# throughput report
+	for shard_idx, shard in enumerate(shards):
+		print(f"Shard {shard_idx} ({shard['device']}): {shard['num_docs']} docs in {shard['seconds']:.1f}s, {shard['num_docs'] / max(shard['seconds'], 1e-9):.1f} docs/sec")
+	print(f"Total: {len(nctids)} docs in {seconds:.1f}s, {len(nctids) / max(seconds, 1e-9):.1f} docs/sec")
+
+	return embeds, nctids
+
+
+if __name__ == "__main__":
+	# build the MedCPT corpus index cache
+	# syntax: python trialgpt_retrieval/medcpt_encoder.py ${corpus} ${batch_size} ${num_workers} ${precision}
+	corpus = sys.argv[1]
+	batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+	num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+	precision = sys.argv[4] if len(sys.argv) > 4 else "fp32"
+
+	embeds, corpus_nctids = encode_corpus(corpus, batch_size, num_workers, precision)
+
+	np.save(f"trialgpt_retrieval/{corpus}_embeds.npy", embeds)
+	with open(f"trialgpt_retrieval/{corpus}_nctids.json", "w") as f:
+		json.dump(corpus_nctids, f, indent=4)
@@ -0,0 +1,149 @@
+__author__ = "qiao"
+
+"""
+Content-addressed on-disk cache of the query-side work of the hybrid retriever:
+condition tokens for BM25, MedCPT query embeddings, and the per-condition top-N
+document ids of each retriever. Entries are keyed by a hash of a namespace (the
+tokenizer, the model name, or the index version) and the normalized condition text.
+Each thread gets its own SQLite connection, so that the cache can be shared by the worker
+threads of the pipeline and the retrieval service.
+"""
+
+import hashlib
+import json
+import numpy as np
+import sqlite3
+import threading
+
+
+class QueryCache:
+	def __init__(self, path: str):
+		self.path = path
+		self.local = threading.local()
+		self.lock = threading.Lock()
+
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, value TEXT)")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS embeds (key TEXT PRIMARY KEY, value BLOB)")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS rankings (key TEXT PRIMARY KEY, depth INTEGER, value BLOB)")
+		self.conn.commit()
+
+		self.hits = 0
+		self.misses = 0
+
+
+	@property
+	def conn(self) -> sqlite3.Connection:
+		"""The connection of the calling thread, opened on its first use."""
+		if not hasattr(self.local, "conn"):
+			self.local.conn = sqlite3.connect(self.path, timeout=60)
+
+		return self.local.conn
+
+
+	@staticmethod
+	def normalize(text: str) -> str:
+		"""Lowercase and collapse whitespace, which changes neither the BM25 tokens nor the (uncased) MedCPT input."""
+		return " ".join(text.lower().split())
+
+
+	@staticmethod
+	def get_key(namespace: str, text: str) -> str:
+		return hashlib.sha256(f"{namespace}\0{text}".encode("utf-8")).hexdigest()
+
+
+	def get_rows(self, table: str, columns: str, keys: list) -> dict:
+		key2row = {}
+		unique_keys = list(set(keys))
+
+		# stay below the SQLite limit of host parameters
+		for start in range(0, len(unique_keys), 500):
+			chunk = unique_keys[start : start + 500]
+			placeholders = ",".join("?" * len(chunk))
+			query = f"SELECT key, {columns} FROM {table} WHERE key IN ({placeholders})"
+
+			for row in self.conn.execute(query, chunk):
+				key2row[row[0]] = row[1:]
+
+		return key2row
+
+
+	def get_or_compute(self, table: str, namespace: str, conditions: list, compute, is_valid=None):
+		"""
+		Look up the conditions and compute the missing ones with compute(List[Str(normalized text)]).
+		Returns (keys, key2row, missing_keys, computed), computed is aligned with missing_keys.
+		"""
+		texts = [self.normalize(condition) for condition in conditions]
+		keys = [self.get_key(namespace, text) for text in texts]
+		columns = "depth, value" if table == "rankings" else "value"
+		key2row = self.get_rows(table, columns, keys)
+
+		if is_valid is not None:
+			key2row = {key: row for key, row in key2row.items() if is_valid(row)}
+
+		# duplicated conditions are computed once
+		missing_keys = list(dict.fromkeys(key for key in keys if key not in key2row))
+		missing_texts = [texts[keys.index(key)] for key in missing_keys]
+
+		with self.lock:
+			self.hits += len(keys) - sum(1 for key in keys if key not in key2row)
+			self.misses += len(missing_keys)
+
+		computed = compute(missing_texts) if missing_texts else []
+
+		return keys, key2row, missing_keys, computed
+
+
+	def get_tokens(self, conditions: list, namespace: str, tokenize) -> list:
+		"""Token lists of the conditions, tokenize maps a normalized text to a token list."""
+		keys, key2row, missing_keys, computed = self.get_or_compute(
+			"tokens", namespace, conditions, lambda texts: [tokenize(text) for text in texts]
+		)
+
+		rows = [(key, json.dumps(tokens)) for key, tokens in zip(missing_keys, computed)]
+		self.conn.executemany("INSERT OR REPLACE INTO tokens VALUES (?, ?)", rows)
+		self.conn.commit()
+
+		key2tokens = {key: json.loads(row[0]) for key, row in key2row.items()}
+		key2tokens.update(zip(missing_keys, computed))
+
+		return [key2tokens[key] for key in keys]
+
+
+	def get_embeds(self, conditions: list, namespace: str, encode) -> np.ndarray:
+		"""(len(conditions), dim) float32 embeddings, encode maps a list of normalized texts to a matrix."""
+		keys, key2row, missing_keys, computed = self.get_or_compute("embeds", namespace, conditions, encode)
+
+		computed = np.asarray(computed, dtype=np.float32)
+		rows = [(key, embed.tobytes()) for key, embed in zip(missing_keys, computed)]
+		self.conn.executemany("INSERT OR REPLACE INTO embeds VALUES (?, ?)", rows)
+		self.conn.commit()
+
+		key2embed = {key: np.frombuffer(row[0], dtype=np.float32) for key, row in key2row.items()}
+		key2embed.update(zip(missing_keys, computed))
+
+		return np.stack([key2embed[key] for key in keys])
+
+
+	def get_rankings(self, conditions: list, namespace: str, N: int, search) -> list:
+		"""
+		Per-condition top-N document ids, search maps (List[Str(normalized text)], N) to a list of
+		int arrays. A cached ranking serves any N up to the depth it was searched with, or any N
+		if the retriever returned fewer documents than that depth.
+		"""
+		def is_valid(row):
+			depth, value = row
+			return depth >= N or len(value) // 4 < depth
+
+		keys, key2row, missing_keys, computed = self.get_or_compute(
+			"rankings", namespace, conditions, lambda texts: search(texts, N), is_valid
+		)
+
+		rows = [(key, N, np.asarray(inds, dtype=np.int32).tobytes()) for key, inds in zip(missing_keys, computed)]
+		self.conn.executemany("INSERT OR REPLACE INTO rankings VALUES (?, ?, ?)", rows)
+		self.conn.commit()
+
+		key2inds = {key: np.frombuffer(row[1], dtype=np.int32) for key, row in key2row.items()}
+		key2inds.update((key, np.asarray(inds, dtype=np.int32)) for key, inds in zip(missing_keys, computed))
+
+		return [key2inds[key][:N].astype(np.int64) for key in keys]
@@ -0,0 +1,95 @@
+__author__ = "qiao"
+
+"""
+Load test of the retrieval service: the conditions of a cohort are sent as concurrent requests,
+and the client-side latency percentiles, the throughput and the server metrics are reported.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import numpy as np
+import sys
+import time
+import urllib.request
+
+
+def post_json(url: str, payload: dict) -> dict:
+	request = urllib.request.Request(
+		url,
+		data=json.dumps(payload).encode("utf-8"),
+		headers={"Content-Type": "application/json"},
+	)
+
+	with urllib.request.urlopen(request, timeout=300) as response:
+		return json.loads(response.read())
+
+
+def load_conditions(corpus: str, q_type: str) -> list:
+	"""The condition lists of the patients of a cohort for a query type."""
+	id2queries = json.load(open(f"dataset/{corpus}/id2queries.json"))
+	condition_lists = []
+
+	for qid, q_type2queries in id2queries.items():
+		if q_type not in q_type2queries:
+			continue
+
+		conditions = q_type2queries[q_type]
+
+		if type(conditions) is str:
+			conditions = [conditions]
+		elif type(conditions) is dict:
+			conditions = conditions["conditions"]
+
+		if conditions:
+			condition_lists.append(conditions)
+
+	return condition_lists
+
+
+def run_load_test(url: str, condition_lists: list, num_requests: int, concurrency: int, N: int) -> dict:
+	"""Send num_requests requests, cycling over the condition lists, with concurrency requests in flight."""
+	def send(idx):
+		start_time = time.perf_counter()
+
+		try:
+			post_json(f"{url}/retrieve", {"conditions": condition_lists[idx % len(condition_lists)], "N": N})
+			return time.perf_counter() - start_time, True
+		except Exception as e:
+			print(e)
+			return time.perf_counter() - start_time, False
+
+	start_time = time.perf_counter()
+
+	with ThreadPoolExecutor(concurrency) as pool:
+		outputs = list(pool.map(send, range(num_requests)))
+
+	elapsed = time.perf_counter() - start_time
+	latencies = np.array([latency for latency, _ in outputs]) * 1000
+
+	return {
+		"requests": num_requests,
+		"errors": sum(not ok for _, ok in outputs),
+		"concurrency": concurrency,
+		"qps": num_requests / elapsed,
+		"p50_ms": float(np.percentile(latencies, 50)),
+		"p99_ms": float(np.percentile(latencies, 99)),
+	}
+
+
+if __name__ == "__main__":
+	# syntax: python trialgpt_retrieval/retrieval_load_test.py ${url} ${corpus} ${q_type} ${num_requests} ${concurrency} ${N}
+	# ${concurrency} is a comma-separated list, e.g., 1,4,16,64
+	url = sys.argv[1].rstrip("/")
+	corpus = sys.argv[2]
+	q_type = sys.argv[3]
+	num_requests = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+	concurrencies = [int(concurrency) for concurrency in sys.argv[5].split(",")] if len(sys.argv) > 5 else [1, 4, 16, 64]
+	N = int(sys.argv[6]) if len(sys.argv) > 6 else 100
+
+	condition_lists = load_conditions(corpus, q_type)
+
+	for concurrency in concurrencies:
+		print(run_load_test(url, condition_lists, num_requests, concurrency, N))
+
+	with urllib.request.urlopen(f"{url}/metrics") as response:
+		print(f"Server metrics: {json.loads(response.read())}")
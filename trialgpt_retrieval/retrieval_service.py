@@ -0,0 +1,271 @@
+__author__ = "qiao"
+
+"""
+Long-lived retrieval service: the BM25 and MedCPT indices and the query encoder are loaded once,
+and the concurrent requests are micro-batched, so that the conditions of all the requests in a
+batch go through one BM25 scoring, one encoder forward pass and one FAISS search. It can be used
+in process (RetrievalService) or over HTTP (POST /retrieve, GET /metrics).
+"""
+
+import asyncio
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import numpy as np
+import sys
+import threading
+import time
+
+
+class RetrievalService:
+	def __init__(self, retriever, max_batch_size: int = 32, max_wait: float = 0.005, window: int = 10000):
+		"""
+		retriever is a HybridRetriever (anything with search_conditions and fuse).
+		A batch is searched once max_batch_size requests are pending or max_wait seconds after its first one.
+		The latency percentiles are computed over the last window requests.
+		"""
+		self.retriever = retriever
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait
+
+		self.latencies = collections.deque(maxlen=window)
+		self.batch_sizes = collections.deque(maxlen=window)
+		self.num_requests = 0
+		self.num_errors = 0
+		self.started_at = time.monotonic()
+
+		# created in the running event loop by start()
+		self.queue = None
+		self.worker = None
+
+
+	async def start(self):
+		self.queue = asyncio.Queue()
+		self.worker = asyncio.create_task(self.run())
+
+
+	async def retrieve(self, conditions: list, k: int = 20, bm25_wt: float = 1, medcpt_wt: float = 1, N: int = 2000) -> list:
+		"""Top-N NCT IDs for a list of conditions ranked by priority, as HybridRetriever.retrieve."""
+		start_time = time.perf_counter()
+
+		if len(conditions) == 0:
+			return []
+
+		future = asyncio.get_running_loop().create_future()
+		await self.queue.put(((list(conditions), k, bm25_wt, medcpt_wt, N), future))
+
+		try:
+			return await future
+
+		finally:
+			self.num_requests += 1
+			self.latencies.append(time.perf_counter() - start_time)
+
+
+	async def run(self):
+		"""Collect the pending requests into batches and search them one batch at a time."""
+		loop = asyncio.get_running_loop()
+
+		while True:
+			batch = [await self.queue.get()]
+			deadline = loop.time() + self.max_wait
+
+			while len(batch) < self.max_batch_size:
+				timeout = deadline - loop.time()
+
+				if timeout <= 0:
+					break
+
+				try:
+					batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+				except asyncio.TimeoutError:
+					break
+
+			self.batch_sizes.append(len(batch))
+
+			# the search is CPU / GPU-bound, the event loop keeps accepting requests meanwhile
+			try:
+				outputs = await asyncio.to_thread(self.search_batch, [request for request, _ in batch])
+
+			except Exception as e:
+				self.num_errors += len(batch)
+
+				for _, future in batch:
+					if not future.done():
+						future.set_exception(e)
+				continue
+
+			for (_, future), output in zip(batch, outputs):
+				if not future.done():
+					future.set_result(output)
+
+
+	def search_batch(self, requests: list) -> list:
+		"""The fused NCT IDs of each (conditions, k, bm25_wt, medcpt_wt, N) request, with one search for the batch."""
+		# the conditions shared by several requests are searched once, at the largest N
+		conditions = list(dict.fromkeys(condition for request in requests for condition in request[0]))
+		condition2idx = {condition: idx for idx, condition in enumerate(conditions)}
+		N = max(request[4] for request in requests)
+
+		bm25_rankings, medcpt_rankings = self.retriever.search_conditions(
+			conditions,
+			N,
+			bm25=any(request[2] > 0 for request in requests),
+			medcpt=any(request[3] > 0 for request in requests),
+		)
+
+		outputs = []
+
+		for request_conditions, k, bm25_wt, medcpt_wt, request_N in requests:
+			inds = [condition2idx[condition] for condition in request_conditions]
+
+			# the top-N of a deeper search is the top-N of the request
+			request_bm25 = [bm25_rankings[idx][:request_N] for idx in inds] if bm25_wt > 0 else []
+			request_medcpt = [medcpt_rankings[idx][:request_N] for idx in inds] if medcpt_wt > 0 else []
+
+			outputs.append(self.retriever.fuse(request_bm25, request_medcpt, k=k, bm25_wt=bm25_wt, medcpt_wt=medcpt_wt, N=request_N))
+
+		return outputs
+
+
+	def stats(self) -> dict:
+		latencies = np.array(self.latencies, dtype=np.float64) * 1000
+
+		return {
+			"requests": self.num_requests,
+			"errors": self.num_errors,
+			"qps": self.num_requests / max(time.monotonic() - self.started_at, 1e-9),
+			"p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+			"p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+			"mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+		}
+
+
+def parse_request(request) -> dict:
+	"""The retrieve() arguments of a request body, raises ValueError if a field is missing or invalid."""
+	if type(request) is not dict:
+		raise ValueError("the request must be a JSON dict")
+
+	if "conditions" not in request:
+		raise ValueError('"conditions" is missing')
+
+	conditions = request["conditions"]
+
+	if type(conditions) is not list or not all(type(condition) is str for condition in conditions):
+		raise ValueError('"conditions" must be a list of strings')
+
+	def get_number(name, default):
+		value = request.get(name, default)
+
+		# bool is a subclass of int, but "k": true is a malformed request
+		if type(value) not in (int, float) or not math.isfinite(value):
+			raise ValueError(f'"{name}" must be a number')
+
+		return value
+
+	k = get_number("k", 20)
+	bm25_wt = get_number("bm25_wt", 1)
+	medcpt_wt = get_number("medcpt_wt", 1)
+	N = get_number("N", 2000)
+
+	if k <= 0:
+		raise ValueError('"k" must be positive')
+
+	if bm25_wt < 0 or medcpt_wt < 0:
+		raise ValueError('"bm25_wt" and "medcpt_wt" must be non-negative')
+
+	if N != int(N) or N <= 0:
+		raise ValueError('"N" must be a positive integer')
+
+	return {"conditions": conditions, "k": k, "bm25_wt": bm25_wt, "medcpt_wt": medcpt_wt, "N": int(N)}
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+	# set by serve()
+	service = None
+	loop = None
+
+	def log_message(self, format, *args):
+		pass
+
+
+	def send_json(self, status: int, payload):
+		body = json.dumps(payload).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+	def do_GET(self):
+		if self.path.split("?")[0] != "/metrics":
+			self.send_json(404, {"error": "not found"})
+			return
+
+		self.send_json(200, self.service.stats())
+
+
+	def do_POST(self):
+		"""{"conditions": List[Str], "k": 20, "bm25_wt": 1, "medcpt_wt": 1, "N": 2000} -> {"nctids": List[Str]}"""
+		if self.path.split("?")[0] != "/retrieve":
+			self.send_json(404, {"error": "not found"})
+			return
+
+		try:
+			request = parse_request(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+
+		except (KeyError, TypeError, ValueError) as e:
+			self.send_json(400, {"error": str(e)})
+			return
+
+		future = asyncio.run_coroutine_threadsafe(self.service.retrieve(**request), self.loop)
+
+		try:
+			self.send_json(200, {"nctids": future.result()})
+		except Exception as e:
+			self.send_json(500, {"error": str(e)})
+
+
+def serve(retriever, port: int = 8100, max_batch_size: int = 32, max_wait: float = 0.005, background: bool = False):
+	"""
+	Serve the retriever over HTTP. The batching runs in an event loop thread, and the handler threads
+	submit their requests to it. With background=True the server runs in a daemon thread and is returned.
+	"""
+	loop = asyncio.new_event_loop()
+	threading.Thread(target=loop.run_forever, daemon=True).start()
+
+	service = RetrievalService(retriever, max_batch_size, max_wait)
+	asyncio.run_coroutine_threadsafe(service.start(), loop).result()
+
+	ServiceHandler.service = service
+	ServiceHandler.loop = loop
+	server = ThreadingHTTPServer(("127.0.0.1", port), ServiceHandler)
+
+	if background:
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		return server
+
+	server.serve_forever()
+
+
+if __name__ == "__main__":
+	# syntax: python trialgpt_retrieval/retrieval_service.py ${corpus} ${port} ${max_batch_size} ${max_wait_ms} ${index_type} ${search_param}
+	# then, e.g., python trialgpt_retrieval/retrieval_load_test.py http://127.0.0.1:${port} ${corpus} gpt-4-turbo 1000 16 100
+	from hybrid_fusion_retrieval import HybridRetriever
+
+	corpus = sys.argv[1]
+	port = int(sys.argv[2]) if len(sys.argv) > 2 else 8100
+	max_batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 32
+	max_wait = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.005
+	index_type = sys.argv[5] if len(sys.argv) > 5 else "flat"
+	search_param = int(sys.argv[6]) if len(sys.argv) > 6 else None
+
+	retriever = HybridRetriever(corpus, index_type=index_type, search_param=search_param)
+
+	# the query encoder is loaded before the first request
+	retriever.encode(["warm up"])
+
+	print(f"Serving the {corpus} retriever at http://127.0.0.1:{port}/retrieve")
+	serve(retriever, port, max_batch_size, max_wait)
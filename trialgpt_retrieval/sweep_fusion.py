@@ -0,0 +1,141 @@
+__author__ = "qiao"
+
+"""
+Parameter sweep of the hybrid retrieval fusion. The indices are loaded and the per-condition
+candidates are retrieved once per query type, then every (k, bm25_wt, medcpt_wt, N) setting
+is fused and evaluated in parallel over the cached candidates.
+"""
+
+from beir.datasets.data_loader import GenericDataLoader
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import sys
+import time
+
+from fusion import reciprocal_rank_fusion
+from hybrid_fusion_retrieval import HybridRetriever, get_conditions
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trialgpt_ranking"))
+from rank_results import get_ndcg
+
+# the per-condition candidates of each query type, shared with the forked workers
+CANDIDATES = {}
+
+
+def evaluate_setting(setting: tuple) -> dict:
+	"""Fuse the cached candidates of all patients with one setting and average the metrics."""
+	q_type, k, bm25_wt, medcpt_wt, N = setting
+	nctids, num_docs, qid2candidates, qrels = CANDIDATES[q_type]
+
+	recalls = []
+	ndcg10s = []
+	ndcgNs = []
+
+	for qid, (bm25_rankings, medcpt_rankings) in qid2candidates.items():
+		# the candidates were retrieved with the largest N, a single run only keeps the top N per condition
+		top_inds, _ = reciprocal_rank_fusion(
+			[[inds[:N] for inds in bm25_rankings], [inds[:N] for inds in medcpt_rankings]],
+			[bm25_wt, medcpt_wt],
+			k,
+			N,
+			num_docs,
+		)
+		top_nctids = [nctids[ind] for ind in top_inds]
+
+		truth_sum = sum(qrels[qid].values())
+		actual_sum = sum([qrels[qid].get(nctid, 0) for nctid in top_nctids])
+
+		recalls.append(actual_sum / truth_sum)
+		ndcg10s.append(get_ndcg(top_nctids, qrels[qid], 10))
+		ndcgNs.append(get_ndcg(top_nctids, qrels[qid], N))
+
+	return {
+		"q_type": q_type,
+		"k": k,
+		"bm25_wt": bm25_wt,
+		"medcpt_wt": medcpt_wt,
+		"N": N,
+		"recall": float(np.mean(recalls)) if recalls else 0.0,
+		"ndcg@10": float(np.mean(ndcg10s)) if ndcg10s else 0.0,
+		"ndcg@N": float(np.mean(ndcgNs)) if ndcgNs else 0.0,
+	}
+
+
+if __name__ == "__main__":
+	# syntax: python trialgpt_retrieval/sweep_fusion.py ${corpus} ${q_types} ${ks} ${bm25_wts} ${medcpt_wts} ${Ns} ${num_workers}
+	# all arguments but ${corpus} and ${num_workers} are comma-separated lists, the grid is their product
+	corpus = sys.argv[1]
+	q_types = sys.argv[2].split(",")
+	ks = [int(value) for value in sys.argv[3].split(",")]
+	bm25_wts = [float(value) for value in sys.argv[4].split(",")]
+	medcpt_wts = [float(value) for value in sys.argv[5].split(",")]
+	Ns = [int(value) for value in sys.argv[6].split(",")]
+	num_workers = int(sys.argv[7]) if len(sys.argv) > 7 else multiprocessing.cpu_count()
+
+	max_N = max(Ns)
+
+	# loading the qrels
+	_, _, qrels = GenericDataLoader(data_folder=f"dataset/{corpus}/").load(split="test")
+
+	# loading all types of queries
+	id2queries = json.load(open(f"dataset/{corpus}/id2queries.json"))
+
+	# loading the indices once
+	retriever = HybridRetriever(corpus, cache_path="trialgpt_retrieval/query_cache.sqlite3")
+
+	with open(f"dataset/{corpus}/queries.jsonl", "r") as f:
+		qids = [json.loads(line)["_id"] for line in f]
+
+	# one pass of candidate generation per query type, with the largest N
+	start_time = time.time()
+
+	for q_type in q_types:
+		qid2candidates = {}
+
+		for qid in qids:
+			if qid not in qrels:
+				continue
+
+			conditions = get_conditions(id2queries, qid, q_type)
+
+			if len(conditions) == 0:
+				qid2candidates[qid] = ([], [])
+			else:
+				qid2candidates[qid] = retriever.search_conditions(
+					conditions,
+					max_N,
+					bm25=max(bm25_wts) > 0,
+					medcpt=max(medcpt_wts) > 0,
+				)
+
+		CANDIDATES[q_type] = (retriever.nctids, len(retriever.nctids), qid2candidates, qrels)
+
+	print(f"Retrieved the candidates in {time.time() - start_time:.1f}s")
+
+	settings = list(itertools.product(q_types, ks, bm25_wts, medcpt_wts, Ns))
+	start_time = time.time()
+
+	if num_workers == 1:
+		outputs = [evaluate_setting(setting) for setting in settings]
+	else:
+		# forked workers inherit the candidates without pickling them
+		with multiprocessing.get_context("fork").Pool(num_workers) as pool:
+			outputs = pool.map(evaluate_setting, settings)
+
+	print(f"Evaluated {len(settings)} settings in {time.time() - start_time:.1f}s")
+
+	output_path = f"results/sweep_fusion_{corpus}.tsv"
+	columns = ["q_type", "k", "bm25_wt", "medcpt_wt", "N", "recall", "ndcg@10", "ndcg@N"]
+
+	with open(output_path, "w") as f:
+		f.write("\t".join(columns) + "\n")
+
+		for output in outputs:
+			f.write("\t".join(str(output[column]) for column in columns) + "\n")
+
+	print(f"{'q_type':<16}{'k':>6}{'bm25_wt':>9}{'medcpt_wt':>11}{'N':>7}{'recall':>9}{'ndcg@10':>9}{'ndcg@N':>9}")
+	for output in sorted(outputs, key=lambda output: -output["recall"]):
+		print(f"{output['q_type']:<16}{output['k']:>6}{output['bm25_wt']:>9g}{output['medcpt_wt']:>11g}{output['N']:>7}{output['recall']:>9.4f}{output['ndcg@10']:>9.4f}{output['ndcg@N']:>9.4f}")
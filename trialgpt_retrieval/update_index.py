@@ -0,0 +1,185 @@
+__author__ = "qiao"
+
+"""
+Incremental updates of the BM25 and MedCPT corpus indices.
+
+Only the new or changed trials of dataset/{corpus}/corpus.jsonl are tokenized and embedded;
+the replaced and withdrawn trials are tombstoned. Compaction that drops the tombstones
+is an explicit step.
+"""
+
+import json
+import numpy as np
+import os
+import sys
+
+from bm25 import BM25Index, tokenize_trial
+from corpus_utils import diff_corpus, get_entry_hash, get_file_fingerprint
+
+
+def get_medcpt_paths(corpus: str) -> dict:
+	return {
+		"embeds": f"trialgpt_retrieval/{corpus}_embeds.npy",
+		"nctids": f"trialgpt_retrieval/{corpus}_nctids.json",
+		"hashes": f"trialgpt_retrieval/{corpus}_hashes.json",
+		"deleted": f"trialgpt_retrieval/{corpus}_deleted.npy",
+	}
+
+
+def read_corpus_hashes(source_path: str) -> dict:
+	"""Dict{Str(NCTID): Str(content hash)} of a corpus file."""
+	nctid2hash = {}
+
+	with open(source_path, "r") as f:
+		for line in f:
+			entry = json.loads(line)
+			nctid2hash[entry["_id"]] = get_entry_hash(entry)
+
+	return nctid2hash
+
+
+def update_bm25_index(corpus: str):
+	"""Bring the BM25 index of a corpus up to date, returns (bm25, nctids)."""
+	index_dir = f"trialgpt_retrieval/bm25_index_{corpus}"
+	source_path = f"dataset/{corpus}/corpus.jsonl"
+
+	bm25, nctids = BM25Index.load(index_dir)
+
+	if BM25Index.is_cached(index_dir, source_path):
+		return bm25, nctids
+
+	source_fingerprint = get_file_fingerprint(source_path)
+	hashes = BM25Index.load_hashes(index_dir)
+
+	new_entries, stale_docs = diff_corpus(source_path, nctids, hashes, bm25.deleted)
+	print(f"BM25 index: {len(new_entries)} new or changed trials, {len(stale_docs)} tombstoned documents")
+
+	bm25 = bm25.add_documents([tokenize_trial(entry, bm25.tokenizer) for entry in new_entries], stale_docs)
+	nctids = nctids + [entry["_id"] for entry in new_entries]
+	hashes = hashes + [get_entry_hash(entry) for entry in new_entries]
+
+	bm25.save(index_dir, nctids, hashes, source_fingerprint)
+
+	return bm25, nctids
+
+
+def compact_bm25_index(corpus: str):
+	"""Drop the tombstoned documents of the BM25 index, returns (bm25, nctids)."""
+	index_dir = f"trialgpt_retrieval/bm25_index_{corpus}"
+
+	bm25, nctids = BM25Index.load(index_dir)
+	hashes = BM25Index.load_hashes(index_dir)
+	source_fingerprint = json.load(open(os.path.join(index_dir, "meta.json")))["source"]
+
+	bm25, keep = bm25.compact()
+	nctids = [nctid for nctid, kept in zip(nctids, keep) if kept]
+	hashes = [entry_hash for entry_hash, kept in zip(hashes, keep) if kept]
+
+	print(f"BM25 index: dropped {int(np.count_nonzero(~keep))} tombstoned documents")
+	bm25.save(index_dir, nctids, hashes, source_fingerprint)
+
+	return bm25, nctids
+
+
+def load_medcpt_cache(corpus: str):
+	"""Returns (embeds, nctids, hashes, deleted) of the cached MedCPT corpus embeddings."""
+	paths = get_medcpt_paths(corpus)
+
+	embeds = np.load(paths["embeds"], mmap_mode="r")
+	nctids = json.load(open(paths["nctids"]))
+
+	if os.path.exists(paths["deleted"]):
+		deleted = np.load(paths["deleted"])
+	else:
+		deleted = np.zeros(len(nctids), dtype=bool)
+
+	if os.path.exists(paths["hashes"]):
+		hashes = json.load(open(paths["hashes"]))
+	else:
+		# caches built before the hashes were recorded are assumed to match the current corpus
+		nctid2hash = read_corpus_hashes(f"dataset/{corpus}/corpus.jsonl")
+		hashes = [nctid2hash.get(nctid) for nctid in nctids]
+
+	return embeds, nctids, hashes, deleted
+
+
+def save_medcpt_cache(corpus: str, embeds: np.ndarray, nctids: list, hashes: list, deleted: np.ndarray):
+	paths = get_medcpt_paths(corpus)
+
+	# write next to the target and rename, the old embeddings may still be memory-mapped
+	tmp_path = paths["embeds"] + ".tmp.npy"
+	np.save(tmp_path, embeds)
+	os.replace(tmp_path, paths["embeds"])
+
+	with open(paths["nctids"], "w") as f:
+		json.dump(nctids, f, indent=4)
+
+	with open(paths["hashes"], "w") as f:
+		json.dump(hashes, f)
+
+	np.save(paths["deleted"], deleted)
+
+
+def update_medcpt_index(corpus: str, batch_size: int = 32, precision: str = "fp32"):
+	"""Embed only the new or changed trials and append them, returns (embeds, nctids, deleted)."""
+	from medcpt_encoder import encode_articles, get_device, load_article_encoder
+
+	embeds, nctids, hashes, deleted = load_medcpt_cache(corpus)
+
+	new_entries, stale_docs = diff_corpus(f"dataset/{corpus}/corpus.jsonl", nctids, hashes, deleted)
+	print(f"MedCPT index: {len(new_entries)} new or changed trials, {len(stale_docs)} tombstoned documents")
+
+	if len(new_entries) == 0 and len(stale_docs) == 0:
+		return np.asarray(embeds), nctids, deleted
+
+	deleted = np.concatenate([deleted, np.zeros(len(new_entries), dtype=bool)])
+	deleted[stale_docs] = True
+
+	if len(new_entries) > 0:
+		device = get_device()
+		model, tokenizer = load_article_encoder(device, precision)
+		new_embeds = encode_articles(new_entries, model, tokenizer, device, batch_size, precision)
+		embeds = np.concatenate([embeds, new_embeds])
+
+	nctids = nctids + [entry["_id"] for entry in new_entries]
+	hashes = hashes + [get_entry_hash(entry) for entry in new_entries]
+
+	embeds = np.asarray(embeds)
+	save_medcpt_cache(corpus, embeds, nctids, hashes, deleted)
+
+	return embeds, nctids, deleted
+
+
+def compact_medcpt_index(corpus: str):
+	"""Drop the tombstoned rows of the MedCPT corpus embeddings, returns (embeds, nctids, deleted)."""
+	embeds, nctids, hashes, deleted = load_medcpt_cache(corpus)
+	keep = ~deleted
+
+	embeds = np.asarray(embeds[keep])
+	nctids = [nctid for nctid, kept in zip(nctids, keep) if kept]
+	hashes = [entry_hash for entry_hash, kept in zip(hashes, keep) if kept]
+	deleted = np.zeros(len(nctids), dtype=bool)
+
+	print(f"MedCPT index: dropped {int(np.count_nonzero(~keep))} tombstoned documents")
+	save_medcpt_cache(corpus, embeds, nctids, hashes, deleted)
+
+	return embeds, nctids, deleted
+
+
+if __name__ == "__main__":
+	# syntax: python trialgpt_retrieval/update_index.py ${corpus} ${mode}
+	# ${mode} can be update (default, incremental indexing of new or changed trials) or compact
+	corpus = sys.argv[1]
+	mode = sys.argv[2] if len(sys.argv) > 2 else "update"
+
+	if not BM25Index.exists(f"trialgpt_retrieval/bm25_index_{corpus}") or not os.path.exists(get_medcpt_paths(corpus)["embeds"]):
+		raise FileNotFoundError(f"Please build the {corpus} indices with hybrid_fusion_retrieval.py first.")
+
+	if mode == "update":
+		update_bm25_index(corpus)
+		update_medcpt_index(corpus)
+	elif mode == "compact":
+		compact_bm25_index(corpus)
+		compact_medcpt_index(corpus)
+	else:
+		raise ValueError(f"Unknown mode: {mode}")
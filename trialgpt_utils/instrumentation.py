@@ -0,0 +1,332 @@
+__author__ = "qiao"
+
+"""
+Instrumentation of the LLM calls and the retrieval steps. Every LLM call is recorded with its
+prompt and completion tokens (from response.usage), latency, retries and errors, every parse
+failure of an LLM output is recorded, and the retrieval steps are timed. The records carry the
+(patient, trial, stage) labels set by the callers with labels(), and are aggregated into a summary
+report, the most expensive patients and trials, and histograms in the OpenMetrics text format
+(e.g., for the textfile collector of the Prometheus node exporter).
+"""
+
+import collections
+import contextlib
+import contextvars
+import json
+import math
+import numpy as np
+import os
+import sys
+import threading
+import time
+
+# the labels of the current task or thread: Dict{"patient_id", "trial_id", "stage": Str}
+LABELS = contextvars.ContextVar("trialgpt_labels", default={})
+
+# list prices in USD per 1M (prompt, completion) tokens, by model or deployment name
+PRICES = {
+	"gpt-4-turbo": (10.0, 30.0),
+	"gpt-4o": (5.0, 15.0),
+	"gpt-35-turbo": (0.5, 1.5),
+	"gpt-3.5-turbo": (0.5, 1.5),
+}
+
+# the upper bounds of the histogram buckets
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf]
+TOKEN_BUCKETS = [100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, math.inf]
+
+
+@contextlib.contextmanager
+def labels(**kwargs):
+	"""Label the LLM calls and the retrieval steps in the block, e.g., with labels(patient_id=..., trial_id=...)."""
+	token = LABELS.set({**LABELS.get(), **kwargs})
+
+	try:
+		yield
+
+	finally:
+		LABELS.reset(token)
+
+
+async def labeled(coro, **kwargs):
+	"""Await coro with the labels, for coroutines that asyncio.gather runs as separate tasks."""
+	with labels(**kwargs):
+		return await coro
+
+
+def get_histogram(values: list, buckets: list) -> list:
+	"""The cumulative counts of the values under each bucket bound."""
+	values = np.sort(np.asarray(values, dtype=np.float64))
+
+	return [int(np.searchsorted(values, bound, side="right")) for bound in buckets]
+
+
+class Instrumentation:
+	def __init__(self, prices: dict = None):
+		"""prices: Dict{Str(model): (USD per 1M prompt tokens, USD per 1M completion tokens)}, default PRICES."""
+		self.prices = PRICES if prices is None else prices
+		self.lock = threading.Lock()
+
+		# List[Dict], one per LLM call ("llm"), retrieval step ("step") or parse failure ("parse_failure")
+		self.records = []
+
+
+	def add(self, kind: str, default_stage: str, **fields):
+		record = {"kind": kind, "stage": default_stage, "patient_id": None, "trial_id": None}
+		record.update(LABELS.get())
+		record.update(fields)
+
+		with self.lock:
+			self.records.append(record)
+
+
+	def record_call(
+		self,
+		model: str,
+		latency: float,
+		wall: float = None,
+		prompt_tokens: int = 0,
+		completion_tokens: int = 0,
+		retries: int = 0,
+		cached: bool = False,
+		error: str = None,
+	):
+		"""
+		An LLM call: latency is the time of the API request, wall also includes the waits for the
+		concurrency and rate limits and the retries. Cached calls have no tokens and no latency.
+		"""
+		self.add(
+			"llm",
+			"llm",
+			model=model,
+			latency=latency,
+			wall=latency if wall is None else wall,
+			prompt_tokens=prompt_tokens,
+			completion_tokens=completion_tokens,
+			retries=retries,
+			cached=cached,
+			error=error,
+		)
+
+
+	def record_parse_failure(self, error: str = None):
+		"""An LLM output that does not follow the expected format."""
+		self.add("parse_failure", "llm", error=error)
+
+
+	@contextlib.contextmanager
+	def timer(self, stage: str):
+		"""Time a retrieval (or any other) step."""
+		start_time = time.perf_counter()
+
+		try:
+			yield
+
+		finally:
+			self.add("step", stage, stage=stage, latency=time.perf_counter() - start_time)
+
+
+	def get_cost(self, record: dict) -> float:
+		prompt_price, completion_price = self.prices.get(record.get("model"), (0.0, 0.0))
+
+		return (record["prompt_tokens"] * prompt_price + record["completion_tokens"] * completion_price) / 1e6
+
+
+	def reset(self):
+		with self.lock:
+			self.records = []
+
+
+	def summary(self) -> dict:
+		"""Dict{Str(stage): Dict{Str(metric): value}} aggregated over the records."""
+		with self.lock:
+			records = list(self.records)
+
+		stage2records = collections.defaultdict(list)
+		for record in records:
+			stage2records[record["stage"]].append(record)
+
+		output = {}
+
+		for stage, stage_records in sorted(stage2records.items()):
+			calls = [record for record in stage_records if record["kind"] == "llm"]
+			steps = [record for record in stage_records if record["kind"] == "step"]
+			timed = [record for record in calls if not record["cached"]] + steps
+			latencies = np.array([record["latency"] for record in timed], dtype=np.float64)
+
+			stats = {
+				"count": len(calls) + len(steps),
+				"latency_sum_s": float(latencies.sum()),
+				"latency_p50_s": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+				"latency_p99_s": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+			}
+
+			if calls:
+				stats.update({
+					"cached": sum(record["cached"] for record in calls),
+					"errors": sum(record["error"] is not None for record in calls),
+					"retries": sum(record["retries"] for record in calls),
+					"parse_failures": sum(record["kind"] == "parse_failure" for record in stage_records),
+					"prompt_tokens": sum(record["prompt_tokens"] for record in calls),
+					"completion_tokens": sum(record["completion_tokens"] for record in calls),
+					"wall_sum_s": float(sum(record["wall"] for record in calls)),
+					"cost_usd": sum(self.get_cost(record) for record in calls),
+				})
+
+			elif any(record["kind"] == "parse_failure" for record in stage_records):
+				stats["parse_failures"] = sum(record["kind"] == "parse_failure" for record in stage_records)
+
+			output[stage] = stats
+
+		return output
+
+
+	def top(self, key: str = "trial_id", n: int = 10) -> list:
+		"""
+		The n most expensive patients (key="patient_id") or trials (key="trial_id") by total tokens, as
+		List[(Str(id), Dict{"calls", "prompt_tokens", "completion_tokens", "latency_s", "cost_usd"})].
+		"""
+		with self.lock:
+			records = [record for record in self.records if record["kind"] == "llm" and record.get(key) is not None]
+
+		totals = collections.defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_s": 0.0, "cost_usd": 0.0})
+
+		for record in records:
+			total = totals[record[key]]
+			total["calls"] += 1
+			total["prompt_tokens"] += record["prompt_tokens"]
+			total["completion_tokens"] += record["completion_tokens"]
+			total["latency_s"] += record["latency"]
+			total["cost_usd"] += self.get_cost(record)
+
+		return sorted(totals.items(), key=lambda x: -(x[1]["prompt_tokens"] + x[1]["completion_tokens"]))[:n]
+
+
+	def report(self, n: int = 10) -> str:
+		"""The summary table by stage and the n most expensive patients and trials."""
+		lines = [f"{'stage':<24}{'count':>8}{'cached':>8}{'errors':>8}{'retries':>8}{'parse':>7}{'prompt tok':>12}{'compl tok':>11}{'p50 s':>9}{'p99 s':>9}{'cost $':>10}"]
+
+		for stage, stats in self.summary().items():
+			lines.append(
+				f"{stage:<24}{stats['count']:>8}{stats.get('cached', 0):>8}{stats.get('errors', 0):>8}{stats.get('retries', 0):>8}"
+				f"{stats.get('parse_failures', 0):>7}{stats.get('prompt_tokens', 0):>12}{stats.get('completion_tokens', 0):>11}"
+				f"{stats['latency_p50_s']:>9.3f}{stats['latency_p99_s']:>9.3f}{stats.get('cost_usd', 0):>10.4f}"
+			)
+
+		for key in ["patient_id", "trial_id"]:
+			top = self.top(key, n)
+
+			if top:
+				lines.append(f"Most expensive by {key}:")
+
+			for name, total in top:
+				lines.append(
+					f"  {name:<22}{total['calls']:>8} calls{total['prompt_tokens']:>10} + {total['completion_tokens']:<8} tokens"
+					f"{total['latency_s']:>9.1f} s{total['cost_usd']:>10.4f} $"
+				)
+
+		return "\n".join(lines)
+
+
+	def to_openmetrics(self) -> str:
+		"""The counters and the latency and token histograms by stage, in the OpenMetrics text format."""
+		with self.lock:
+			records = list(self.records)
+
+		lines = []
+
+		def add_histogram(name, unit, buckets, stage2values):
+			lines.append(f"# TYPE {name} histogram")
+			lines.append(f"# UNIT {name} {unit}")
+
+			for stage, values in sorted(stage2values.items()):
+				for bound, count in zip(buckets, get_histogram(values, buckets)):
+					le = "+Inf" if bound == math.inf else repr(float(bound))
+					lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {count}')
+
+				lines.append(f'{name}_count{{stage="{stage}"}} {len(values)}')
+				lines.append(f'{name}_sum{{stage="{stage}"}} {float(sum(values))}')
+
+		latencies = collections.defaultdict(list)
+		prompt_tokens = collections.defaultdict(list)
+		completion_tokens = collections.defaultdict(list)
+
+		for record in records:
+			if record["kind"] == "step" or (record["kind"] == "llm" and not record["cached"]):
+				latencies[record["stage"]].append(record["latency"])
+
+			if record["kind"] == "llm" and not record["cached"] and record["error"] is None:
+				prompt_tokens[record["stage"]].append(record["prompt_tokens"])
+				completion_tokens[record["stage"]].append(record["completion_tokens"])
+
+		add_histogram("trialgpt_latency_seconds", "seconds", LATENCY_BUCKETS, latencies)
+		add_histogram("trialgpt_prompt_tokens", "tokens", TOKEN_BUCKETS, prompt_tokens)
+		add_histogram("trialgpt_completion_tokens", "tokens", TOKEN_BUCKETS, completion_tokens)
+
+		counters = [
+			("trialgpt_llm_calls", "count"),
+			("trialgpt_llm_cached", "cached"),
+			("trialgpt_llm_errors", "errors"),
+			("trialgpt_llm_retries", "retries"),
+			("trialgpt_llm_parse_failures", "parse_failures"),
+			("trialgpt_llm_cost_usd", "cost_usd"),
+		]
+		summary = self.summary()
+
+		for name, metric in counters:
+			lines.append(f"# TYPE {name} counter")
+
+			for stage, stats in summary.items():
+				if metric in stats and (metric != "count" or "prompt_tokens" in stats):
+					lines.append(f'{name}_total{{stage="{stage}"}} {stats[metric]}')
+
+		lines.append("# EOF")
+
+		return "\n".join(lines) + "\n"
+
+
+	def save(self, path: str):
+		"""The records and the summary as JSON, and the OpenMetrics text to $TRIALGPT_OPENMETRICS if set."""
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		with self.lock:
+			records = list(self.records)
+
+		with open(path, "w") as f:
+			json.dump({"summary": self.summary(), "records": records}, f, indent=4)
+
+		openmetrics_path = os.getenv("TRIALGPT_OPENMETRICS")
+
+		if openmetrics_path:
+			# written then renamed, so that a scraper never reads a partial file
+			with open(openmetrics_path + ".tmp", "w") as f:
+				f.write(self.to_openmetrics())
+			os.replace(openmetrics_path + ".tmp", openmetrics_path)
+
+
+	@classmethod
+	def load(cls, path: str, prices: dict = None):
+		instrumentation = cls(prices)
+		instrumentation.records = json.load(open(path))["records"]
+
+		return instrumentation
+
+
+# the process-wide instrumentation, shared by the LLM clients and the retrievers
+metrics = Instrumentation()
+
+
+if __name__ == "__main__":
+	# report on the metrics saved by a run, e.g., results/metrics_matching_sigir_gpt-4-turbo.json
+	# syntax: python trialgpt_utils/instrumentation.py ${metrics_path} ${top_n} ${openmetrics_path}
+	metrics_path = sys.argv[1]
+	top_n = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+	openmetrics_path = sys.argv[3] if len(sys.argv) > 3 else None
+
+	instrumentation = Instrumentation.load(metrics_path)
+	print(instrumentation.report(top_n))
+
+	if openmetrics_path:
+		with open(openmetrics_path, "w") as f:
+			f.write(instrumentation.to_openmetrics())
@@ -0,0 +1,140 @@
+__author__ = "qiao"
+
+"""
+Content-addressed SQLite cache of LLM responses, keyed by a hash of (model, messages, parameters),
+with size-based LRU eviction and hit/miss counters. The total size is kept as a running count, and
+the last-used times of the hits are written in batches rather than one transaction per hit.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+
+def get_request_key(model: str, messages: list, params: dict) -> str:
+	request = {"model": model, "messages": messages, "params": params}
+
+	return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+	def __init__(self, path: str, max_bytes: int = 2 * 1024 ** 3):
+		"""max_bytes bounds the total size of the cached responses, the least recently used are evicted first."""
+		self.path = path
+		self.max_bytes = max_bytes
+
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		# several processes can share the cache
+		self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+		self.conn.commit()
+
+		self.hits = 0
+		self.misses = 0
+
+		# the running total size, recounted from the table before an eviction since other processes also write
+		self.size = self.get_size()
+
+		# Dict{Str(key): Float(last_used)} of the hits not written yet
+		self.touches = {}
+		self.max_touches = 256
+		atexit.register(self.flush)
+
+
+	def get(self, key: str):
+		"""The cached response content, or None."""
+		row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+
+		if row is None:
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		self.touches[key] = time.time()
+
+		if len(self.touches) >= self.max_touches:
+			self.flush()
+
+		return row[0]
+
+
+	def flush(self):
+		"""Write the last-used times of the recent hits."""
+		if not self.touches:
+			return
+
+		self.conn.executemany("UPDATE responses SET last_used = ? WHERE key = ?", [(last_used, key) for key, last_used in self.touches.items()])
+		self.conn.commit()
+		self.touches = {}
+
+
+	def put(self, key: str, value: str):
+		size = len(value.encode("utf-8"))
+		self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, value, size, time.time()))
+		self.conn.commit()
+		self.size += size
+
+		if self.size > self.max_bytes:
+			self.evict()
+
+
+	def delete(self, key: str):
+		"""Drop a response, e.g., one that the caller cannot parse."""
+		row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+		self.touches.pop(key, None)
+
+		if row is None:
+			return
+
+		self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+		self.conn.commit()
+		self.size -= row[0]
+
+
+	def get_size(self) -> int:
+		return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+
+	def evict(self):
+		"""Drop the least recently used responses down to 90% of max_bytes once the cache is full."""
+		self.flush()
+		total = self.size = self.get_size()
+
+		if total <= self.max_bytes:
+			return
+
+		target = total - int(0.9 * self.max_bytes)
+		freed = 0
+		keys = []
+
+		for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+			if freed >= target:
+				break
+
+			keys.append(key)
+			freed += size
+
+		self.conn.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key in keys])
+		self.conn.commit()
+		self.size = total - freed
+
+
+	def stats(self) -> str:
+		self.flush()
+		num_entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+		hit_rate = self.hits / max(self.hits + self.misses, 1)
+
+		return f"LLM cache {self.path}: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), {num_entries} entries, {self.get_size() / 1024 ** 2:.1f} MB"
+
+
+if __name__ == "__main__":
+	# syntax: python trialgpt_utils/llm_cache.py ${cache_path}
+	print(LLMCache(sys.argv[1]).stats())
@@ -0,0 +1,158 @@
+__author__ = "qiao"
+
+"""
+The single LLM client of the matching, aggregation and keyword generation steps.
+Deterministic (temperature=0) requests are served from a shared response cache, and only the
+responses that pass the validate callback of the caller (e.g., that parse) are cached.
+"""
+
+import os
+import time
+
+from openai import AzureOpenAI, OpenAI
+
+from instrumentation import metrics
+from llm_cache import LLMCache, get_request_key
+from llm_executor import get_retry_delay, is_retryable
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "results", "llm_cache.sqlite3")
+
+
+def get_sync_client():
+	"""
+	An OpenAI-compatible server if OPENAI_BASE_URL is set (e.g., the mock server), otherwise Azure.
+	The retries are left to LLMClient.chat, so that they are recorded.
+	"""
+	if os.getenv("OPENAI_BASE_URL"):
+		return OpenAI(
+			base_url=os.getenv("OPENAI_BASE_URL"),
+			api_key=os.getenv("OPENAI_API_KEY", "mock"),
+			max_retries=0,
+		)
+
+	return AzureOpenAI(
+		api_version="2023-09-01-preview",
+		azure_endpoint=os.getenv("OPENAI_ENDPOINT"),
+		api_key=os.getenv("OPENAI_API_KEY"),
+		max_retries=0,
+	)
+
+
+class LLMClient:
+	def __init__(
+		self,
+		cache_path: str = None,
+		max_cache_bytes: int = None,
+		executor=None,
+		max_retries: int = 6,
+		base_delay: float = 1,
+		max_delay: float = 60,
+	):
+		"""
+		cache_path defaults to $TRIALGPT_LLM_CACHE or results/llm_cache.sqlite3, and the cache
+		is disabled with TRIALGPT_LLM_CACHE=off. executor (an LLMExecutor) serves achat(), and
+		chat() retries the 429 and 5xx errors as the executor does.
+		"""
+		cache_path = cache_path or os.getenv("TRIALGPT_LLM_CACHE", DEFAULT_CACHE_PATH)
+		max_cache_bytes = max_cache_bytes or int(os.getenv("TRIALGPT_LLM_CACHE_BYTES", 2 * 1024 ** 3))
+
+		self.cache = None if cache_path == "off" else LLMCache(cache_path, max_cache_bytes)
+		self.executor = executor
+		self.client = None
+		self.max_retries = max_retries
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+
+
+	def lookup(self, model: str, messages: list, params: dict, validate=None):
+		"""
+		Returns (key, cached content), the key is None for requests that are not cached. A cached
+		content that fails validate (e.g., cached before the check) is dropped and requested again.
+		"""
+		if self.cache is None or params.get("temperature", 1) != 0:
+			return None, None
+
+		key = get_request_key(model, messages, params)
+		content = self.cache.get(key)
+
+		if content is not None and validate is not None and not validate(content):
+			self.cache.delete(key)
+			content = None
+
+		if content is not None:
+			metrics.record_call(model, 0.0, cached=True)
+
+		return key, content
+
+
+	def store(self, key: str, content: str, validate=None):
+		if key is not None and (validate is None or validate(content)):
+			self.cache.put(key, content)
+
+
+	def chat(self, model: str, messages: list, validate=None, **params) -> str:
+		"""
+		The stripped message content of a chat completion. validate(content) -> Bool decides if the
+		content is cached, so that a malformed output is not replayed from the cache.
+		"""
+		key, content = self.lookup(model, messages, params, validate)
+
+		if content is not None:
+			return content
+
+		# created on the first request, so that cached runs need no API configuration
+		if self.client is None:
+			self.client = get_sync_client()
+
+		start_time = time.perf_counter()
+
+		for attempt in range(self.max_retries + 1):
+			request_time = time.perf_counter()
+
+			try:
+				response = self.client.chat.completions.create(model=model, messages=messages, **params)
+			except Exception as error:
+				if not is_retryable(error) or attempt == self.max_retries:
+					metrics.record_call(
+						model,
+						time.perf_counter() - request_time,
+						wall=time.perf_counter() - start_time,
+						retries=attempt,
+						error=type(error).__name__,
+					)
+					raise
+
+				time.sleep(get_retry_delay(error, attempt, self.base_delay, self.max_delay))
+				continue
+
+			break
+
+		metrics.record_call(
+			model,
+			time.perf_counter() - request_time,
+			wall=time.perf_counter() - start_time,
+			prompt_tokens=response.usage.prompt_tokens if response.usage is not None else 0,
+			completion_tokens=response.usage.completion_tokens if response.usage is not None else 0,
+			retries=attempt,
+		)
+		content = response.choices[0].message.content.strip()
+		self.store(key, content, validate)
+
+		return content
+
+
+	async def achat(self, model: str, messages: list, validate=None, **params) -> str:
+		"""Same as chat, through the asynchronous executor."""
+		key, content = self.lookup(model, messages, params, validate)
+
+		if content is not None:
+			return content
+
+		content = await self.executor.chat(model, messages, **params)
+		self.store(key, content, validate)
+
+		return content
+
+
+	def stats(self) -> str:
+		return self.cache.stats() if self.cache is not None else "LLM cache disabled"
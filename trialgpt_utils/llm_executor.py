@@ -0,0 +1,177 @@
+__author__ = "qiao"
+
+"""
+Asynchronous LLM execution with bounded concurrency, token-bucket limits on the
+requests and tokens per minute, and exponential backoff on 429 and 5xx errors.
+"""
+
+import asyncio
+import os
+import random
+import time
+
+import openai
+from openai import AsyncAzureOpenAI, AsyncOpenAI
+
+from instrumentation import metrics
+
+
+def get_async_client():
+	"""
+	An OpenAI-compatible server if OPENAI_BASE_URL is set (e.g., the mock server), otherwise Azure.
+	The retries are left to LLMExecutor.
+	"""
+	if os.getenv("OPENAI_BASE_URL"):
+		return AsyncOpenAI(
+			base_url=os.getenv("OPENAI_BASE_URL"),
+			api_key=os.getenv("OPENAI_API_KEY", "mock"),
+			max_retries=0,
+		)
+
+	return AsyncAzureOpenAI(
+		api_version="2023-09-01-preview",
+		azure_endpoint=os.getenv("OPENAI_ENDPOINT"),
+		api_key=os.getenv("OPENAI_API_KEY"),
+		max_retries=0,
+	)
+
+
+def is_retryable(error: Exception) -> bool:
+	if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+		return True
+
+	return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def get_retry_delay(error: Exception, attempt: int, base_delay: float, max_delay: float) -> float:
+	"""The retry-after header of the server if any, otherwise exponential backoff with jitter."""
+	response = getattr(error, "response", None)
+	retry_after = response.headers.get("retry-after") if response is not None else None
+
+	try:
+		return min(float(retry_after), max_delay)
+	except (TypeError, ValueError):
+		return min(base_delay * 2 ** attempt, max_delay) * random.uniform(0.5, 1)
+
+
+def estimate_tokens(messages: list) -> int:
+	"""A rough prompt size for rate limiting, about 4 characters per token."""
+	return sum(len(message["content"]) // 4 + 4 for message in messages)
+
+
+class TokenBucket:
+	"""A bucket of per_minute units that refills continuously, None means no limit."""
+
+	def __init__(self, per_minute: float = None):
+		self.per_minute = per_minute
+		self.tokens = per_minute or 0
+		self.updated = time.monotonic()
+		self.lock = asyncio.Lock()
+
+
+	def refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * self.per_minute / 60)
+		self.updated = now
+
+
+	async def acquire(self, amount: float = 1):
+		if self.per_minute is None:
+			return
+
+		# larger requests than the bucket would wait forever
+		amount = min(amount, self.per_minute)
+
+		# the lock keeps the waiting requests in order
+		async with self.lock:
+			self.refill()
+
+			while self.tokens < amount:
+				await asyncio.sleep((amount - self.tokens) * 60 / self.per_minute)
+				self.refill()
+
+			self.tokens -= amount
+
+
+	def adjust(self, amount: float):
+		"""Correct an estimate once the actual usage is known, a negative balance delays the next requests."""
+		if self.per_minute is not None:
+			self.tokens -= amount
+
+
+class LLMExecutor:
+	def __init__(
+		self,
+		client=None,
+		max_concurrency: int = 8,
+		rpm: float = None,
+		tpm: float = None,
+		max_retries: int = 6,
+		base_delay: float = 1,
+		max_delay: float = 60,
+		max_completion_tokens: int = 1024,
+	):
+		"""
+		max_concurrency is the number of requests in flight, rpm and tpm are the requests and
+		tokens per minute allowed by the deployment (None for no limit), and max_completion_tokens
+		is the completion size reserved in the TPM bucket when a request does not set max_tokens.
+		"""
+		self.client = client or get_async_client()
+		self.semaphore = asyncio.Semaphore(max_concurrency)
+		self.request_bucket = TokenBucket(rpm)
+		self.token_bucket = TokenBucket(tpm)
+		self.max_retries = max_retries
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.max_completion_tokens = max_completion_tokens
+
+
+	async def create(self, model: str, messages: list, **kwargs):
+		"""client.chat.completions.create with the limits and the retries, returns the response."""
+		reserved = estimate_tokens(messages) + kwargs.get("max_tokens", self.max_completion_tokens)
+		start_time = request_time = time.perf_counter()
+
+		for attempt in range(self.max_retries + 1):
+			await self.request_bucket.acquire(1)
+			await self.token_bucket.acquire(reserved)
+
+			try:
+				async with self.semaphore:
+					request_time = time.perf_counter()
+					response = await self.client.chat.completions.create(model=model, messages=messages, **kwargs)
+
+			except Exception as error:
+				if not is_retryable(error) or attempt == self.max_retries:
+					metrics.record_call(
+						model,
+						time.perf_counter() - request_time,
+						wall=time.perf_counter() - start_time,
+						retries=attempt,
+						error=type(error).__name__,
+					)
+					raise
+
+				await asyncio.sleep(get_retry_delay(error, attempt, self.base_delay, self.max_delay))
+				continue
+
+			usage = response.usage
+			metrics.record_call(
+				model,
+				time.perf_counter() - request_time,
+				wall=time.perf_counter() - start_time,
+				prompt_tokens=usage.prompt_tokens if usage is not None else 0,
+				completion_tokens=usage.completion_tokens if usage is not None else 0,
+				retries=attempt,
+			)
+
+			if usage is not None:
+				self.token_bucket.adjust(usage.total_tokens - reserved)
+
+			return response
+
+
+	async def chat(self, model: str, messages: list, **kwargs) -> str:
+		"""The stripped message content of a chat completion."""
+		response = await self.create(model, messages, **kwargs)
+
+		return response.choices[0].message.content.strip()
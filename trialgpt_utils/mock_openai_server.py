@@ -0,0 +1,149 @@
+__author__ = "qiao"
+
+"""
+A local OpenAI-compatible chat completion server for testing the LLM clients without
+API calls. It answers with a fixed (or criterion-level) JSON output after a configurable
+latency, and can fail a share of the requests with 429 or 500 errors. The requests and the
+injected errors are counted in MockHandler.counts.
+"""
+
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import sys
+import threading
+import time
+
+
+def get_mock_content(messages: list) -> str:
+	"""A parseable output for each TrialGPT prompt type, based on the prompt text."""
+	system = messages[0]["content"] if messages else ""
+	user = messages[-1]["content"] if messages else ""
+
+	if "key conditions" in system:
+		return json.dumps({"summary": "mock summary", "conditions": ["mock condition"]})
+
+	if "relevance score" in system or "eligibility score" in system:
+		return json.dumps({"relevance_explanation": "mock", "relevance_score_R": 50.0, "eligibility_explanation": "mock", "eligibility_score_E": 0.0})
+
+	# matching: one label per numbered criterion of the trial(s)
+	inc_exc = "inclusion" if "the inclusion criteria of" in system else "exclusion"
+
+	if "several clinical trials" in system:
+		sections = re.split(r"Here is the clinical trial (\S+):\n", user)[1:]
+		return json.dumps({
+			nctid: get_mock_criteria(section, inc_exc) for nctid, section in zip(sections[::2], sections[1::2])
+		})
+
+	return json.dumps(get_mock_criteria(user, inc_exc))
+
+
+def get_mock_criteria(trial_text: str, inc_exc: str) -> dict:
+	label = "included" if inc_exc == "inclusion" else "not excluded"
+	criteria_text = trial_text.split(f"{inc_exc.capitalize()} criteria:")[-1].split("Here is the patient note")[0]
+	criterion_ids = re.findall(r"^\s*(\d+)\. ", criteria_text, flags=re.MULTILINE)
+
+	return {idx: ["mock reasoning", [0], label] for idx in criterion_ids}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+	# set by serve()
+	latency = 0.0
+	error_rate = 0.0
+	rate_limit_share = 0.5
+
+	counts = collections.Counter()
+	lock = threading.Lock()
+
+	def log_message(self, format, *args):
+		pass
+
+
+	def count(self, key: str):
+		with self.lock:
+			self.counts[key] += 1
+
+
+	def send_json(self, status: int, payload: dict, headers: dict = {}):
+		body = json.dumps(payload).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		for key, value in headers.items():
+			self.send_header(key, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+
+	def do_POST(self):
+		# both /v1/chat/completions and the Azure /openai/deployments/{model}/chat/completions
+		if not self.path.split("?")[0].endswith("/chat/completions"):
+			self.send_json(404, {"error": {"message": "not found"}})
+			return
+
+		request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+		time.sleep(self.latency)
+
+		self.count("requests")
+
+		if random.random() < self.error_rate:
+			if random.random() < self.rate_limit_share:
+				self.count("429")
+				self.send_json(429, {"error": {"message": "rate limited"}}, {"retry-after": "0.1"})
+			else:
+				self.count("500")
+				self.send_json(500, {"error": {"message": "server error"}})
+			return
+
+		messages = request.get("messages", [])
+		content = get_mock_content(messages)
+		prompt_tokens = sum(len(message["content"]) // 4 for message in messages)
+		completion_tokens = len(content) // 4
+
+		self.send_json(200, {
+			"id": "chatcmpl-mock",
+			"object": "chat.completion",
+			"created": int(time.time()),
+			"model": request.get("model", "mock"),
+			"choices": [{
+				"index": 0,
+				"message": {"role": "assistant", "content": content},
+				"finish_reason": "stop",
+			}],
+			"usage": {
+				"prompt_tokens": prompt_tokens,
+				"completion_tokens": completion_tokens,
+				"total_tokens": prompt_tokens + completion_tokens,
+			},
+		})
+
+
+def serve(port: int = 8000, latency: float = 0.0, error_rate: float = 0.0, background: bool = False, rate_limit_share: float = 0.5):
+	"""
+	Start the server, with background=True it runs in a daemon thread and the server is returned.
+	rate_limit_share is the share of the injected errors that are 429 (the others are 500).
+	Port 0 picks a free port, see server.server_address.
+	"""
+	MockHandler.latency = latency
+	MockHandler.error_rate = error_rate
+	MockHandler.rate_limit_share = rate_limit_share
+	server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+
+	if background:
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		return server
+
+	server.serve_forever()
+
+
+if __name__ == "__main__":
+	# syntax: python trialgpt_utils/mock_openai_server.py ${port} ${latency_seconds} ${error_rate}
+	# then set OPENAI_BASE_URL=http://127.0.0.1:${port}/v1
+	port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+	latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+	error_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+
+	print(f"Serving the mock OpenAI API at http://127.0.0.1:{port}/v1")
+	serve(port, latency, error_rate)
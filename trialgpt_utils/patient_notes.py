@@ -0,0 +1,197 @@
+__author__ = "qiao"
+
+"""
+Shared preprocessing of the patient notes: sentence segmentation, the added consent sentence,
+and the sentence numbering used by the matching and aggregation prompts. The numbered notes
+and their sentence offsets are cached in SQLite by patient ID and note hash, so that a restart
+does not segment the notes again and the evidence sentence IDs of the matching outputs
+(preds[1]) can be resolved back to character spans of the original note.
+"""
+
+import hashlib
+import json
+from nltk.tokenize import sent_tokenize
+import os
+import re
+import sqlite3
+import sys
+import time
+
+CONSENT_SENTENCE = "The patient will provide informed consent, and will comply with the trial protocol without any practical issues."
+
+# a sentence ends at [.!?] followed by whitespace and an uppercase letter, a digit or an opening bracket,
+# unless the period closes a common abbreviation or an initial
+ABBREVIATIONS = r"(?<!\bDr\.)(?<!\bMr\.)(?<!\bMs\.)(?<!\bMrs\.)(?<!\bSt\.)(?<!\bvs\.)(?<!\be\.g\.)(?<!\bi\.e\.)(?<!\b[A-Z]\.)"
+SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*" + ABBREVIATIONS + r"(?=\s+[A-Z0-9\"'(\[])")
+
+
+def get_spans(note: str, sents: list) -> list:
+	"""Character spans of the sentences in the note, the segmenters only drop the whitespace between them."""
+	spans = []
+	pos = 0
+
+	for sent in sents:
+		start = note.find(sent, pos)
+
+		if start < 0:
+			spans.append(None)
+			continue
+
+		spans.append((start, start + len(sent)))
+		pos = start + len(sent)
+
+	return spans
+
+
+def segment_punkt(note: str) -> list:
+	"""NLTK Punkt, as in the original scripts."""
+	return sent_tokenize(note)
+
+
+def segment_regex(note: str) -> list:
+	"""A single-pass regex segmenter, faster than Punkt but without its learned abbreviations."""
+	sents = []
+	start = 0
+
+	for match in SENTENCE_END.finditer(note):
+		sents.append(note[start : match.end()].strip())
+		start = match.end()
+
+	sents.append(note[start:].strip())
+
+	return [sent for sent in sents if sent]
+
+
+# Dict{Str(name): Callable[Str(note), List[Str(sentence)]]}, other segmenters can be added here
+SEGMENTERS = {
+	"punkt": segment_punkt,
+	"regex": segment_regex,
+}
+
+
+def format_note(sents: list) -> str:
+	"""The sentence-numbered note of the prompts, with the consent sentence last."""
+	sents = sents + [CONSENT_SENTENCE]
+
+	return "\n".join(f"{idx}. {sent}" for idx, sent in enumerate(sents))
+
+
+class PatientNotes:
+	def __init__(self, path: str = "results/patient_notes.sqlite3", segmenter: str = "punkt"):
+		"""path=None keeps the notes in memory only."""
+		self.segmenter = segmenter
+		self.segment = SEGMENTERS[segmenter]
+
+		if path and os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		# several processes can share the cache
+		self.conn = sqlite3.connect(path or ":memory:", timeout=60, check_same_thread=False)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS notes (patient_id TEXT, key TEXT, value TEXT, spans TEXT, PRIMARY KEY (patient_id, key))")
+		self.conn.commit()
+
+		# Dict{(Str(patient_id), Str(key)): (Str(numbered note), List[span])}
+		self.notes = {}
+
+		self.hits = 0
+		self.misses = 0
+
+
+	def get_key(self, note: str) -> str:
+		"""The note hash, which also covers the segmenter."""
+		return hashlib.sha256(f"{self.segmenter}\0{note}".encode("utf-8")).hexdigest()
+
+
+	def load(self, patient_id: str, note: str) -> tuple:
+		"""(numbered note, sentence spans), the span of the consent sentence is None."""
+		key = self.get_key(note)
+
+		if (patient_id, key) in self.notes:
+			self.hits += 1
+			return self.notes[(patient_id, key)]
+
+		row = self.conn.execute("SELECT value, spans FROM notes WHERE patient_id = ? AND key = ?", (patient_id, key)).fetchone()
+
+		if row is not None:
+			self.hits += 1
+			value, spans = row[0], [tuple(span) if span else None for span in json.loads(row[1])]
+
+		else:
+			self.misses += 1
+			sents = self.segment(note)
+			value = format_note(sents)
+			spans = get_spans(note, sents) + [None]
+
+			self.conn.execute("INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?)", (patient_id, key, value, json.dumps(spans)))
+			self.conn.commit()
+
+		self.notes[(patient_id, key)] = (value, spans)
+
+		return value, spans
+
+
+	def get(self, patient_id: str, note: str) -> str:
+		"""The sentence-numbered note used by the matching and aggregation prompts."""
+		return self.load(patient_id, note)[0]
+
+
+	def resolve_evidence(self, patient_id: str, note: str, sent_ids: list) -> list:
+		"""
+		List[(Int(sentence id), span)] of the evidence sentence ids of a matching output, the span is
+		None for the consent sentence and for ids that are not in the note.
+		"""
+		spans = self.load(patient_id, note)[1]
+		output = []
+
+		for sent_id in sent_ids:
+			try:
+				sent_id = int(sent_id)
+			except (TypeError, ValueError):
+				continue
+
+			output.append((sent_id, spans[sent_id] if 0 <= sent_id < len(spans) else None))
+
+		return output
+
+
+	def stats(self) -> dict:
+		return {"hits": self.hits, "misses": self.misses}
+
+
+if __name__ == "__main__":
+	# benchmark the segmenters against NLTK Punkt on the patient notes of a corpus
+	# syntax: python trialgpt_utils/patient_notes.py ${corpus} ${segmenters}
+	# ${segmenters} is a comma-separated list of names in SEGMENTERS (default: all)
+	corpus = sys.argv[1]
+	segmenters = sys.argv[2].split(",") if len(sys.argv) > 2 else list(SEGMENTERS.keys())
+
+	with open(f"dataset/{corpus}/queries.jsonl", "r") as f:
+		notes = [json.loads(line)["text"] for line in f]
+
+	reference = [segment_punkt(note) for note in notes]
+
+	print(f"{'segmenter':<12}{'ms/note':>10}{'sentences':>11}{'same as punkt':>15}")
+
+	for name in segmenters:
+		segment = SEGMENTERS[name]
+
+		start_time = time.time()
+		outputs = [segment(note) for note in notes]
+		elapsed = time.time() - start_time
+
+		same = sum(output == sents for output, sents in zip(outputs, reference)) / max(len(notes), 1)
+		num_sents = sum(len(output) for output in outputs)
+
+		print(f"{name:<12}{1000 * elapsed / max(len(notes), 1):>10.3f}{num_sents:>11}{same:>15.1%}")
+
+	# the cost of a cached lookup, as on a restart
+	cache = PatientNotes(path=None)
+	for idx, note in enumerate(notes):
+		cache.get(str(idx), note)
+
+	cache.notes = {}
+	start_time = time.time()
+	for idx, note in enumerate(notes):
+		cache.get(str(idx), note)
+	print(f"cached      {1000 * (time.time() - start_time) / max(len(notes), 1):>10.3f} ms/note ({cache.stats()})")
@@ -0,0 +1,167 @@
+__author__ = "qiao"
+
+"""
+Token budgets for the matching and aggregation prompts. The prompts are counted with tiktoken
+if it is installed (otherwise about 4 characters per token), and a prompt over the budget is
+rendered again at increasing compaction levels, which truncate the lowest-value fields first
+(e.g., the tail of the brief summary, then the reasoning of the "not applicable" criteria in
+the aggregation), until it fits. The criteria themselves are never dropped, since the outputs
+refer to them by number. The tokens saved are counted by stage.
+"""
+
+import os
+import sys
+import threading
+
+try:
+	import tiktoken
+	ENCODING = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+	ENCODING = None
+
+# the marker of a truncated field
+ELLIPSIS = " ..."
+
+
+def count_tokens(text: str) -> int:
+	if ENCODING is None:
+		return len(text) // 4
+
+	return len(ENCODING.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: list) -> int:
+	"""The prompt tokens of chat messages, with the per-message overhead of the chat format."""
+	return sum(count_tokens(message["content"]) + 4 for message in messages)
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+	"""The head of the text within max_tokens, with an ellipsis if anything was cut."""
+	if max_tokens is None or count_tokens(text) <= max_tokens:
+		return text
+
+	if max_tokens <= 0:
+		return ELLIPSIS.strip()
+
+	if ENCODING is None:
+		head = text[: 4 * max_tokens]
+	else:
+		head = ENCODING.decode(ENCODING.encode(text, disallowed_special=())[:max_tokens])
+
+	# cut at a word boundary when there is one
+	if " " in head:
+		head = head[: head.rindex(" ")]
+
+	return head.rstrip() + ELLIPSIS
+
+
+class PromptBudget:
+	def __init__(self, max_tokens: int = None):
+		"""max_tokens is the prompt budget of each call, None for no limit."""
+		self.max_tokens = max_tokens
+		self.lock = threading.Lock()
+
+		# Dict{Str(stage): Dict{Str(counter): Int}}
+		self.stats = {}
+
+
+	def fit(self, stage: str, render, levels: list) -> list:
+		"""
+		render(**level) returns the messages of a prompt at a compaction level, levels are ordered
+		from the full prompt ({}) to the most compact one. Returns the messages of the first level
+		within the budget, or of the last level if none is.
+		"""
+		messages = render(**levels[0])
+		full_tokens = count_message_tokens(messages)
+		tokens = full_tokens
+		level = 0
+
+		if self.max_tokens is not None:
+			while tokens > self.max_tokens and level < len(levels) - 1:
+				level += 1
+				messages = render(**levels[level])
+				tokens = count_message_tokens(messages)
+
+		with self.lock:
+			stats = self.stats.setdefault(stage, {"prompts": 0, "compacted": 0, "over_budget": 0, "full_tokens": 0, "tokens": 0})
+			stats["prompts"] += 1
+			stats["compacted"] += level > 0
+			stats["over_budget"] += self.max_tokens is not None and tokens > self.max_tokens
+			stats["full_tokens"] += full_tokens
+			stats["tokens"] += tokens
+
+		return messages
+
+
+	def report(self, name: str = "") -> str:
+		"""The prompts compacted and the tokens saved by stage, e.g., for a cohort."""
+		lines = []
+		prefix = f"{name} " if name else ""
+
+		for stage, stats in sorted(self.stats.items()):
+			saved = stats["full_tokens"] - stats["tokens"]
+			lines.append(
+				f"{prefix}{stage}: {stats['compacted']} / {stats['prompts']} prompts compacted to {self.max_tokens} tokens, "
+				f"{saved} / {stats['full_tokens']} tokens saved ({saved / max(stats['full_tokens'], 1):.1%}), "
+				f"{stats['over_budget']} still over the budget"
+			)
+
+		return "\n".join(lines)
+
+
+if __name__ == "__main__":
+	# the tokens a budget saves on the prompts of cohorts, without any API calls
+	# syntax: python trialgpt_utils/prompt_budget.py ${corpora} ${max_tokens} ${model}
+	# the matching prompts are built from dataset/${corpus}/retrieved_trials.json, and the aggregation
+	# prompts from results/matching_results_${corpus}_${model}.json if it exists
+	import importlib.util
+	import json
+
+	root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+	def load_module(name, path):
+		spec = importlib.util.spec_from_file_location(name, path)
+		module = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(module)
+
+		return module
+
+	corpora = sys.argv[1].split(",")
+	max_tokens = int(sys.argv[2])
+	model = sys.argv[3] if len(sys.argv) > 3 else "gpt-4-turbo"
+
+	# no API client is created, the cache is left alone
+	os.environ.setdefault("TRIALGPT_LLM_CACHE", "off")
+	matching = load_module("trialgpt_matching_main", os.path.join(root, "trialgpt_matching", "TrialGPT.py"))
+	ranking = load_module("trialgpt_ranking_main", os.path.join(root, "trialgpt_ranking", "TrialGPT.py"))
+
+	from patient_notes import PatientNotes
+	from trial_store import TrialStore
+
+	patient_notes = PatientNotes()
+	trial_store = TrialStore()
+
+	print(f"Tokens counted with {'tiktoken cl100k_base' if ENCODING else '4 characters per token'}")
+
+	for corpus in corpora:
+		budget = PromptBudget(max_tokens)
+		id2patient = {}
+
+		for instance in json.load(open(f"dataset/{corpus}/retrieved_trials.json")):
+			patient = patient_notes.get(instance["patient_id"], instance["patient"])
+			id2patient[instance["patient_id"]] = patient
+
+			for label in ["2", "1", "0"]:
+				for trial in trial_store.resolve(instance.get(label, [])):
+					for inc_exc in ["inclusion", "exclusion"]:
+						matching.get_matching_messages(trial, inc_exc, patient, prompt_budget=budget)
+
+		matching_results_path = f"results/matching_results_{corpus}_{model}.json"
+
+		if os.path.exists(matching_results_path):
+			for patient_id, label2trials in json.load(open(matching_results_path)).items():
+				for trial_id, trial_results in (item for trials in label2trials.values() for item in trials.items()):
+					if type(trial_results) is dict and patient_id in id2patient and trial_id in trial_store:
+						ranking.get_aggregation_messages(id2patient[patient_id], trial_results, trial_store[trial_id], prompt_budget=budget)
+
+		print(budget.report(corpus))
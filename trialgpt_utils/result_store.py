@@ -0,0 +1,173 @@
+__author__ = "qiao"
+
+"""
+Crash-safe append-only store of the LLM results, one JSONL record per (stage, patient, label, trial).
+Each record is flushed when written and fsynced in batches; a run resumes by streaming the records
+back, and the nested JSON layout used by rank_results.py is exported on demand.
+"""
+
+import json
+import os
+import sys
+import time
+
+
+class ResultStore:
+	def __init__(self, path: str, stage: str, sync_every: int = 64, sync_interval: float = 5.0):
+		"""
+		stage is "matching" (records with a label), "aggregation" (records without one),
+		or "keywords" (one record per patient, without a label or a trial).
+		The file is fsynced after sync_every records or sync_interval seconds, whichever comes first.
+		"""
+		self.path = path
+		self.stage = stage
+		self.sync_every = sync_every
+		self.sync_interval = sync_interval
+
+		# Dict{(Str(patient_id), Str(label) or None, Str(trial_id)): result}
+		self.results = {}
+		self.load()
+
+		self.file = open(path, "a", encoding="utf-8")
+		self.unsynced = 0
+		self.synced_at = time.monotonic()
+
+
+	def load(self):
+		"""Stream the existing records, a partial last line left by a crash is cut off."""
+		if not os.path.exists(self.path):
+			return
+
+		valid_size = 0
+
+		with open(self.path, "rb") as f:
+			for line in f:
+				if not line.endswith(b"\n"):
+					break
+
+				try:
+					record = json.loads(line)
+				except json.JSONDecodeError:
+					break
+
+				valid_size += len(line)
+
+				if record["stage"] == self.stage:
+					self.results[(record["patient_id"], record["label"], record["trial_id"])] = record["result"]
+
+		if valid_size < os.path.getsize(self.path):
+			with open(self.path, "r+b") as f:
+				f.truncate(valid_size)
+
+
+	def __contains__(self, key: tuple) -> bool:
+		return key in self.results
+
+
+	def __len__(self) -> int:
+		return len(self.results)
+
+
+	def put(self, patient_id: str, label: str, trial_id: str, result):
+		record = {
+			"stage": self.stage,
+			"patient_id": patient_id,
+			"label": label,
+			"trial_id": trial_id,
+			"result": result,
+		}
+
+		self.file.write(json.dumps(record) + "\n")
+		self.file.flush()
+		self.results[(patient_id, label, trial_id)] = result
+
+		self.unsynced += 1
+		if self.unsynced >= self.sync_every or time.monotonic() - self.synced_at >= self.sync_interval:
+			self.sync()
+
+
+	def sync(self):
+		os.fsync(self.file.fileno())
+		self.unsynced = 0
+		self.synced_at = time.monotonic()
+
+
+	def close(self):
+		self.sync()
+		self.file.close()
+
+
+	def import_nested(self, output: dict):
+		"""Add the results of a nested JSON output of the previous versions, for resuming from it."""
+		for patient_id, info in output.items():
+			if self.stage == "matching":
+				for label, trials in info.items():
+					for trial_id, result in trials.items():
+						if (patient_id, label, trial_id) not in self:
+							self.put(patient_id, label, trial_id, result)
+			elif self.stage == "keywords":
+				if (patient_id, None, None) not in self:
+					self.put(patient_id, None, None, info)
+			else:
+				for trial_id, result in info.items():
+					if (patient_id, None, trial_id) not in self:
+						self.put(patient_id, None, trial_id, result)
+
+		self.sync()
+
+
+	def to_nested(self) -> dict:
+		"""
+		matching: Dict{Str(patient_id): Dict{Str(label): Dict{Str(trial_id): result}}}
+		aggregation: Dict{Str(patient_id): Dict{Str(trial_id): result}}
+		keywords: Dict{Str(patient_id): result}
+		"""
+		output = {}
+
+		for (patient_id, label, trial_id), result in self.results.items():
+			if self.stage == "matching":
+				output.setdefault(patient_id, {"0": {}, "1": {}, "2": {}}).setdefault(label, {})[trial_id] = result
+			elif self.stage == "keywords":
+				output[patient_id] = result
+			else:
+				output.setdefault(patient_id, {})[trial_id] = result
+
+		return output
+
+
+	def export(self, json_path: str):
+		"""Write the nested JSON layout, atomically so that a kill never leaves a partial file."""
+		tmp_path = json_path + ".tmp"
+
+		with open(tmp_path, "w") as f:
+			json.dump(self.to_nested(), f, indent=4)
+
+		os.replace(tmp_path, json_path)
+
+
+def open_store(output_path: str, stage: str) -> ResultStore:
+	"""
+	The store next to a nested JSON output path (.json -> .jsonl). An existing JSON output
+	without a store, from the previous versions, is imported for resuming.
+	"""
+	store_path = os.path.splitext(output_path)[0] + ".jsonl"
+	is_new = not os.path.exists(store_path)
+	store = ResultStore(store_path, stage)
+
+	if is_new and os.path.exists(output_path):
+		store.import_nested(json.load(open(output_path)))
+
+	return store
+
+
+if __name__ == "__main__":
+	# export a store to the nested JSON layout
+	# syntax: python trialgpt_utils/result_store.py ${store_path} ${stage} ${json_path}
+	# ${stage} can be matching, aggregation, or keywords
+	store_path = sys.argv[1]
+	stage = sys.argv[2]
+	json_path = sys.argv[3]
+
+	store = ResultStore(store_path, stage)
+	store.export(json_path)
+	store.close()
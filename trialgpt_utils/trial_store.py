@@ -0,0 +1,162 @@
+__author__ = "qiao"
+
+"""
+SQLite store of the trial information keyed by NCT ID, built once from dataset/trial_info.json
+and rebuilt when the size or mtime of the source changes. The records are decoded on lookup,
+so a run only keeps the trials it actually uses in memory instead of the whole JSON dict.
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import time
+
+
+class TrialStore:
+	def __init__(self, path: str = "dataset/trial_info.sqlite3", source_path: str = "dataset/trial_info.json"):
+		self.path = path
+		self.source_path = source_path
+
+		# opened on first access, so that callers with complete trial records never build it
+		self.conn = None
+
+		# Dict{Str(NCTID): Dict(trial info)} of the decoded records
+		self.records = {}
+
+
+	def get_source_stamp(self) -> str:
+		stat = os.stat(self.source_path)
+
+		return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+	def connect(self):
+		if self.conn is not None:
+			return self.conn
+
+		# several processes and the worker threads of the pipeline can read the store
+		self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+		self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS trials (nctid TEXT PRIMARY KEY, value TEXT)")
+		self.conn.commit()
+
+		row = self.conn.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+
+		# without the source file, an existing store is used as is
+		if os.path.exists(self.source_path) and (row is None or row[0] != self.get_source_stamp()):
+			self.build()
+
+		return self.conn
+
+
+	def build(self):
+		"""(Re)load every trial of the source file, with the source stamp written in the same transaction."""
+		trial2info = json.load(open(self.source_path))
+
+		with self.conn:
+			self.conn.execute("DELETE FROM trials")
+			self.conn.executemany(
+				"INSERT INTO trials VALUES (?, ?)",
+				((nctid, json.dumps(info)) for nctid, info in trial2info.items()),
+			)
+			self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('source', ?)", (self.get_source_stamp(),))
+
+		self.records = {}
+
+
+	def get(self, nctid: str, default=None):
+		if nctid not in self.records:
+			row = self.connect().execute("SELECT value FROM trials WHERE nctid = ?", (nctid,)).fetchone()
+
+			if row is None:
+				return default
+
+			self.records[nctid] = json.loads(row[0])
+
+		return self.records[nctid]
+
+
+	def get_many(self, nctids: list) -> dict:
+		"""Dict{Str(NCTID): Dict(trial info)} of the known trials among nctids, in one query per 500 ids."""
+		missing = list(dict.fromkeys(nctid for nctid in nctids if nctid not in self.records))
+
+		# stay below the SQLite limit of host parameters
+		for start in range(0, len(missing), 500):
+			chunk = missing[start : start + 500]
+			placeholders = ",".join("?" * len(chunk))
+			query = f"SELECT nctid, value FROM trials WHERE nctid IN ({placeholders})"
+
+			for nctid, value in self.connect().execute(query, chunk):
+				self.records[nctid] = json.loads(value)
+
+		return {nctid: self.records[nctid] for nctid in nctids if nctid in self.records}
+
+
+	def __getitem__(self, nctid: str) -> dict:
+		info = self.get(nctid)
+
+		if info is None:
+			raise KeyError(nctid)
+
+		return info
+
+
+	def __contains__(self, nctid: str) -> bool:
+		if nctid in self.records:
+			return True
+
+		return self.connect().execute("SELECT 1 FROM trials WHERE nctid = ?", (nctid,)).fetchone() is not None
+
+
+	def __len__(self) -> int:
+		return self.connect().execute("SELECT COUNT(*) FROM trials").fetchone()[0]
+
+
+	def items(self):
+		"""Iterate over (NCTID, trial info) without keeping the records."""
+		for nctid, value in self.connect().execute("SELECT nctid, value FROM trials ORDER BY rowid"):
+			yield nctid, json.loads(value)
+
+
+	def resolve(self, trials: list) -> list:
+		"""
+		Complete trial records (with their NCTID) for a list of trials given as full records,
+		NCT IDs, or {"NCTID": ...} stubs. The unknown trials are dropped.
+		"""
+		trials = [{"NCTID": trial} if type(trial) is str else trial for trial in trials]
+		stubs = [trial["NCTID"] for trial in trials if "brief_title" not in trial]
+
+		if not stubs:
+			return trials
+
+		trial2info = self.get_many(stubs)
+
+		return [
+			trial if "brief_title" in trial else dict(trial2info[trial["NCTID"]], **trial)
+			for trial in trials
+			if "brief_title" in trial or trial["NCTID"] in trial2info
+		]
+
+
+if __name__ == "__main__":
+	# build (or check) the store and time the lookups
+	# syntax: python trialgpt_utils/trial_store.py ${trial_info_path} ${store_path}
+	source_path = sys.argv[1] if len(sys.argv) > 1 else "dataset/trial_info.json"
+	path = sys.argv[2] if len(sys.argv) > 2 else "dataset/trial_info.sqlite3"
+
+	start_time = time.time()
+	store = TrialStore(path, source_path)
+	print(f"{len(store)} trials in {path}, opened in {time.time() - start_time:.2f}s")
+
+	nctids = [row[0] for row in store.connect().execute("SELECT nctid FROM trials LIMIT 1000")]
+
+	start_time = time.time()
+	for nctid in nctids:
+		store.get(nctid)
+	print(f"{len(nctids)} single lookups in {time.time() - start_time:.3f}s")
+
+	store.records = {}
+	start_time = time.time()
+	store.get_many(nctids)
+	print(f"{len(nctids)} batch lookups in {time.time() - start_time:.3f}s")